@@ -0,0 +1,82 @@
+"""
+Микробенчмарк сериализации лобби.
+
+Сравнивает прежний путь (json.dumps(lobby.to_dict()) целиком) с форматами storage/codec.py
+на лобби из 4, 12 и 50 игроков с розданными картами. Для кодеков измеряется то же,
+что делает репозиторий: кодирование/декодирование записей всех игроков и бункера.
+
+Запуск:
+    python -m benchmarks.codec_bench [--repeat 200]
+"""
+import argparse
+import json
+import time
+
+from models.lobby import Lobby, Player
+from services.dealer import deal_lobby
+from storage.codec import JsonCodec, MsgpackCodec, encode_player, decode_player, encode_bunker, decode_bunker, \
+    msgpack, orjson
+from utils.scenario_loader import get_catalog
+
+LOBBY_SIZES = (4, 12, 50)
+
+
+def _make_lobby(players: int) -> Lobby:
+    members = [Player(user_id=100_000 + i, username=f"player{i}", cards=None) for i in range(players)]
+    lobby = Lobby(code="bench", owner=members[0], players=members, bunker=None, started=True)
+    deal_lobby(lobby, get_catalog().scenarios[0])
+    for player in members:
+        player.cards.revealed_values.append(next(iter(player.cards.characteristics)))
+    return lobby
+
+
+def _measure(fn, repeat: int) -> float:
+    """Возвращает среднее время вызова в микросекундах."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def _legacy_case(lobby: Lobby, repeat: int) -> tuple:
+    raw = json.dumps(lobby.to_dict())
+    encode = _measure(lambda: json.dumps(lobby.to_dict()), repeat)
+    decode = _measure(lambda: Lobby.from_dict(json.loads(raw)), repeat)
+    return encode, decode, len(raw.encode())
+
+
+def _codec_case(lobby: Lobby, codec, repeat: int) -> tuple:
+    def encode():
+        return [encode_player(p, codec) for p in lobby.players] + [encode_bunker(lobby.bunker, codec)]
+
+    records = encode()
+
+    def decode():
+        [decode_player(r) for r in records[:-1]]
+        decode_bunker(records[-1])
+
+    return _measure(encode, repeat), _measure(decode, repeat), sum(len(r) for r in records)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    codecs = [("json (stdlib)", JsonCodec(use_orjson=False))]
+    if orjson is not None:
+        codecs.append(("json (orjson)", JsonCodec()))
+    if msgpack is not None:
+        codecs.append(("msgpack", MsgpackCodec()))
+
+    print(f"{'игроков':>8} {'формат':<22} {'encode, мкс':>12} {'decode, мкс':>12} {'байт':>9}")
+    for size in LOBBY_SIZES:
+        lobby = _make_lobby(size)
+        rows = [("документ целиком", _legacy_case(lobby, args.repeat))]
+        rows += [(name, _codec_case(lobby, codec, args.repeat)) for name, codec in codecs]
+        for name, (encode, decode, size_bytes) in rows:
+            print(f"{size:>8} {name:<22} {encode:>12.1f} {decode:>12.1f} {size_bytes:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Микробенчмарк раздачи карт.
+
+Для лобби из 4, 12 и 50 игроков сравнивает:
+- независимый случайный выбор каждой карты для каждого игрока (как было до services/dealer.py);
+- раздачу по колодам без повторов (dealer.deal).
+Кроме времени выводится доля игроков, которым досталась та же профессия, что и кому-то еще в лобби.
+
+Запуск:
+    python -m benchmarks.deal_bench [--repeat 2000]
+"""
+import argparse
+import random
+import time
+from collections import Counter
+
+from models.player_card import PlayerCard
+from services.dealer import deal, new_seed
+from utils.scenario_loader import get_catalog
+
+LOBBY_SIZES = (4, 12, 50)
+CHARACTERISTIC = "Профессия"
+
+
+def _independent(scenario, players: int):
+    return [PlayerCard(characteristics={name: random.randrange(len(values))
+                                        for name, values in scenario.characteristics.items()},
+                       items=[random.randrange(len(scenario.items))],
+                       special_cards=[random.randrange(len(scenario.special_cards))])
+            for _ in range(players)]
+
+
+def _measure(fn, repeat: int) -> float:
+    """Возвращает среднее время вызова в микросекундах."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def _duplicates(deal_fn, repeat: int) -> float:
+    shared = total = 0
+    for _ in range(repeat):
+        counts = Counter(cards.characteristics.get(CHARACTERISTIC) for cards in deal_fn())
+        shared += sum(count for count in counts.values() if count > 1)
+        total += sum(counts.values())
+    return shared / total * 100
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    scenario = get_catalog().scenarios[0]
+    print(f"Мкс на раздачу лобби; повторы - доля игроков с неуникальной характеристикой «{CHARACTERISTIC}»")
+    print(f"{'игроков':>8} {'независимо':>11} {'повторы':>8} {'колоды':>8} {'повторы':>8}")
+    for size in LOBBY_SIZES:
+        independent = _measure(lambda: _independent(scenario, size), args.repeat)
+        decks = _measure(lambda: deal(scenario, new_seed(), size), args.repeat)
+        independent_dups = _duplicates(lambda: _independent(scenario, size), args.repeat // 10)
+        deck_dups = _duplicates(lambda: deal(scenario, new_seed(), size), args.repeat // 10)
+        print(f"{size:>8} {independent:>11.1f} {independent_dups:>7.1f}% {decks:>8.1f} {deck_dups:>7.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Локальная замена Bot API для нагрузочных тестов.
+
+HTTP-сервер отвечает на запросы вида POST /bot<токен>/<метод> так же, как Telegram:
+sendMessage и editMessageText возвращают сообщение, остальные методы - true.
+Последние сообщения каждому чату (текст и клавиатура) сохраняются, чтобы тест мог
+«нажимать кнопки». Можно задать задержку ответа и долю ответов 429.
+Используется benchmarks/load_test.py.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List
+
+from aiohttp import web
+
+MESSAGE_METHODS = {"sendmessage", "editmessagetext"}
+# Сколько последних сообщений хранится для каждого чата
+HISTORY_SIZE = 64
+
+
+@dataclass(slots=True)
+class SentMessage:
+    text: str
+    keyboard: List[str] = field(default_factory=list)
+
+
+class FakeBotApi:
+    def __init__(self, delay: float = 0.0, rate_limited: float = 0.0):
+        self.delay = delay
+        self.rate_limited = rate_limited
+        self.calls = 0
+        self.rejected = 0
+        self.messages: Dict[int, Deque[SentMessage]] = {}
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        return app
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.rate_limited and random.random() < self.rate_limited:
+            self.rejected += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}})
+
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        if method not in MESSAGE_METHODS:
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(data["chat_id"])
+        markup = json.loads(data["reply_markup"]) if "reply_markup" in data else {}
+        history = self.messages.get(chat_id)
+        if history is None:
+            history = self.messages[chat_id] = deque(maxlen=HISTORY_SIZE)
+        history.append(SentMessage(text=data.get("text", ""),
+                                   keyboard=[button["text"] for row in markup.get("keyboard", []) for button in row]))
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+        return web.json_response({"ok": True, "result": message})
+
+    def find_message(self, chat_id: int, prefix: str) -> SentMessage | None:
+        """Последнее сообщение чату, текст которого начинается с prefix."""
+        for message in reversed(self.messages.get(chat_id, ())):
+            if message.text.startswith(prefix):
+                return message
+        return None
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
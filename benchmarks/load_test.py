@@ -0,0 +1,315 @@
+"""
+Нагрузочный тест бота: lobbies лобби по players игроков проходят полный цикл игры.
+
+Апдейты подаются в диспетчер бота (main.dp: роутер lobby_commands со всеми middleware
+и хранилищем состояний в Redis), ответы принимает локальная замена Bot API
+(benchmarks/fake_bot_api.py), Redis - из config.py (лучше отдельная база: тест создает
+и удаляет свои лобби, но считает команды всех клиентов сервера).
+
+Этапы выполняются по очереди, внутри этапа все лобби работают одновременно (не больше
+--concurrency действий сразу):
+- create: владелец создает лобби (/create);
+- join: остальные игроки входят по коду из ответа бота (/join <код>);
+- start_game: владелец начинает игру;
+- reveal: каждый игрок --reveals раз раскрывает карту кнопками «Действия» -> «Раскрыть карту» -> <характеристика>;
+- leave: все игроки выходят, лобби удаляются.
+Для каждого действия выводятся пропускная способность, задержки p50/p95/p99, число операций Redis,
+которых ждут обработчики (запрос или конвейер - одна операция), число команд, выполненных сервером Redis
+(вместе с командами внутри Lua-скриптов), и запросов к Bot API на одно действие. Уведомления отправляются из очереди после ответа бота, поэтому
+перед подсчетом команд и запросов этап ждет, пока очередь уведомлений опустеет и обновятся живые доски
+(в задержки это время не входит). Живая доска вместо уведомлений: LIVE_BOARD=1 python -m benchmarks.load_test.
+
+Результаты можно сохранить (--output) и сравнить с сохраненными ранее (--baseline): при росте
+p95, числа операций или команд Redis больше чем на --tolerance тест завершается с кодом 1.
+
+Все действия этапа начинаются одновременно, поэтому задержка в основном - ожидание своей очереди
+в цикле событий: p50 примерно равно числу одновременных действий, деленному на пропускную способность.
+Изменения сравниваются по пропускной способности и числу операций Redis при одних и тех же параметрах.
+
+Запуск:
+    python -m benchmarks.load_test [--lobbies 1000] [--players 6] [--concurrency 500] [--api-delay 0.02]
+    python -m benchmarks.load_test --output baseline.json
+    python -m benchmarks.load_test --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+os.environ.setdefault("API_TOKEN", "42:LOADTEST")
+# Рассылка не должна упираться в лимиты Telegram: проверяется сам бот
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000000")
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+# Под нагрузкой медленным оказывается почти каждый апдейт, деревья вызовов только засоряют вывод
+os.environ.setdefault("TRACE_SLOW_UPDATE_MS", "0")
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import config
+from benchmarks.fake_bot_api import FakeBotApi
+from main import dp
+from services.lobby_service import live_boards
+from services.outbox import outbox_stats
+from storage import redis_repository
+from utils.metrics import REDIS_LATENCY
+
+PHASES = ["create", "join", "start_game", "reveal", "leave"]
+CODE_PATTERN = re.compile(r"Код: \|\|([0-9a-f]+)\|\|")
+
+
+@dataclass(slots=True)
+class PhaseResult:
+    actions: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    redis_commands: int = 0
+    redis_operations: int = 0
+    api_calls: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+    def percentile(self, q: float) -> float:
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+    def to_dict(self):
+        return {"actions": self.actions,
+                "failed": self.failed,
+                "throughput": self.actions / self.seconds if self.seconds else 0.0,
+                "p50_ms": self.percentile(0.5) * 1000,
+                "p95_ms": self.percentile(0.95) * 1000,
+                "p99_ms": self.percentile(0.99) * 1000,
+                "mean_ms": statistics.fmean(self.latencies) * 1000 if self.latencies else 0.0,
+                "redis_per_action": self.redis_commands / self.actions if self.actions else 0.0,
+                "redis_ops_per_action": self.redis_operations / self.actions if self.actions else 0.0,
+                "api_per_action": self.api_calls / self.actions if self.actions else 0.0}
+
+
+class LoadTest:
+    def __init__(self, bot: Bot, api: FakeBotApi, lobbies: int, players: int, reveals: int, concurrency: int,
+                 user_id_base: int):
+        self.bot = bot
+        self.api = api
+        self.lobbies = lobbies
+        self.players = players
+        self.reveals = reveals
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.user_id_base = user_id_base
+        self.codes: Dict[int, str] = {}
+        self._update_ids = iter(range(1, 1 << 62))
+
+    def user_id(self, lobby: int, player: int) -> int:
+        return self.user_id_base + lobby * 100 + player
+
+    async def send(self, user_id: int, text: str) -> None:
+        message = {"message_id": next(self._update_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": "load", "username": f"load{user_id}"},
+                   "text": text}
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        update = Update.model_validate({"update_id": next(self._update_ids), "message": message},
+                                       context={"bot": self.bot})
+        await dp.feed_update(self.bot, update)
+
+    async def create(self, lobby: int) -> bool:
+        owner = self.user_id(lobby, 0)
+        await self.send(owner, "/create")
+        reply = self.api.find_message(owner, "Лобби создано")
+        match = CODE_PATTERN.search(reply.text) if reply else None
+        if match:
+            self.codes[lobby] = match.group(1)
+        return match is not None
+
+    async def join(self, lobby: int, player: int) -> bool:
+        user_id = self.user_id(lobby, player)
+        await self.send(user_id, f"/join {self.codes[lobby]}")
+        reply = self.api.find_message(user_id, "Вы ")
+        return reply is not None and reply.text.startswith("Вы присоединились")
+
+    async def start_game(self, lobby: int) -> bool:
+        owner = self.user_id(lobby, 0)
+        await self.send(owner, "/start_game")
+        return self.api.find_message(owner, "Игра") is not None
+
+    async def reveal(self, lobby: int, player: int) -> bool:
+        user_id = self.user_id(lobby, player)
+        await self.send(user_id, "Действия")
+        await self.send(user_id, "Раскрыть карту")
+        prompt = self.api.find_message(user_id, "Какую характеристику")
+        choices = [text for text in prompt.keyboard if text != "Назад"] if prompt else []
+        if not choices:
+            return False
+        await self.send(user_id, random.choice(choices))
+        return self.api.find_message(user_id, "Вы успешно раскрыли") is not None
+
+    async def leave(self, lobby: int, player: int) -> bool:
+        user_id = self.user_id(lobby, player)
+        await self.send(user_id, "/leave")
+        return self.api.find_message(user_id, "Вы покинули лобби") is not None
+
+    def actions(self, phase: str) -> list:
+        lobbies = range(self.lobbies)
+        if phase == "create":
+            return [(self.create, lobby) for lobby in lobbies]
+        if phase == "join":
+            return [(self.join, lobby, player) for lobby in lobbies if lobby in self.codes
+                    for player in range(1, self.players)]
+        if phase == "start_game":
+            return [(self.start_game, lobby) for lobby in lobbies if lobby in self.codes]
+        if phase == "reveal":
+            return [(self.reveal, lobby, player) for _ in range(self.reveals) for lobby in lobbies
+                    if lobby in self.codes for player in range(self.players)]
+        return [(self.leave, lobby, player) for lobby in lobbies if lobby in self.codes
+                for player in range(self.players)]
+
+    async def run_phase(self, phase: str) -> PhaseResult:
+        result = PhaseResult()
+
+        async def run(action, *args) -> None:
+            async with self.semaphore:
+                started = time.perf_counter()
+                try:
+                    ok = await action(*args)
+                except Exception as e:
+                    print(f"{phase}: {e}")
+                    ok = False
+                result.latencies.append(time.perf_counter() - started)
+                result.actions += 1
+                result.failed += not ok
+
+        actions = self.actions(phase)
+        # Повторы раскрытия одного игрока выполняются по очереди, чтобы не перемешать его кнопки
+        if phase == "reveal":
+            by_player: Dict[tuple, list] = {}
+            for action in actions:
+                by_player.setdefault(action[1:], []).append(action)
+
+            async def run_sequence(sequence: list) -> None:
+                for action in sequence:
+                    await run(*action)
+
+            jobs = [run_sequence(sequence) for sequence in by_player.values()]
+        else:
+            jobs = [run(*action) for action in actions]
+
+        commands_before = await _redis_commands()
+        operations_before = _redis_operations()
+        api_before = self.api.calls
+        started = time.perf_counter()
+        await asyncio.gather(*jobs)
+        result.seconds = time.perf_counter() - started
+        await _drain_notifications()
+        # Сама команда INFO тоже учитывается сервером
+        result.redis_commands = await _redis_commands() - commands_before - 1
+        result.redis_operations = _redis_operations() - operations_before
+        result.api_calls = self.api.calls - api_before
+        return result
+
+
+async def _redis_commands() -> int:
+    return (await redis_repository.redis_client.info("stats"))["total_commands_processed"]
+
+
+def _redis_operations() -> int:
+    """Операции репозитория, замеренные observe_redis в этом процессе (чтения из кэшей не учитываются)."""
+    return int(sum(sample.value for metric in REDIS_LATENCY.collect() for sample in metric.samples
+                   if sample.name.endswith("_count")))
+
+
+async def _drain_notifications(timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while (live_boards.pending() or (await outbox_stats()).length) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+def _print_results(results: Dict[str, dict]) -> None:
+    print(f"{'действие':<12}{'всего':>8}{'ошибок':>8}{'в с':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"
+          f"{'опер./д':>9}{'Redis/д':>9}{'API/д':>7}")
+    for phase, r in results.items():
+        print(f"{phase:<12}{r['actions']:>8}{r['failed']:>8}{r['throughput']:>9.0f}{r['p50_ms']:>9.1f}"
+              f"{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r.get('redis_ops_per_action', 0.0):>9.1f}"
+              f"{r['redis_per_action']:>9.1f}{r['api_per_action']:>7.1f}")
+
+
+def _compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    for phase, r in results.items():
+        base = baseline.get(phase)
+        if not base:
+            continue
+        for key in ("p95_ms", "redis_ops_per_action", "redis_per_action"):
+            # В старых результатах операций Redis нет
+            if base.get(key) and r[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{phase}: {key} {base[key]:.1f} -> {r[key]:.1f}")
+    return regressions
+
+
+async def main_async(args) -> Dict[str, dict]:
+    random.seed(args.seed)
+    api = FakeBotApi(delay=args.api_delay, rate_limited=args.rate_limited)
+    runner = await api.start("127.0.0.1", args.api_port)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.api_port}"),
+                             limit=args.api_connections)
+    bot = Bot(token=config.API_TOKEN, session=session)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    # id пользователей теста не пересекаются с реальными id Telegram и с предыдущими запусками
+    test = LoadTest(bot, api, args.lobbies, args.players, args.reveals, args.concurrency,
+                    user_id_base=10 ** 12 + random.randrange(10 ** 6) * 10 ** 6)
+    results = {}
+    try:
+        for phase in PHASES:
+            results[phase] = (await test.run_phase(phase)).to_dict()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        await runner.cleanup()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lobbies", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--reveals", type=int, default=1, help="раскрытий на игрока")
+    parser.add_argument("--concurrency", type=int, default=500, help="действий одновременно")
+    parser.add_argument("--api-delay", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--rate-limited", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--api-connections", type=int, default=100, help="соединений бота с Bot API")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="сравнить с результатами из JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p95, операций и команд Redis")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    _print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failed = sum(r["failed"] for r in results.values())
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = _compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Регрессия: {regression}")
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
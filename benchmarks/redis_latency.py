@@ -0,0 +1,137 @@
+"""
+Задержки операций с лобби в Redis через слой подключения бота (storage/redis_connection.py).
+
+Создает лобби и выполняет конкурентно:
+- чтение кода лобби пользователя и чтение лобби (в реплику, если задан REDIS_REPLICA_HOST, кэш лобби выключен);
+- чтение лобби из основного Redis (как под блокировкой);
+- запись игрока лобби;
+- вход и выход игрока.
+Для каждой операции выводятся перцентили задержки, в конце - состояние пула соединений.
+С репликой дополнительно проверяется, через сколько запись видна при чтении из реплики.
+
+Запуск (нужен Redis, параметры подключения и пула берутся из config.py):
+    python -m benchmarks.redis_latency [--lobbies 50] [--requests 2000] [--concurrency 64]
+    REDIS_REPLICA_HOST=localhost REDIS_REPLICA_PORT=6380 python -m benchmarks.redis_latency
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from models.error import BadResponse
+from models.lobby import Lobby, Player
+from storage import redis_repository
+from storage.redis_connection import pool_stats
+
+# id пользователей теста не пересекаются с реальными id Telegram
+USER_ID_BASE = -30_000_000
+
+
+def _user_id(lobby_index: int, player_index: int) -> int:
+    return USER_ID_BASE - lobby_index * 100 - player_index
+
+
+def _lobby_code(lobby_index: int) -> str:
+    return f"latency{lobby_index}"
+
+
+def _percentiles(values: List[float]) -> str:
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+    return (f"p50 {pick(0.5):6.2f}  p95 {pick(0.95):6.2f}  p99 {pick(0.99):6.2f}  "
+            f"max {values[-1] * 1000:6.2f}  сред. {statistics.fmean(values) * 1000:6.2f} мс")
+
+
+async def _cleanup(lobbies: int) -> None:
+    await redis_repository.delete_lobbies([_lobby_code(i) for i in range(lobbies)],
+                                          [_user_id(i, p) for i in range(lobbies) for p in (0, 1)])
+
+
+async def _prepare(lobbies: int) -> None:
+    await _cleanup(lobbies)
+    for i in range(lobbies):
+        owner = Player(user_id=_user_id(i, 0), username="owner", cards=None)
+        response = await redis_repository.create_lobby_and_add_user(
+            owner.user_id, Lobby(code=_lobby_code(i), owner=owner, players=[owner], bunker=None))
+        if isinstance(response, BadResponse):
+            raise RuntimeError(response.message)
+
+
+async def _join_leave(lobby_index: int) -> None:
+    user_id = _user_id(lobby_index, 1)
+    await redis_repository.add_user_to_lobby(user_id, "guest", _lobby_code(lobby_index))
+    await redis_repository.remove_user_from_lobby(user_id, _lobby_code(lobby_index))
+
+
+async def _write_player(lobby_index: int) -> None:
+    lobby = await redis_repository.get_lobby_by_code(_lobby_code(lobby_index), fresh=True)
+    await redis_repository.save_lobby_changes(lobby, [lobby.owner.user_id], meta=False)
+
+
+OPERATIONS = {
+    "код лобби пользователя": lambda i: redis_repository.get_user_lobby_code(_user_id(i, 0)),
+    "чтение лобби": lambda i: redis_repository.get_lobby_by_code(_lobby_code(i)),
+    "чтение лобби (основной)": lambda i: redis_repository.get_lobby_by_code(_lobby_code(i), fresh=True),
+    "запись игрока": _write_player,
+    "вход и выход": _join_leave,
+}
+
+
+async def _measure_replica_lag(samples: int) -> List[float]:
+    """Время от записи в основной Redis до появления новой версии лобби в реплике."""
+    lags = []
+    code = _lobby_code(0)
+    for _ in range(samples):
+        lobby = await redis_repository.get_lobby_by_code(code, fresh=True)
+        saved = await redis_repository.save_lobby_changes(lobby, [lobby.owner.user_id], meta=False)
+        written = time.perf_counter()
+        while True:
+            version = await redis_repository.redis_reader.hget(redis_repository.LOBBY_KEY_PREFIX + code,
+                                                               redis_repository.VERSION_FIELD)
+            if int(version) >= saved.version:
+                break
+        lags.append(time.perf_counter() - written)
+    return lags
+
+
+async def run(lobbies: int, requests: int, concurrency: int) -> None:
+    await _prepare(lobbies)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(name: str, index: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await OPERATIONS[name](index % lobbies)
+            latencies[name].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(name, i) for i in range(requests) for name in OPERATIONS))
+    elapsed = time.perf_counter() - started
+
+    replica = redis_repository.redis_reader is not redis_repository.redis_client
+    print(f"Операций: {requests * len(OPERATIONS)}, одновременно: {concurrency}, "
+          f"{requests * len(OPERATIONS) / elapsed:.0f} операций/с, реплика: {'да' if replica else 'нет'}")
+    for name in OPERATIONS:
+        print(f"{name:<26} {_percentiles(latencies[name])}")
+    if replica:
+        print(f"{'отставание реплики':<26} {_percentiles(await _measure_replica_lag(200))}")
+    print(f"Пул основного Redis: {pool_stats(redis_repository.redis_client)}")
+
+    await _cleanup(lobbies)
+    await redis_repository.close_redis()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lobbies", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="запросов каждой операции")
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+    asyncio.run(run(args.lobbies, args.requests, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
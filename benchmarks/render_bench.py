@@ -0,0 +1,71 @@
+"""
+Микробенчмарк отрисовки доски лобби и карточки игрока.
+
+Для лобби из 4, 12 и 50 игроков с розданными картами сравнивает:
+- экранирование строк при каждой отрисовке (как было до кэша отрисовки);
+- отрисовку с заранее экранированными строками каталога;
+- повторный запрос той же версии лобби (текст из кэша отрисовки).
+
+Запуск:
+    python -m benchmarks.render_bench [--repeat 200]
+"""
+import argparse
+import copy
+import time
+
+from models.lobby import Lobby, Player
+from services.dealer import deal_lobby
+from services.render_service import render_lobby_board, render_player_card, render_cache
+from utils.scenario_loader import get_catalog
+
+LOBBY_SIZES = (4, 12, 50)
+
+
+def _make_lobby(players: int, scenario) -> Lobby:
+    members = [Player(user_id=100_000 + i, username=f"player_{i}", cards=None) for i in range(players)]
+    lobby = Lobby(code="bench", owner=members[0], players=members, bunker=None, started=True)
+    deal_lobby(lobby, scenario)
+    for player in members[::2]:
+        player.cards.revealed_values += list(player.cards.characteristics)[:3]
+    return lobby
+
+
+def _measure(fn, repeat: int) -> float:
+    """Возвращает среднее время вызова в микросекундах."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def _render_all(lobby: Lobby, scenario) -> None:
+    render_lobby_board(lobby, scenario)
+    for player in lobby.players:
+        render_player_card(lobby, player, scenario)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    scenario = get_catalog().scenarios[0]
+    unescaped = copy.copy(scenario)
+    unescaped.escaped_text = {}
+
+    print("Доска лобби и карточки всех игроков, мкс на одну версию лобби")
+    print(f"{'игроков':>8} {'экранирование':>14} {'заранее':>10} {'из кэша':>10}")
+    for size in LOBBY_SIZES:
+        lobby = _make_lobby(size, scenario)
+        # Версия 0 - кэш отрисовки не используется
+        escaping = _measure(lambda: _render_all(lobby, unescaped), args.repeat)
+        prepared = _measure(lambda: _render_all(lobby, scenario), args.repeat)
+        lobby.version = 1
+        render_cache.clear()
+        _render_all(lobby, scenario)
+        cached = _measure(lambda: _render_all(lobby, scenario), args.repeat)
+        print(f"{size:>8} {escaping:>14.1f} {prepared:>10.1f} {cached:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
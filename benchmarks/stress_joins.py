@@ -0,0 +1,119 @@
+"""
+Стресс-тест одновременных входов в лобби.
+
+Несколько процессов одновременно добавляют игроков в одни и те же лобби,
+затем проверяется, что ни один вход не потерялся, а после одновременных выходов
+лобби корректно удаляются.
+
+Запуск (нужен локальный Redis, параметры подключения берутся из config.py):
+    python -m benchmarks.stress_joins --lobbies 20 --players 50 --processes 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import sys
+
+from models.error import BadResponse
+from models.lobby import Lobby, Player
+from storage import redis_repository
+
+# id пользователей теста не пересекаются с реальными id Telegram
+USER_ID_BASE = -10_000_000
+
+
+def _user_id(lobby_index: int, player_index: int) -> int:
+    return USER_ID_BASE - lobby_index * 10_000 - player_index
+
+
+def _lobby_code(lobby_index: int) -> str:
+    return f"stress{lobby_index}"
+
+
+async def _join_slice(lobbies: int, players: int, process_index: int, processes: int) -> int:
+    tasks = [redis_repository.add_user_to_lobby(_user_id(lobby, player), f"p{player}", _lobby_code(lobby))
+             for lobby in range(lobbies)
+             for player in range(1, players)
+             if player % processes == process_index]
+    results = await asyncio.gather(*tasks)
+    await redis_repository.close_redis()
+    return sum(isinstance(r, BadResponse) for r in results)
+
+
+def _join_worker(args) -> int:
+    return asyncio.run(_join_slice(*args))
+
+
+async def _cleanup(lobbies: int, players: int) -> None:
+    user_ids = [_user_id(lobby, player) for lobby in range(lobbies) for player in range(players)]
+    await redis_repository.delete_lobbies([_lobby_code(lobby) for lobby in range(lobbies)], user_ids)
+
+
+async def _create_lobbies(lobbies: int) -> None:
+    for lobby in range(lobbies):
+        owner = Player(user_id=_user_id(lobby, 0), username="owner", cards=None)
+        lobby_obj = Lobby(code=_lobby_code(lobby), owner=owner, players=[owner], bunker=None)
+        response = await redis_repository.create_lobby_and_add_user(owner.user_id, lobby_obj)
+        if isinstance(response, BadResponse):
+            raise RuntimeError(response.message)
+
+
+async def _check_membership(lobbies: int, players: int) -> int:
+    lost = 0
+    for lobby in range(lobbies):
+        response = await redis_repository.get_lobby_by_code(_lobby_code(lobby))
+        expected = {_user_id(lobby, player) for player in range(players)}
+        actual = {p.user_id for p in response.players} if isinstance(response, Lobby) else set()
+        if actual != expected:
+            lost += len(expected - actual)
+            print(f"Лобби {_lobby_code(lobby)}: потеряно {len(expected - actual)} игроков")
+    return lost
+
+
+async def _leave_all(lobbies: int, players: int) -> int:
+    results = await asyncio.gather(*(redis_repository.remove_user_from_lobby(_user_id(lobby, player), _lobby_code(lobby))
+                                     for lobby in range(lobbies) for player in range(players)))
+    left = 0
+    for lobby in range(lobbies):
+        if await redis_repository.redis_client.exists(redis_repository.LOBBY_KEY_PREFIX + _lobby_code(lobby)):
+            left += 1
+    return sum(isinstance(r, BadResponse) for r in results) + left
+
+
+async def _prepare(lobbies: int, players: int) -> None:
+    await _cleanup(lobbies, players)
+    await _create_lobbies(lobbies)
+    await redis_repository.close_redis()
+
+
+async def _verify(lobbies: int, players: int) -> int:
+    lost = await _check_membership(lobbies, players)
+    leave_errors = await _leave_all(lobbies, players)
+    if leave_errors:
+        print(f"Ошибок при выходе из лобби: {leave_errors}")
+    await _cleanup(lobbies, players)
+    return lost + leave_errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lobbies", type=int, default=20)
+    parser.add_argument("--players", type=int, default=50, help="игроков в лобби, включая владельца")
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    asyncio.run(_prepare(args.lobbies, args.players))
+
+    with multiprocessing.Pool(args.processes) as pool:
+        errors = sum(pool.map(_join_worker, [(args.lobbies, args.players, i, args.processes)
+                                             for i in range(args.processes)]))
+    if errors:
+        print(f"Ошибок при входе в лобби: {errors}")
+
+    failures = asyncio.run(_verify(args.lobbies, args.players)) + errors
+    joins = args.lobbies * (args.players - 1)
+    print(f"Входов: {joins}, процессов: {args.processes}, потерь и ошибок: {failures}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Стресс-тест одновременных изменений лобби из нескольких процессов.
+
+Процессы одновременно раскрывают разные характеристики одних и тех же игроков
+(каждое раскрытие читает и перезаписывает запись игрока). Затем проверяется, что ни одно
+раскрытие не потерялось, и выводится пропускная способность и число записей лобби в Redis
+(одновременные раскрытия в одном лобби сохраняются одной записью) для каждого числа процессов.
+
+Запуск (нужен локальный Redis, параметры подключения берутся из config.py):
+    python -m benchmarks.stress_reveals --lobbies 50 --players 6 --processes 1 2 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+# Уведомления о раскрытии не должны упираться в лимиты Telegram
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000000")
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+
+from models.error import BadResponse
+from models.lobby import Lobby, Player
+from services import lobby_service, lobby_actor
+from services.dealer import deal_lobby
+from services.outbox import start_outbox, stop_outbox, outbox_stats
+from storage import redis_repository
+from utils.scenario_loader import get_catalog
+
+# id пользователей теста не пересекаются с реальными id Telegram
+USER_ID_BASE = -20_000_000
+
+
+class NullBot:
+    async def send_message(self, *args, **kwargs):
+        return None
+
+
+def _user_id(lobby_index: int, player_index: int) -> int:
+    return USER_ID_BASE - lobby_index * 10_000 - player_index
+
+
+def _lobby_code(lobby_index: int) -> str:
+    return f"reveal{lobby_index}"
+
+
+async def _cleanup(lobbies: int, players: int) -> None:
+    user_ids = [_user_id(lobby, player) for lobby in range(lobbies) for player in range(players)]
+    await redis_repository.delete_lobbies([_lobby_code(lobby) for lobby in range(lobbies)], user_ids)
+
+
+async def _prepare(lobbies: int, players: int) -> None:
+    await _cleanup(lobbies, players)
+    scenario = get_catalog().scenarios[0]
+    for lobby_index in range(lobbies):
+        code = _lobby_code(lobby_index)
+        owner = Player(user_id=_user_id(lobby_index, 0), username="owner", cards=None)
+        response = await redis_repository.create_lobby_and_add_user(
+            owner.user_id, Lobby(code=code, owner=owner, players=[owner], bunker=None))
+        if isinstance(response, BadResponse):
+            raise RuntimeError(response.message)
+        for player in range(1, players):
+            await redis_repository.add_user_to_lobby(_user_id(lobby_index, player), f"p{player}", code)
+        lobby = await redis_repository.get_lobby_by_code(code, fresh=True)
+        lobby.started = True
+        deal_lobby(lobby, scenario)
+        await redis_repository.save_lobby_changes(lobby, [p.user_id for p in lobby.players], meta=True)
+    await redis_repository.close_redis()
+
+
+def _characteristics() -> list:
+    return list(get_catalog().scenarios[0].characteristics)
+
+
+async def _reveal_slice(lobbies: int, players: int, process_index: int, processes: int) -> tuple:
+    names = [name for i, name in enumerate(_characteristics()) if i % processes == process_index]
+    bot = NullBot()
+    await start_outbox(bot)
+    results = await asyncio.gather(*(lobby_service.reveal_player_value(_user_id(lobby, player), name)
+                                     for name in names
+                                     for lobby in range(lobbies)
+                                     for player in range(players)))
+    await lobby_actor.stop_lobby_actors()
+    # Уведомления о раскрытии отправляют отправители очереди всех процессов
+    while (await outbox_stats()).length:
+        await asyncio.sleep(0.05)
+    await stop_outbox()
+    await redis_repository.close_redis()
+    return sum(not r for r in results), lobby_actor.stats.writes
+
+
+def _reveal_worker(args) -> tuple:
+    return asyncio.run(_reveal_slice(*args))
+
+
+async def _verify(lobbies: int, players: int) -> int:
+    expected = set(_characteristics())
+    lost = 0
+    for lobby_index in range(lobbies):
+        lobby = await redis_repository.get_lobby_by_code(_lobby_code(lobby_index), fresh=True)
+        for player in lobby.players:
+            missing = expected - set(player.cards.revealed_values)
+            if missing:
+                lost += len(missing)
+                print(f"Лобби {lobby.code}, игрок {player.user_id}: не раскрыто {sorted(missing)}")
+    await _cleanup(lobbies, players)
+    await redis_repository.close_redis()
+    return lost
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lobbies", type=int, default=50)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    failures = 0
+    reveals = args.lobbies * args.players * len(_characteristics())
+    for processes in args.processes:
+        asyncio.run(_prepare(args.lobbies, args.players))
+        started = time.perf_counter()
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_reveal_worker, [(args.lobbies, args.players, i, processes)
+                                                for i in range(processes)])
+        errors = sum(r[0] for r in results)
+        writes = sum(r[1] for r in results)
+        elapsed = time.perf_counter() - started
+        lost = asyncio.run(_verify(args.lobbies, args.players))
+        failures += errors + lost
+        print(f"Процессов: {processes}, раскрытий: {reveals}, {reveals / elapsed:.0f} раскрытий/с, "
+              f"записей в Redis: {writes}, отклонено: {errors}, потеряно: {lost}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
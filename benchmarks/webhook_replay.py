@@ -0,0 +1,178 @@
+"""
+Нагрузочный прогон режима webhook.
+
+Поднимает приложение вебхука (webhook.build_app) с настоящим диспетчером бота и Redis
+из config.py, но с поддельной сессией Bot API, и отправляет в него POST-запросы с апдейтами.
+Для каждого апдейта измеряется:
+- время ответа вебхука (сколько ждет Telegram);
+- время от отправки запроса до окончания обработки апдейта диспетчером.
+
+Апдейты берутся из файла JSONL (по одному апдейту Bot API в строке, например записанные
+с помощью --record) или генерируются: каждый пользователь создает лобби, смотрит лобби,
+персонажа и бункер и выходит. Апдейты одного пользователя отправляются по очереди,
+пользователи - параллельно, как это делает Telegram.
+
+Запуск (нужен Redis, лучше отдельная база):
+    python -m benchmarks.webhook_replay [--users 200] [--workers 8] [--api-delay 0.05]
+    python -m benchmarks.webhook_replay --record updates.jsonl --users 50
+    python -m benchmarks.webhook_replay --updates updates.jsonl
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+os.environ.setdefault("API_TOKEN", "42:REPLAY")
+os.environ.setdefault("WEBHOOK_SECRET", "replay-secret")
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message, Chat
+from aiohttp import ClientSession, web
+
+import config
+from main import dp
+from webhook import build_app
+
+USER_SCRIPT = ["/start", "/create", "/lobby", "/me", "/bunker", "/leave"]
+
+
+class FakeApiSession(BaseSession):
+    """Сессия Bot API без сети: отвечает через delay секунд."""
+
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+        self.calls = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if hasattr(method, "text") and hasattr(method, "chat_id"):
+            return Message(message_id=self.calls, date=0, chat=Chat(id=method.chat_id, type="private"), text=method.text)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def generate_updates(users: int) -> List[dict]:
+    base = random.randrange(10 ** 9, 2 * 10 ** 9)
+    ids = itertools.count(1)
+    updates = []
+    for text in USER_SCRIPT:
+        for user_id in range(base, base + users):
+            message = {"message_id": next(ids), "date": int(time.time()),
+                       "chat": {"id": user_id, "type": "private"},
+                       "from": {"id": user_id, "is_bot": False, "first_name": "replay", "username": f"replay{user_id}"},
+                       "text": text,
+                       "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}
+            updates.append({"update_id": next(ids), "message": message})
+    return updates
+
+
+def _sender(update: dict) -> int:
+    for event in update.values():
+        if isinstance(event, dict) and "from" in event:
+            return event["from"]["id"]
+    return update["update_id"]
+
+
+def _percentiles(values: List[float]) -> str:
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+    return (f"p50 {pick(0.5):7.1f}  p95 {pick(0.95):7.1f}  p99 {pick(0.99):7.1f}  "
+            f"max {values[-1] * 1000:7.1f}  сред. {statistics.fmean(values) * 1000:7.1f} мс")
+
+
+async def replay(updates: List[dict], workers: int, api_delay: float, port: int) -> None:
+    sent_at: Dict[int, float] = {}
+    handled_at: Dict[int, float] = {}
+    done = asyncio.Event()
+
+    async def measure(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            handled_at[event.update_id] = time.perf_counter()
+            if len(handled_at) == len(updates):
+                done.set()
+
+    dp.update.outer_middleware(measure)
+    bot = Bot(token=config.API_TOKEN, session=FakeApiSession(api_delay))
+    runner = web.AppRunner(build_app(dp, bot, workers))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    by_user = defaultdict(list)
+    for update in updates:
+        by_user[_sender(update)].append(update)
+
+    url = f"http://127.0.0.1:{port}{config.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": config.WEBHOOK_SECRET}
+    ack: List[float] = []
+    rejected = 0
+
+    async with ClientSession() as http:
+        async def send_user(user_updates: List[dict]) -> None:
+            nonlocal rejected
+            for update in user_updates:
+                start = time.perf_counter()
+                sent_at[update["update_id"]] = start
+                async with http.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        rejected += 1
+                ack.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send_user(u) for u in by_user.values()))
+        await asyncio.wait_for(done.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+
+    total = [handled_at[i] - sent_at[i] for i in handled_at]
+    print(f"Апдейтов: {len(updates)}, пользователей: {len(by_user)}, отклонено: {rejected}, "
+          f"{len(updates) / elapsed:.0f} апдейтов/с")
+    print(f"Ответ вебхука:       {_percentiles(ack)}")
+    print(f"Обработка апдейта:   {_percentiles(total)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", help="файл JSONL с апдейтами")
+    parser.add_argument("--record", help="сохранить сгенерированные апдейты в файл и выйти")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=config.WEBHOOK_WORKERS)
+    parser.add_argument("--api-delay", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--port", type=int, default=18723)
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = generate_updates(args.users)
+
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + "\n")
+        return
+
+    asyncio.run(replay(updates, args.workers, args.api_delay, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,24 +3,31 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 
+from commands.menu_commands import ACTIONS_MENU
+from config import ADMIN_IDS
+from middlewares.lobby_snapshot import LobbySnapshotMiddleware
+from middlewares.metrics import HandlerMetricsMiddleware
+from services.admin_service import start_profiling
 from services.lobby_service import *
 from utils.escape import escape_md
 
 router = Router()
+router.message.outer_middleware(LobbySnapshotMiddleware())
+router.message.middleware(HandlerMetricsMiddleware())
 
 @router.message(Command('start'))
-async def cmd_start(message: Message):
-    menu = await get_main_menu(message.from_user.id)
+async def cmd_start(message: Message, snapshot: LobbySnapshot):
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(escape_md(f"Привет, {message.from_user.username}. Начнем играть?"), reply_markup=menu, parse_mode="MarkdownV2")
 
 @router.message(Command("create"))
-async def handle_create(message: Message):
-    response = await create_lobby(owner_id=message.from_user.id, username=message.from_user.username)
-    menu = await get_main_menu(message.from_user.id)
+async def handle_create(message: Message, snapshot: LobbySnapshot):
+    response = await create_lobby(owner_id=message.from_user.id, username=message.from_user.username, snapshot=snapshot)
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(escape_md(response), reply_markup=menu, parse_mode="MarkdownV2")
 
 @router.message(Command("join"))
-async def handle_join(message: Message, command: Command, bot: Bot):
+async def handle_join(message: Message, command: Command, snapshot: LobbySnapshot):
     if not command.args:
         await message.answer(escape_md("Пожалуйста, укажи код лобби: /join <код>"))
         return
@@ -30,41 +37,46 @@ async def handle_join(message: Message, command: Command, bot: Bot):
         user_id=message.from_user.id,
         username=message.from_user.username or message.from_user.full_name,
         code=code,
-        bot=bot
+        snapshot=snapshot
     )
-    menu = await get_main_menu(message.from_user.id)
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(escape_md(result), reply_markup=menu, parse_mode="MarkdownV2")
 
 @router.message(Command('leave'))
-async def cmd_leave(message: Message, bot: Bot):
-    response = await leave_lobby(message.from_user.id, message.from_user.username, bot)
-    menu = await get_main_menu(message.from_user.id)
+async def cmd_leave(message: Message, snapshot: LobbySnapshot):
+    response = await leave_lobby(message.from_user.id, message.from_user.username, snapshot)
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(escape_md(response), reply_markup=menu, parse_mode="MarkdownV2")
 
 @router.message(Command('lobby'))
-async def cmd_lobby(message: Message):
-    response = await get_lobby_info(message.from_user.id)
+async def cmd_lobby(message: Message, snapshot: LobbySnapshot):
+    response = await get_lobby_info(message.from_user.id, snapshot)
     await message.answer(escape_md(response), parse_mode="MarkdownV2")
 
 @router.message(Command('me'))
-async def cmd_me(message: Message):
-    response = await get_player_info(message.from_user.id)
+async def cmd_me(message: Message, snapshot: LobbySnapshot):
+    response = await get_player_info(message.from_user.id, snapshot)
     await message.answer(escape_md(response), parse_mode="MarkdownV2")
 
 @router.message(Command('start_game'))
-async def cmd_start_game(message: Message, bot: Bot):
-    response = await start_game(message.from_user.id, bot=bot)
-    menu = await get_main_menu(message.from_user.id)
+async def cmd_start_game(message: Message, snapshot: LobbySnapshot):
+    response = await start_game(message.from_user.id, snapshot=snapshot)
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(escape_md(response), parse_mode="MarkdownV2", reply_markup=menu)
 
 @router.message(Command("menu"))
-async def show_menu(message: Message):
-    keyboard = await get_main_menu(message.from_user.id)
+async def show_menu(message: Message, snapshot: LobbySnapshot):
+    keyboard = await get_main_menu(message.from_user.id, snapshot)
     await message.answer("Меню действий:", reply_markup=keyboard, parse_mode="MarkdownV2")
 
+@router.message(Command("profile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: Message, command: Command):
+    response = await start_profiling(message.from_user.id, command.args)
+    await message.answer(response)
+
 @router.message(F.text == "Создать лобби")
-async def on_create_lobby_click(message: Message):
-    await handle_create(message)
+async def on_create_lobby_click(message: Message, snapshot: LobbySnapshot):
+    await handle_create(message, snapshot)
 
 @router.message(F.text == "Присоединиться к лобби")
 async def on_join_lobby_click(message: Message,  state: FSMContext):
@@ -72,56 +84,47 @@ async def on_join_lobby_click(message: Message,  state: FSMContext):
     await state.set_state(JoinLobbyState.waiting_for_code)
 
 @router.message(JoinLobbyState.waiting_for_code)
-async def on_lobby_code_received(message: Message, state: FSMContext, bot: Bot):
+async def on_lobby_code_received(message: Message, state: FSMContext, snapshot: LobbySnapshot):
     code = message.text.strip()
     result = await join_lobby(
         user_id=message.from_user.id,
         username=message.from_user.username or message.from_user.full_name,
         code=code,
-        bot=bot
+        snapshot=snapshot
     )
     await state.clear()
 
-    menu = await get_main_menu(message.from_user.id)
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(result, reply_markup=menu, parse_mode="MarkdownV2")
 
 @router.message(Command("bunker"))
-async def handle_bunker_click(message: Message, bot: Bot):
-    response = await get_bunker_info(message.from_user.id, bot)
-    menu = await get_main_menu(message.from_user.id)
+async def handle_bunker_click(message: Message, snapshot: LobbySnapshot):
+    response = await get_bunker_info(message.from_user.id, snapshot)
+    menu = await get_main_menu(message.from_user.id, snapshot)
     await message.answer(response, reply_markup=menu)
 
 
 @router.message(F.text == "Действия")
 async def on_actions_click(message: Message, state: FSMContext):
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Раскрыть карту")],
-            [KeyboardButton(text="Назад")],
-        ],
-        resize_keyboard=True
-    )
     await state.set_state(ActionsState.choosing_action)
-    await message.answer("Что вы хотите сделать?", reply_markup=keyboard)
+    await message.answer("Что вы хотите сделать?", reply_markup=ACTIONS_MENU)
 
 
 @router.message(ActionsState.choosing_action)
-async def on_action_chosen(message: Message, state: FSMContext):
+async def on_action_chosen(message: Message, state: FSMContext, snapshot: LobbySnapshot):
     text = message.text.strip()
 
     if text == "Назад":
-        keyboard = await get_main_menu(message.from_user.id)
+        keyboard = await get_main_menu(message.from_user.id, snapshot)
         await state.clear()
         await message.answer("Что вы хотите сделать?", reply_markup=keyboard)
         return
 
     if text == "Раскрыть карту":
-        player_card = await get_player_card(message.from_user.id)
-        characteristics = list(player_card.characteristics.keys()) + \
-                          [item.name for item in player_card.items] + \
-                          [special_card.name for special_card in player_card.special_cards]
-
-        unrevealed_characteristics = [name for name in characteristics if name not in player_card.revealed_values]
+        unrevealed_characteristics = await get_unrevealed_values(message.from_user.id, snapshot)
+        if isinstance(unrevealed_characteristics, BadResponse):
+            await message.answer(unrevealed_characteristics.message)
+            return
 
         if not unrevealed_characteristics:
             await message.answer("Все характеристики уже раскрыты!")
@@ -149,53 +152,49 @@ async def on_action_chosen(message: Message, state: FSMContext):
 
 
 @router.message(RevealCardState.choosing_characteristic)
-async def on_characteristic_chosen(message: Message, state: FSMContext, bot: Bot):
+async def on_characteristic_chosen(message: Message, state: FSMContext, snapshot: LobbySnapshot):
     text = message.text.strip()
 
     if text == "Назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Раскрыть карту")],
-                [KeyboardButton(text="Назад")],
-            ],
-            resize_keyboard=True
-        )
         await state.set_state(ActionsState.choosing_action)
-        await message.answer("Что вы хотите сделать?", reply_markup=keyboard)
+        await message.answer("Что вы хотите сделать?", reply_markup=ACTIONS_MENU)
         return
 
     characteristic_name = text
-    await reveal_player_value(message.from_user.id, characteristic_name, bot)
+    revealed = await reveal_player_value(message.from_user.id, characteristic_name, snapshot)
     await state.clear()
 
-    menu = await get_main_menu(message.from_user.id)
+    menu = await get_main_menu(message.from_user.id, snapshot)
+    if not revealed:
+        await message.answer(f"Не удалось раскрыть: {characteristic_name}. Попробуйте еще раз", reply_markup=menu)
+        return
     await message.answer(f"Вы успешно раскрыли: {characteristic_name}", reply_markup=menu, parse_mode="MarkdownV2")
 
 
 @router.message(F.text == "Начать игру")
-async def on_start_game_click(message: Message, bot: Bot):
-    await cmd_start_game(message, bot)
+async def on_start_game_click(message: Message, snapshot: LobbySnapshot):
+    await cmd_start_game(message, snapshot)
 
 @router.message(F.text == "Список игроков")
-async def on_lobby_info_click(message: Message):
-    await cmd_lobby(message)
+async def on_lobby_info_click(message: Message, snapshot: LobbySnapshot):
+    await cmd_lobby(message, snapshot)
 
 @router.message(F.text == "Игроки")
-async def on_lobby_players_click(message: Message):
-    await cmd_lobby(message)
+async def on_lobby_players_click(message: Message, snapshot: LobbySnapshot):
+    await cmd_lobby(message, snapshot)
 
 @router.message(F.text == "Выйти из лобби")
-async def on_leave_lobby_click(message: Message, bot: Bot):
-    await cmd_leave(message, bot)
+async def on_leave_lobby_click(message: Message, snapshot: LobbySnapshot):
+    await cmd_leave(message, snapshot)
 
 @router.message(F.text == "Выйти из игры")
-async def on_leave_game_click(message: Message, bot: Bot):
-    await cmd_leave(message, bot)
+async def on_leave_game_click(message: Message, snapshot: LobbySnapshot):
+    await cmd_leave(message, snapshot)
 
 @router.message(F.text == "Бункер")
-async def on_leave_lobby_click(message: Message, bot: Bot):
-    await handle_bunker_click(message, bot)
+async def on_bunker_click(message: Message, snapshot: LobbySnapshot):
+    await handle_bunker_click(message, snapshot)
 
 @router.message(F.text == "Мой персонаж")
-async def on_me_click(message: Message):
-    await cmd_me(message)
+async def on_me_click(message: Message, snapshot: LobbySnapshot):
+    await cmd_me(message, snapshot)
@@ -1,49 +1,52 @@
+from typing import Tuple
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from pydantic import ConfigDict
 
 from models.error import BadResponse, NOT_FOUND_ERROR
 from models.lobby import Lobby
-from storage.redis_repository import get_lobby_by_user
-
-
-async def get_main_menu(user_id: int) -> ReplyKeyboardMarkup | None:
-    user_lobby = await get_lobby_by_user(user_id)
-    if isinstance(user_lobby, BadResponse) and user_lobby.code == NOT_FOUND_ERROR:
-        return ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Создать лобби")],
-                [KeyboardButton(text="Присоединиться к лобби")]
-            ],
-            resize_keyboard=True
-        )
-
-    if isinstance(user_lobby, Lobby) and not user_lobby.started:
-        player = next((p for p in user_lobby.players if p.user_id == user_id), None)
-        is_creator = player.user_id == user_lobby.owner.user_id
-
-        buttons = [
-            [KeyboardButton(text="Список игроков")],
-            [KeyboardButton(text="Выйти из лобби")]
-        ]
-
-        if is_creator:
-            buttons.insert(0, [KeyboardButton(text="Начать игру")])
-
-        return ReplyKeyboardMarkup(
-            keyboard=buttons,
-            resize_keyboard=True
-        )
-
-    elif isinstance(user_lobby, Lobby) and user_lobby.started:
-        buttons = [
-            [KeyboardButton(text="Мой персонаж")],
-            [KeyboardButton(text="Бункер")],
-            [KeyboardButton(text="Игроки")],
-            [KeyboardButton(text="Действия")],
-            [KeyboardButton(text="Выйти из игры")],
-        ]
-        return ReplyKeyboardMarkup(
-            keyboard=buttons,
-            resize_keyboard=True
-        )
-
-    return None
+from storage.lobby_snapshot import LobbySnapshot, load_lobby
+
+
+class _FrozenKeyboardButton(KeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    """Клавиатура, которую нельзя изменить: ни поля, ни ряды кнопок (кортежи), ни сами кнопки."""
+    model_config = ConfigDict(frozen=True)
+    keyboard: Tuple[Tuple[_FrozenKeyboardButton, ...], ...]
+
+
+def _menu(*rows: Tuple[str, ...]) -> FrozenReplyKeyboardMarkup:
+    return FrozenReplyKeyboardMarkup(keyboard=[[_FrozenKeyboardButton(text=text) for text in row] for row in rows],
+                                     resize_keyboard=True)
+
+
+# Клавиатуры собираются один раз и общие для всех сообщений, поэтому неизменяемые:
+# изменение клавиатуры одного сообщения попало бы в сообщения всех игроков
+NOT_IN_LOBBY_MENU = _menu(("Создать лобби",), ("Присоединиться к лобби",))
+
+LOBBY_MEMBER_MENU = _menu(("Список игроков",), ("Выйти из лобби",))
+
+LOBBY_OWNER_MENU = _menu(("Начать игру",), ("Список игроков",), ("Выйти из лобби",))
+
+IN_GAME_MENU = _menu(("Мой персонаж",), ("Бункер",), ("Игроки",), ("Действия",), ("Выйти из игры",))
+
+ACTIONS_MENU = _menu(("Раскрыть карту",), ("Назад",))
+
+
+def build_main_menu(user_lobby: Lobby | BadResponse, user_id: int) -> ReplyKeyboardMarkup | None:
+    """Выбирает меню по уже загруженному лобби пользователя, не обращаясь к Redis."""
+    if isinstance(user_lobby, BadResponse):
+        return NOT_IN_LOBBY_MENU if user_lobby.code == NOT_FOUND_ERROR else None
+
+    if not user_lobby.started:
+        return LOBBY_OWNER_MENU if user_lobby.owner.user_id == user_id else LOBBY_MEMBER_MENU
+
+    return IN_GAME_MENU
+
+
+async def get_main_menu(user_id: int, snapshot: LobbySnapshot | None = None) -> ReplyKeyboardMarkup | None:
+    user_lobby = await load_lobby(user_id, snapshot)
+    return build_main_menu(user_lobby, user_id)
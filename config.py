@@ -3,9 +3,124 @@ import os
 # Токен для Telegram-бота
 API_TOKEN = os.getenv("API_TOKEN")
 
+# Способ получения апдейтов: polling (для разработки) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Параметры вебхука. WEBHOOK_URL - внешний адрес бота; если не задан, вебхук регистрируется вручную
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8723))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Количество процессов бота в режиме webhook (слушают один порт через SO_REUSEPORT)
+WEBHOOK_PROCESSES = int(os.getenv("WEBHOOK_PROCESSES", 1))
+
+# Эндпоинт метрик Prometheus /metrics (0 - выключен); процесс с номером i слушает METRICS_PORT + i
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9723))
+
+# Апдейты, обработка которых заняла дольше порога (мс), печатаются с деревом вызовов (0 - не отслеживать);
+# в дерево записываются не больше TRACE_MAX_SPANS вызовов
+TRACE_SLOW_UPDATE_MS = int(os.getenv("TRACE_SLOW_UPDATE_MS", 1000))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", 500))
+
+# Профилирование по команде /profile (только для ADMIN_IDS через запятую) или сигналу SIGUSR1:
+# результаты в PROFILE_DIR, длительность по умолчанию и максимальная длительность (с), интервал выборок (мс)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_DEFAULT_SECONDS = float(os.getenv("PROFILE_DEFAULT_SECONDS", 30))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 120))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", 5))
+
 # Параметры подключения к Redis
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# Реплика для чтения лобби (пусто - все запросы идут в основной Redis)
+REDIS_REPLICA_HOST = os.getenv("REDIS_REPLICA_HOST", "")
+REDIS_REPLICA_PORT = int(os.getenv("REDIS_REPLICA_PORT", REDIS_PORT))
+
+# Пул соединений Redis: размер и сколько ждать свободное соединение (с)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+# Таймауты ответа и подключения (с)
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 2))
+# Повторы команды, которая не дошла до Redis (нет соединения): количество и экспоненциальная задержка (мс)
+REDIS_RETRIES = int(os.getenv("REDIS_RETRIES", 3))
+REDIS_BACKOFF_BASE_MS = int(os.getenv("REDIS_BACKOFF_BASE_MS", 10))
+REDIS_BACKOFF_CAP_MS = int(os.getenv("REDIS_BACKOFF_CAP_MS", 500))
+# Соединение, простаивавшее дольше интервала (с), проверяется перед запросом (0 - не проверять)
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
 
+# Файл сценариев или каталог с файлами *.json
 CONFIG_FILE = os.getenv("CONFIG_FILE", "./utils/config.json")
+# Предкомпилированный каталог сценариев (пустое значение - не кэшировать)
+SCENARIO_CACHE_FILE = os.getenv("SCENARIO_CACHE_FILE", "./utils/.scenarios.cache") or None
+# Период проверки файлов сценариев на изменения в секундах (0 - без перезагрузки)
+SCENARIO_RELOAD_INTERVAL = float(os.getenv("SCENARIO_RELOAD_INTERVAL", 5))
+# Сколько прежних версий сценариев, нужных начатым играм, держать в памяти (остальные читаются из Redis)
+SCENARIO_PINNED_CACHE_SIZE = int(os.getenv("SCENARIO_PINNED_CACHE_SIZE", 64))
+
+# Параметры рассылки уведомлений (лимиты Telegram: ~30 сообщений/с на бота, ~1 сообщение/с в чат)
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 16))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", 3))
+# Повторы отправки при сетевых ошибках: экспоненциальная задержка со случайным разбросом (мс)
+NOTIFY_BACKOFF_BASE_MS = int(os.getenv("NOTIFY_BACKOFF_BASE_MS", 500))
+NOTIFY_BACKOFF_CAP_MS = int(os.getenv("NOTIFY_BACKOFF_CAP_MS", 30000))
+# Сообщения одному чату с паузами меньше NOTIFY_DIGEST_WINDOW_MS отправляются одной сводкой, но не позже
+# NOTIFY_DIGEST_MAX_DELAY_MS после первого из них (NOTIFY_DIGEST_WINDOW_MS=0 - каждое сообщение отдельно)
+NOTIFY_DIGEST_WINDOW_MS = int(os.getenv("NOTIFY_DIGEST_WINDOW_MS", 1000))
+NOTIFY_DIGEST_MAX_DELAY_MS = int(os.getenv("NOTIFY_DIGEST_MAX_DELAY_MS", 3000))
+# Очередь уведомлений в Redis: OUTBOX_WORKERS отправителей в каждом процессе держат в работе до OUTBOX_BATCH
+# сообщений каждый и ждут новых до OUTBOX_BLOCK_MS за запрос. Сообщение, которое отправитель не подтвердил
+# дольше OUTBOX_CLAIM_IDLE_MS (процесс упал или остановлен), забирает другой отправитель
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", 32))
+OUTBOX_BLOCK_MS = int(os.getenv("OUTBOX_BLOCK_MS", 1000))
+OUTBOX_CLAIM_IDLE_MS = int(os.getenv("OUTBOX_CLAIM_IDLE_MS", 60000))
+# Живая доска лобби: вместо сообщений о входе, выходе и раскрытии карт у каждого игрока редактируется одно
+# закрепленное сообщение с доской лобби (1 - включено). Изменения за LIVE_BOARD_DEBOUNCE_MS дают одно редактирование
+LIVE_BOARD = os.getenv("LIVE_BOARD", "0") == "1"
+LIVE_BOARD_DEBOUNCE_MS = int(os.getenv("LIVE_BOARD_DEBOUNCE_MS", 1500))
+
+# Состояния диалогов aiogram: кэш в памяти процесса на FSM_CACHE_SIZE ключей (0 - кэш выключен), запись в Redis
+# пачками раз в FSM_WRITE_BEHIND_MS (0 - сразу). Состояние без изменений дольше FSM_STATE_TTL секунд удаляется
+# (0 - не удаляется).
+# FSM_REDIS_DB - отдельная база Redis со своим пулом соединений (пусто - общий пул с лобби)
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 100_000))
+FSM_WRITE_BEHIND_MS = int(os.getenv("FSM_WRITE_BEHIND_MS", 100))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 86400))
+FSM_REDIS_DB = int(os.getenv("FSM_REDIS_DB")) if os.getenv("FSM_REDIS_DB") else None
+
+# Размер кэша лобби в памяти процесса (0 - кэш выключен)
+LOBBY_CACHE_SIZE = int(os.getenv("LOBBY_CACHE_SIZE", 1024))
+# Количество готовых текстов (доска лобби, карточки игроков) в кэше отрисовки (0 - кэш выключен)
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 4096))
+
+# Блокировка лобби на время изменения: время жизни блокировки и сколько ждать ее освобождения (мс)
+LOBBY_LOCK_TTL_MS = int(os.getenv("LOBBY_LOCK_TTL_MS", 5000))
+LOBBY_LOCK_WAIT_MS = int(os.getenv("LOBBY_LOCK_WAIT_MS", 3000))
+# Сколько раз обработчик лобби ждет блокировку, прежде чем вернуть ошибку всем действиям пачки
+LOBBY_LOCK_ATTEMPTS = int(os.getenv("LOBBY_LOCK_ATTEMPTS", 4))
+
+# Изменения одного лобби, пришедшие в течение окна (мс), сохраняются одной записью;
+# обработчик лобби без изменений дольше LOBBY_ACTOR_IDLE_SECONDS удаляется
+LOBBY_FLUSH_WINDOW_MS = int(os.getenv("LOBBY_FLUSH_WINDOW_MS", 10))
+LOBBY_ACTOR_IDLE_SECONDS = float(os.getenv("LOBBY_ACTOR_IDLE_SECONDS", 60))
+
+# Лобби без изменений дольше LOBBY_TTL_SECONDS удаляется вместе со ссылками игроков на него.
+# Сборщик проверяет лобби раз в LOBBY_SWEEP_INTERVAL секунд (0 - выключен) пачками по LOBBY_SWEEP_BATCH
+LOBBY_TTL_SECONDS = int(os.getenv("LOBBY_TTL_SECONDS", 86400))
+LOBBY_SWEEP_INTERVAL = float(os.getenv("LOBBY_SWEEP_INTERVAL", 60))
+LOBBY_SWEEP_BATCH = int(os.getenv("LOBBY_SWEEP_BATCH", 100))
+# Журнал изменений лобби: когда в нем становится больше LOBBY_EVENTS_MAX событий, в журнал записывается
+# снимок лобби, а события до снимка удаляются
+LOBBY_EVENTS_MAX = int(os.getenv("LOBBY_EVENTS_MAX", 500))
+
+# Формат хранения лобби: msgpack (компактный бинарный) или json
+LOBBY_CODEC = os.getenv("LOBBY_CODEC", "msgpack")
@@ -1,19 +1,70 @@
 import asyncio
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.redis import RedisStorage
 
 from commands import lobby_commands
-from config import API_TOKEN
+from config import API_TOKEN, BOT_MODE, WEBHOOK_PROCESSES, TRACE_SLOW_UPDATE_MS, REDIS_HOST, REDIS_PORT, \
+    FSM_CACHE_SIZE, FSM_WRITE_BEHIND_MS, FSM_STATE_TTL, FSM_REDIS_DB
+from metrics_server import start_metrics_server, stop_metrics_server, register_cache
+from middlewares.metrics import UpdateMetricsMiddleware, TelegramMetricsMiddleware
+from middlewares.tracing import TracingMiddleware
+from services.lobby_actor import stop_lobby_actors
+from services.lobby_service import live_boards
+from services.outbox import start_outbox, stop_outbox
 from storage import redis_repository
+from storage.fsm_storage import HybridStorage
+from storage.redis_connection import create_redis
+from utils import scenario_loader, profiler
+from webhook import run_webhook, run_processes
 
-dp = Dispatcher(storage=RedisStorage(redis=redis_repository.redis_client))
+if FSM_REDIS_DB is None:
+    fsm_storage = HybridStorage(redis_repository.redis_client, FSM_CACHE_SIZE, FSM_STATE_TTL, FSM_WRITE_BEHIND_MS)
+else:
+    fsm_storage = HybridStorage(create_redis(REDIS_HOST, REDIS_PORT, FSM_REDIS_DB), FSM_CACHE_SIZE, FSM_STATE_TTL,
+                                FSM_WRITE_BEHIND_MS, owns_client=True)
+register_cache("fsm", fsm_storage.cache.stats)
+dp = Dispatcher(storage=fsm_storage)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+if TRACE_SLOW_UPDATE_MS > 0:
+    dp.update.outer_middleware(TracingMiddleware(TRACE_SLOW_UPDATE_MS))
 dp.include_router(lobby_commands.router)
+dp.startup.register(fsm_storage.start)
+dp.startup.register(redis_repository.start_lobby_cache)
+dp.startup.register(scenario_loader.start_catalog_watcher)
+dp.startup.register(redis_repository.start_lobby_sweeper)
+dp.startup.register(profiler.install_profile_signal)
+dp.startup.register(start_outbox)
+dp.startup.register(live_boards.start)
+dp.shutdown.register(profiler.stop_profile)
+dp.shutdown.register(stop_lobby_actors)
+dp.shutdown.register(live_boards.stop)
+dp.shutdown.register(stop_outbox)
+dp.shutdown.register(redis_repository.stop_lobby_cache)
+dp.shutdown.register(redis_repository.stop_lobby_sweeper)
+dp.shutdown.register(redis_repository.close_redis)
+dp.shutdown.register(scenario_loader.stop_catalog_watcher)
 
 
-async def main() -> None:
+async def main(process_index: int = 0) -> None:
     bot = Bot(token=API_TOKEN)
-    await dp.start_polling(bot)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    metrics = await start_metrics_server(process_index)
+    try:
+        if BOT_MODE == "webhook":
+            # Вебхук в Telegram регистрирует только первый процесс
+            await run_webhook(dp, bot, reuse_port=WEBHOOK_PROCESSES > 1, register_webhook=process_index == 0)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await stop_metrics_server(metrics)
+
+
+def run_process(process_index: int) -> None:
+    asyncio.run(main(process_index))
+
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if BOT_MODE == "webhook" and WEBHOOK_PROCESSES > 1:
+        run_processes(WEBHOOK_PROCESSES, run_process)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,82 @@
+"""
+HTTP-эндпоинт /metrics в формате Prometheus (отдельный порт, не порт вебхука).
+
+Число лобби и игроков и состояние очереди уведомлений читаются из Redis, а счетчики кэшей процесса - из самих
+кэшей только при запросе метрик; остальные метрики собираются по ходу работы (utils/metrics.py).
+Каждый процесс бота отдает свои метрики на порту METRICS_PORT + номер процесса.
+"""
+from typing import Callable, Dict
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from config import METRICS_HOST, METRICS_PORT
+from services.outbox import outbox_stats
+from services.render_service import render_cache
+from storage.redis_repository import count_lobby_players, lobby_cache
+from utils.metrics import ACTIVE_LOBBIES, LOBBY_PLAYERS, OUTBOX_DEPTH, OUTBOX_PENDING, OUTBOX_OLDEST, CACHE_ITEMS, \
+    CACHE_MAX_ITEMS, CACHE_ENABLED, CACHE_EVENTS
+
+# Кэши, которые попадают в метрики: имя -> функция stats() кэша
+_caches: Dict[str, Callable[[], dict]] = {"lobby": lobby_cache.stats, "render": render_cache.stats}
+_CACHE_EVENTS = ("hits", "misses", "evictions", "invalidations")
+
+
+def register_cache(name: str, stats: Callable[[], dict]) -> None:
+    """Добавляет в метрики кэш, созданный вне модулей репозитория (например, кэш состояний диалогов)."""
+    _caches[name] = stats
+
+
+async def _refresh_lobby_gauges() -> None:
+    try:
+        lobbies, players = await count_lobby_players()
+    except Exception as e:
+        print(f"Не удалось получить число лобби для метрик: {e}")
+        return
+    ACTIVE_LOBBIES.set(lobbies)
+    LOBBY_PLAYERS.set(players)
+
+
+async def _refresh_outbox_gauges() -> None:
+    try:
+        stats = await outbox_stats()
+    except Exception as e:
+        print(f"Не удалось получить состояние очереди уведомлений для метрик: {e}")
+        return
+    OUTBOX_DEPTH.set(stats.length)
+    OUTBOX_PENDING.set(stats.pending)
+    OUTBOX_OLDEST.set(stats.oldest_seconds)
+
+
+def _refresh_cache_gauges() -> None:
+    for name, stats in _caches.items():
+        values = stats()
+        CACHE_ITEMS.labels(name).set(values["size"])
+        CACHE_MAX_ITEMS.labels(name).set(values["max_size"])
+        CACHE_ENABLED.labels(name).set(int(values["enabled"]))
+        for event in _CACHE_EVENTS:
+            if event in values:
+                CACHE_EVENTS.labels(name, event).set(values[event])
+
+
+async def _metrics(_: web.Request) -> web.Response:
+    await _refresh_lobby_gauges()
+    await _refresh_outbox_gauges()
+    _refresh_cache_gauges()
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(process_index: int = 0) -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT + process_index).start()
+    return runner
+
+
+async def stop_metrics_server(runner: web.AppRunner | None) -> None:
+    if runner is not None:
+        await runner.cleanup()
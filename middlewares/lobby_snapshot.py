@@ -0,0 +1,19 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from storage.lobby_snapshot import LobbySnapshot
+
+
+class LobbySnapshotMiddleware(BaseMiddleware):
+    """Передает обработчикам аргумент snapshot - лобби пользователя, общее на весь апдейт."""
+
+    async def __call__(self,
+                       handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is not None:
+            data["snapshot"] = LobbySnapshot(user.id)
+        return await handler(event, data)
@@ -0,0 +1,88 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, Response
+from aiogram.types import TelegramObject
+
+from utils.metrics import HANDLER_LATENCY, HANDLER_ERRORS, UPDATES_IN_FLIGHT, TELEGRAM_LATENCY, \
+    TELEGRAM_RATE_LIMITED, TELEGRAM_ERRORS
+from utils.tracing import start_span, end_span
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Считает апдейты, которые сейчас обрабатываются (внешний middleware диспетчера)."""
+
+    async def __call__(self,
+                       handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время выбранного обработчика; метка и узел дерева вызовов - имя функции обработчика."""
+
+    def __init__(self):
+        self._metrics: Dict[Callable, tuple] = {}
+
+    async def __call__(self,
+                       handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        handler_object: HandlerObject | None = data.get("handler")
+        if handler_object is None:
+            return await handler(event, data)
+
+        metrics = self._metrics.get(handler_object.callback)
+        if metrics is None:
+            name = handler_object.callback.__name__
+            metrics = self._metrics[handler_object.callback] = (name,
+                                                                HANDLER_LATENCY.labels(name),
+                                                                HANDLER_ERRORS.labels(name))
+        name, latency, errors = metrics
+        span = start_span(name)
+        started = time.perf_counter()
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            errors.inc()
+            error = e
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+            end_span(span, error)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет запросы бота к Bot API, считает ответы 429 и добавляет запросы в дерево вызовов апдейта."""
+
+    async def __call__(self,
+                       make_request: NextRequestMiddlewareType,
+                       bot: Bot,
+                       method: TelegramMethod) -> Response:
+        name = method.__api_method__
+        span = start_span("telegram " + name)
+        started = time.perf_counter()
+        error = None
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            TELEGRAM_RATE_LIMITED.labels(name).inc()
+            error = e
+            raise
+        except Exception as e:
+            TELEGRAM_ERRORS.labels(name).inc()
+            error = e
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(name).observe(time.perf_counter() - started)
+            end_span(span, error)
@@ -0,0 +1,31 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from utils.tracing import start_trace, end_span, format_trace
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Строит дерево вызовов апдейта и печатает его, если обработка заняла дольше threshold_ms."""
+
+    def __init__(self, threshold_ms: int):
+        self.threshold = threshold_ms / 1000
+
+    async def __call__(self,
+                       handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: Update,
+                       data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        started = start_trace(f"апдейт {event.update_id} ({event.event_type}, пользователь {user.id if user else '-'})")
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            end_span(started, error)
+            root = started[0]
+            if root.duration >= self.threshold:
+                print(f"Медленный апдейт:\n{format_trace(root)}")
@@ -3,6 +3,8 @@ from dataclasses import dataclass
 NOT_FOUND_ERROR = 1
 BAD_REQUEST = 2
 INTERNAL_ERROR = 3
+ALREADY_EXISTS = 4
+CONFLICT = 5
 
 @dataclass
 class BadResponse:
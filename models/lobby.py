@@ -2,10 +2,9 @@ from typing import List
 from dataclasses import dataclass, field
 
 from models.player_card import PlayerCard
-from models.scenario import BunkerFeature
 
 
-@dataclass
+@dataclass(slots=True)
 class Player:
     user_id: int
     username: str
@@ -22,34 +21,48 @@ class Player:
                       username=data["username"],
                       cards=PlayerCard.from_dict(data["cards"]) if data["cards"] else None)
 
-@dataclass
+@dataclass(slots=True)
 class Bunker:
+    """
+    Ссылка на сценарий лобби. Пустая версия - лобби, созданное до закрепления версий сценариев.
+    deal_seed - зерно раздачи карт (services/dealer.py), None - карты розданы до записи зерна.
+    """
     scenario_id: str
-    scenario_name: str
-    scenario_description: str
-    features: List[BunkerFeature] = field(default_factory=list)
+    scenario_version: str = ""
+    deal_seed: int | None = None
 
     def to_dict(self):
         return {"scenario_id": self.scenario_id,
-                "scenario_name": self.scenario_name,
-                "scenario_description": self.scenario_description,
-                "features": [f.to_dict() for f in self.features]}
+                "scenario_version": self.scenario_version,
+                "deal_seed": self.deal_seed}
 
     @staticmethod
     def from_dict(data):
         return Bunker(scenario_id=data["scenario_id"],
-                      scenario_name=data["scenario_name"],
-                      scenario_description=data["scenario_description"],
-                      features=[BunkerFeature.from_dict(f) for f in data["features"]])
+                      scenario_version=data.get("scenario_version", ""),
+                      deal_seed=data.get("deal_seed"))
 
-@dataclass
+@dataclass(slots=True)
 class Lobby:
     code: str
     owner: Player
     bunker: Bunker | None
     players: List[Player] = field(default_factory=list)
     started: bool = False
+    # Номер изменения лобби в Redis; 0 - неизвестен (например, после неудачной записи)
+    version: int = field(default=0, compare=False)
 
+    def copy(self) -> "Lobby":
+        """Независимая копия лобби: изменения копии не видны в исходном объекте."""
+        players = [Player.from_dict(p.to_dict()) for p in self.players]
+        owner = next((p for p in players if p.user_id == self.owner.user_id), None) \
+            or Player.from_dict(self.owner.to_dict())
+        return Lobby(code=self.code,
+                     owner=owner,
+                     bunker=Bunker.from_dict(self.bunker.to_dict()) if self.bunker else None,
+                     players=players,
+                     started=self.started,
+                     version=self.version)
 
     def to_dict(self):
         return {
@@ -1,25 +1,58 @@
 from dataclasses import dataclass, field
 from typing import Dict, List
 
-from models.scenario import Item, SpecialCard
+from models.scenario import Item, SpecialCard, Scenario
 
 
-@dataclass
+@dataclass(slots=True)
 class PlayerCard:
-    characteristics: Dict[str, str]
-    items: List[Item] = field(default_factory=list)
-    special_cards: List[SpecialCard] = field(default_factory=list)
+    """
+    Карты игрока хранятся ссылками на сценарий лобби: индекс значения характеристики,
+    индексы предметов и спец. карт. Строка вместо индекса - значение из лобби,
+    созданного до перехода на ссылки (само значение или название карты).
+    """
+    characteristics: Dict[str, int | str]
+    items: List[int | str] = field(default_factory=list)
+    special_cards: List[int | str] = field(default_factory=list)
     revealed_values: List[str] = field(default_factory=list)
 
     def to_dict(self):
         return {"characteristics": self.characteristics,
-                "items":[i.to_dict() for i in self.items],
-                "special_cards": [c.to_dict() for c in self.special_cards],
+                "items": self.items,
+                "special_cards": self.special_cards,
                 "revealed_values": self.revealed_values}
 
     @staticmethod
     def from_dict(data):
         return PlayerCard(characteristics=data["characteristics"],
-                          items=[Item.from_dict(i) for i in data["items"]],
-                          special_cards=[SpecialCard.from_dict(c) for c in data["special_cards"]],
+                          items=[_legacy_name(i) for i in data["items"]],
+                          special_cards=[_legacy_name(c) for c in data["special_cards"]],
                           revealed_values=data["revealed_values"])
+
+    def resolve_characteristics(self, scenario: Scenario) -> Dict[str, str]:
+        """Значения характеристик; ссылки, которых нет в этой версии сценария, пропускаются."""
+        resolved = {}
+        for name, value in self.characteristics.items():
+            if isinstance(value, int):
+                value = _at(scenario.characteristics.get(name, []), value)
+            if value is not None:
+                resolved[name] = value
+        return resolved
+
+    def resolve_items(self, scenario: Scenario) -> List[Item]:
+        return [item for item in (_at(scenario.items, i) if isinstance(i, int) else scenario.find_item(i)
+                                  for i in self.items) if item]
+
+    def resolve_special_cards(self, scenario: Scenario) -> List[SpecialCard]:
+        return [card for card in (_at(scenario.special_cards, i) if isinstance(i, int)
+                                  else scenario.find_special_card(i)
+                                  for i in self.special_cards) if card]
+
+def _at(values: list, index: int):
+    # Индекс из другой версии сценария может не существовать в этой
+    return values[index] if 0 <= index < len(values) else None
+
+
+def _legacy_name(value):
+    # В старых лобби карта хранилась целиком
+    return value["name"] if isinstance(value, dict) else value
@@ -1,7 +1,7 @@
 from typing import List, Tuple, Dict
 from dataclasses import dataclass, field
 
-@dataclass
+@dataclass(slots=True)
 class WinCondition:
     type: str
     value: int
@@ -13,7 +13,7 @@ class WinCondition:
     def from_dict(data):
         return WinCondition(type=data["type"], value=data["value"])
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     type: str
     dice_range: Tuple[int, int] = None
@@ -25,7 +25,7 @@ class Action:
     def from_dict(data):
         return Action(type=data["type"], dice_range=data["dice_range"])
 
-@dataclass
+@dataclass(slots=True)
 class Item:
     name: str
     description: str
@@ -38,7 +38,7 @@ class Item:
     def from_dict(data):
         return Item(name=data["name"], description=data["description"], actions=[Action.from_dict(a) for a in data["actions"]])
 
-@dataclass
+@dataclass(slots=True)
 class BunkerFeature:
     name: str
     description: str
@@ -53,7 +53,7 @@ class BunkerFeature:
                       description=data["description"])
 
 
-@dataclass
+@dataclass(slots=True)
 class SpecialCardAction:
     type: str
 
@@ -64,7 +64,7 @@ class SpecialCardAction:
     def from_dict(data):
         return SpecialCardAction(type=data["type"])
 
-@dataclass
+@dataclass(slots=True)
 class SpecialCard:
     name: str
     description: str
@@ -77,7 +77,7 @@ class SpecialCard:
     def from_dict(data):
         return SpecialCard(name=data["name"], description=data["description"], actions=[SpecialCardAction.from_dict(a) for a in data["actions"]])
 
-@dataclass
+@dataclass(slots=True)
 class BaseAction:
     id: str
     name: str
@@ -90,7 +90,7 @@ class BaseAction:
     def from_dict(data):
         return BaseAction(id=data["id"], name=data["name"], description=data["description"])
 
-@dataclass
+@dataclass(slots=True)
 class Scenario:
     id: str
     name: str
@@ -100,4 +100,54 @@ class Scenario:
     items: List[Item] = field(default_factory=list)
     bunker_features: List[BunkerFeature] = field(default_factory=list)
     special_cards: List[SpecialCard] = field(default_factory=list)
-    base_actions: List[BaseAction] = field(default_factory=list)
\ No newline at end of file
+    base_actions: List[BaseAction] = field(default_factory=list)
+    # Колоды, карты которых могут повторяться у игроков одного лобби: названия характеристик, "items", "special_cards"
+    repeatable_cards: List[str] = field(default_factory=list)
+    # Хэш содержимого: лобби закрепляет версию сценария, с которой началась игра
+    version: str = ""
+    # Индексы по названию строятся один раз и сохраняются вместе с предкомпилированным каталогом
+    item_index: Dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+    special_card_index: Dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+    # Строки сценария, заранее экранированные для MarkdownV2 (заполняется при загрузке каталога)
+    escaped_text: Dict[str, str] = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.item_index = {item.name: i for i, item in enumerate(self.items)}
+        self.special_card_index = {card.name: i for i, card in enumerate(self.special_cards)}
+
+    def to_dict(self):
+        data = {"id": self.id,
+                "name": self.name,
+                "description": self.description,
+                "win_condition": self.win_condition.to_dict(),
+                "characteristics": self.characteristics,
+                "items": [i.to_dict() for i in self.items],
+                "bunker_features": [bf.to_dict() for bf in self.bunker_features],
+                "special_cards": [sc.to_dict() for sc in self.special_cards],
+                "base_actions": [a.to_dict() for a in self.base_actions]}
+        # Необязательное поле не меняет версию сценариев, в которых оно не задано
+        if self.repeatable_cards:
+            data["repeatable_cards"] = self.repeatable_cards
+        return data
+
+    @staticmethod
+    def from_dict(data, version: str = ""):
+        return Scenario(id=data["id"],
+                        name=data["name"],
+                        description=data["description"],
+                        win_condition=WinCondition.from_dict(data["win_condition"]),
+                        characteristics=data["characteristics"],
+                        items=[Item.from_dict(i) for i in data.get("items", [])],
+                        bunker_features=[BunkerFeature.from_dict(bf) for bf in data.get("bunker_features", [])],
+                        special_cards=[SpecialCard.from_dict(sc) for sc in data.get("special_cards", [])],
+                        base_actions=[BaseAction.from_dict(a) for a in data.get("base_actions", [])],
+                        repeatable_cards=data.get("repeatable_cards", []),
+                        version=version)
+
+    def find_item(self, name: str) -> Item | None:
+        index = self.item_index.get(name)
+        return self.items[index] if index is not None else None
+
+    def find_special_card(self, name: str) -> SpecialCard | None:
+        index = self.special_card_index.get(name)
+        return self.special_cards[index] if index is not None else None
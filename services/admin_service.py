@@ -0,0 +1,37 @@
+import asyncio
+from typing import Set
+
+from config import PROFILE_DEFAULT_SECONDS
+from services.outbox import OutgoingMessage, enqueue
+from utils import profiler
+
+# Задачи, которые ждут окончания профилирования и отправляют результат администратору
+_reports: Set[asyncio.Task] = set()
+
+
+async def start_profiling(user_id: int, args: str | None) -> str:
+    """Запускает профилирование процесса; пути к результатам придут отдельным сообщением."""
+    try:
+        seconds = float(args) if args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        return "Укажи длительность в секундах: /profile 30"
+
+    task = profiler.start_profile(seconds)
+    if task is None:
+        return "Профилирование уже идет"
+
+    report = asyncio.create_task(_report_profile(task, user_id))
+    _reports.add(report)
+    report.add_done_callback(_reports.discard)
+    return f"Профилирование запущено на {profiler.profile_seconds(seconds):.0f} с"
+
+
+async def _report_profile(task: asyncio.Task, user_id: int) -> None:
+    try:
+        paths = await task
+    except asyncio.CancelledError:
+        return
+    except Exception as e:
+        await enqueue([OutgoingMessage(user_id, f"Ошибка профилирования: {e}")])
+        return
+    await enqueue([OutgoingMessage(user_id, "Профиль сохранен:\n" + "\n".join(paths))])
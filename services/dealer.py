@@ -0,0 +1,121 @@
+"""
+Раздача карт игрокам лобби.
+
+Колоды сценария (значения каждой характеристики, предметы, спец. карты) описываются один раз на версию
+сценария, вместе с числом случайных чисел, которое нужно на одного игрока. Раздача идет по колодам, а не
+по игрокам: из каждой колоды сразу берутся карты для всего лобби. Карты колоды не повторяются, пока она
+не кончится (колода меньше лобби тасуется заново), кроме колод из repeatable_cards сценария.
+
+Раздача полностью определяется версией сценария, зерном (сохраняется в Bunker.deal_seed) и числом игроков:
+deal(scenario, seed, n) повторяет карты игроков в том порядке, в котором они были в лобби при начале игры.
+Случайные числа берутся из SHAKE-128 от зерна, а не из random, поэтому раздача не зависит от версии Python.
+"""
+import hashlib
+import secrets
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from models.lobby import Bunker, Lobby
+from models.player_card import PlayerCard
+from models.scenario import Scenario
+
+ITEMS_DECK = "items"
+SPECIAL_CARDS_DECK = "special_cards"
+ITEMS_PER_PLAYER = 1
+SPECIAL_CARDS_PER_PLAYER = 1
+DECK_CACHE_SIZE = 64
+
+
+@dataclass(slots=True, frozen=True)
+class Deck:
+    name: str
+    size: int
+    per_player: int
+    repeatable: bool
+
+
+@dataclass(slots=True, frozen=True)
+class ScenarioDecks:
+    # Колоды характеристик в порядке сценария, затем предметы и спец. карты
+    decks: List[Deck]
+    characteristics: Tuple[str, ...]
+    # Случайных чисел на одного игрока: по одному на каждую карту, которую он получает
+    draws_per_player: int
+
+
+_decks: OrderedDict[Tuple[str, str], ScenarioDecks] = OrderedDict()
+
+
+def scenario_decks(scenario: Scenario) -> ScenarioDecks:
+    key = (scenario.id, scenario.version)
+    decks = _decks.get(key)
+    if decks is None:
+        repeatable = set(scenario.repeatable_cards)
+        deck_list = [Deck(name, len(values), 1, name in repeatable) for name, values in scenario.characteristics.items()]
+        deck_list.append(Deck(ITEMS_DECK, len(scenario.items), ITEMS_PER_PLAYER, ITEMS_DECK in repeatable))
+        deck_list.append(Deck(SPECIAL_CARDS_DECK, len(scenario.special_cards), SPECIAL_CARDS_PER_PLAYER,
+                              SPECIAL_CARDS_DECK in repeatable))
+        decks = _decks[key] = ScenarioDecks(deck_list, tuple(scenario.characteristics),
+                                            sum(deck.per_player for deck in deck_list))
+        if len(_decks) > DECK_CACHE_SIZE:
+            _decks.popitem(last=False)
+    return decks
+
+
+def new_seed() -> int:
+    # 63 бита помещаются в целые msgpack и JSON без потерь
+    return secrets.randbits(63)
+
+
+def _random_numbers(seed: int, count: int) -> List[int]:
+    # Все случайные числа раздачи одним вызовом: поток SHAKE-128 от зерна режется на 64-битные числа
+    # (порядок байт платформы; на little-endian платформах результат одинаков везде)
+    return memoryview(hashlib.shake_128(seed.to_bytes(8, "little")).digest(8 * count)).cast("Q").tolist()
+
+
+def _draw(deck: Deck, numbers: List[int]) -> List[int]:
+    """Карты колоды по одной на каждое случайное число; смещение остатка от деления на 64-битное число ничтожно."""
+    size = deck.size
+    if deck.repeatable:
+        return [number % size for number in numbers]
+    # Перестановка Фишера-Йетса только на вытянутые карты: переставленные позиции хранятся в словаре,
+    # а не в копии всей колоды. Если колоды не хватает на всех, следующие игроки тянут из новой колоды
+    drawn = []
+    swaps = {}
+    for i, number in enumerate(numbers):
+        position = i % size
+        if position == 0:
+            swaps = {}
+        other = position + number % (size - position)
+        drawn.append(swaps.get(other, other))
+        swaps[other] = swaps.get(position, position)
+    return drawn
+
+
+def deal(scenario: Scenario, seed: int, players: int) -> List[PlayerCard]:
+    """Карты players игроков для раздачи с зерном seed."""
+    decks = scenario_decks(scenario)
+    numbers = _random_numbers(seed, players * decks.draws_per_player)
+    columns = []
+    offset = 0
+    for deck in decks.decks:
+        count = players * deck.per_player
+        columns.append(_draw(deck, numbers[offset:offset + count]))
+        offset += count
+    *characteristics, items, special_cards = columns
+    names = decks.characteristics
+    return [PlayerCard(characteristics=dict(zip(names, values)),
+                       items=items[i * ITEMS_PER_PLAYER:(i + 1) * ITEMS_PER_PLAYER],
+                       special_cards=special_cards[i * SPECIAL_CARDS_PER_PLAYER:(i + 1) * SPECIAL_CARDS_PER_PLAYER])
+            for i, values in enumerate(zip(*characteristics))]
+
+
+def deal_lobby(lobby: Lobby, scenario: Scenario, seed: int | None = None) -> int:
+    """Раздает карты всем игрокам лобби и закрепляет за ним сценарий и зерно раздачи; возвращает зерно."""
+    if seed is None:
+        seed = new_seed()
+    lobby.bunker = Bunker(scenario_id=scenario.id, scenario_version=scenario.version, deal_seed=seed)
+    for player, cards in zip(lobby.players, deal(scenario, seed, len(lobby.players))):
+        player.cards = cards
+    return seed
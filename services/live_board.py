@@ -0,0 +1,123 @@
+"""
+Живая доска лобби: у каждого игрока одно закрепленное сообщение с доской лобби (как /lobby),
+которое редактируется при изменениях лобби вместо нового сообщения на каждое событие.
+
+Обновление доски чата откладывается на debounce и рисует лобби таким, каким оно стало к этому
+моменту, поэтому серия изменений (несколько раскрытий подряд) дает одно редактирование.
+Id сообщения доски хранится в Redis (board:<id>), и доску продолжает редактировать любой процесс,
+в том числе после перезапуска. Если сообщение удалено, отправляется и закрепляется новое;
+после выхода из лобби доска открепляется.
+"""
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Iterable, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from models.error import BadResponse, NOT_FOUND_ERROR
+from services.notification_service import notifier
+from storage.redis_repository import get_board_message, set_board_message, delete_board_message
+
+# Код лобби пользователя и текст доски (MarkdownV2) по id пользователя
+BoardRenderer = Callable[[int], Awaitable[Tuple[str, str] | BadResponse]]
+
+
+class LiveBoards:
+    """Обновления досок игроков; одновременно выполняется не больше concurrency обновлений."""
+
+    def __init__(self, render: BoardRenderer, debounce: float, concurrency: int):
+        self.render = render
+        self.debounce = debounce
+        # Обновления досок не должны занимать пул соединений Redis, нужный обработчикам
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.bot: Bot | None = None
+        # Чаты, обновление доски которых уже запланировано, и задачи обновлений
+        self._scheduled: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._flush = asyncio.Event()
+
+    async def start(self, bot: Bot) -> None:
+        self.bot = bot
+        self._flush = asyncio.Event()
+
+    async def stop(self) -> None:
+        """Сразу выполняет отложенные обновления и перестает принимать новые."""
+        self._flush.set()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.bot = None
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def schedule(self, user_ids: Iterable[int]) -> None:
+        """Планирует обновление досок игроков; уже запланированное обновление чата покрывает и это изменение."""
+        if self.bot is None:
+            return
+        for user_id in user_ids:
+            if user_id in self._scheduled:
+                continue
+            self._scheduled.add(user_id)
+            # Обновление живет дольше апдейта и не должно наследовать его контекст (дерево вызовов)
+            task = asyncio.create_task(self._update_later(self.bot, user_id), context=contextvars.Context())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _update_later(self, bot: Bot, user_id: int) -> None:
+        try:
+            await asyncio.wait_for(self._flush.wait(), self.debounce)
+        except asyncio.TimeoutError:
+            pass
+        # Изменения после этого момента запланируют следующее обновление
+        self._scheduled.discard(user_id)
+        try:
+            async with self._semaphore:
+                await self._update(bot, user_id)
+        except TelegramRetryAfter:
+            # Чат уже заблокирован в notifier до конца паузы, повтор дождется ее
+            self.schedule([user_id])
+        except Exception as e:
+            print(f"Не удалось обновить доску лобби игрока {user_id}: {e}")
+
+    async def _update(self, bot: Bot, user_id: int) -> None:
+        board = await self.render(user_id)
+        stored = await get_board_message(user_id)
+        if isinstance(stored, BadResponse):
+            print(f"Не удалось получить доску лобби игрока {user_id}: {stored.message}")
+            return
+        if isinstance(board, BadResponse):
+            if board.code != NOT_FOUND_ERROR:
+                print(f"Не удалось получить лобби игрока {user_id}: {board.message}")
+            elif stored is not None:
+                # Игрок вышел из лобби
+                await self._unpin(bot, user_id, stored[1])
+                await delete_board_message(user_id)
+            return
+
+        code, text = board
+        if stored is not None and stored[0] == code:
+            try:
+                await notifier.limited(user_id, lambda: bot.edit_message_text(
+                    text, chat_id=user_id, message_id=stored[1], parse_mode="MarkdownV2"))
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" in e.message:
+                    return
+                # Сообщение удалено или его нельзя редактировать - отправим новое
+        elif stored is not None:
+            # Доска предыдущего лобби
+            await self._unpin(bot, user_id, stored[1])
+
+        message = await notifier.deliver(bot, user_id, text, parse_mode="MarkdownV2")
+        await notifier.limited(user_id, lambda: bot.pin_chat_message(
+            user_id, message.message_id, disable_notification=True))
+        await set_board_message(user_id, code, message.message_id)
+
+    @staticmethod
+    async def _unpin(bot: Bot, user_id: int, message_id: int) -> None:
+        try:
+            await notifier.limited(user_id, lambda: bot.unpin_chat_message(user_id, message_id=message_id))
+        except TelegramBadRequest:
+            # Сообщение уже удалено или откреплено
+            pass
@@ -0,0 +1,174 @@
+import asyncio
+import contextvars
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from config import LOBBY_FLUSH_WINDOW_MS, LOBBY_ACTOR_IDLE_SECONDS, LOBBY_LOCK_ATTEMPTS
+from models.error import BadResponse, INTERNAL_ERROR, CONFLICT
+from models.lobby import Lobby
+from storage.redis_repository import acquire_lobby_lock, release_lobby_lock, get_lobby_by_code, save_lobby_changes, \
+    UPDATE_EVENT
+from utils.tracing import traced
+
+
+@dataclass(slots=True)
+class LobbyChanges:
+    """
+    Что изменило действие: записи каких игроков и общие поля лобби (статус игры и бункер) нужно сохранить,
+    и названия изменений для журнала лобби (start, reveal, ...). Владельца и состав лобби меняют только
+    вход и выход, а записи вышедших игроков Redis не сохранит.
+    """
+    players: Set[int] = field(default_factory=set)
+    meta: bool = False
+    events: List[str] = field(default_factory=list)
+
+
+# Действие над лобби: изменяет объект лобби, отмечает изменения и возвращает результат для вызывающего.
+# Выполняется синхронно, поэтому действия одного лобби никогда не перемешиваются.
+LobbyMutation = Callable[[Lobby, LobbyChanges], Any]
+
+
+class LobbyActor:
+    """
+    Очередь изменений одного лобби в процессе.
+
+    Действия, накопившиеся за flush_window, применяются по порядку к одной свежей копии лобби
+    под блокировкой лобби и сохраняются одной записью в Redis.
+    """
+
+    def __init__(self, code: str, flush_window: float, idle_timeout: float):
+        self.code = code
+        self.flush_window = flush_window
+        self.idle_timeout = idle_timeout
+        # None в очереди - сигнал остановки после сохранения предыдущих действий
+        self.queue: asyncio.Queue[Tuple[LobbyMutation, asyncio.Future] | None] = asyncio.Queue()
+        # Обработчик живет дольше апдейта, который его создал, и не должен наследовать его контекст (дерево вызовов)
+        self.task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                first = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # Между проверкой и удалением нет await, поэтому новое действие не может потеряться
+                if self.queue.empty():
+                    if _actors.get(self.code) is self:
+                        del _actors[self.code]
+                    return
+                continue
+            if first is None:
+                return
+
+            if self.flush_window > 0:
+                await asyncio.sleep(self.flush_window)
+            batch = [first]
+            stopping = False
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                print(f"Ошибка при сохранении лобби {self.code}: {e}")
+                _resolve_all(batch, BadResponse(str(e), INTERNAL_ERROR))
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Tuple[LobbyMutation, asyncio.Future]]) -> None:
+        stats.batches += 1
+        stats.mutations += len(batch)
+
+        lock = await acquire_lobby_lock(self.code)
+        # Блокировку держит другой процесс: действия уже ждут в очереди, поэтому ждем дальше, а не отказываем
+        for _ in range(LOBBY_LOCK_ATTEMPTS - 1):
+            if not isinstance(lock, BadResponse) or lock.code != CONFLICT:
+                break
+            stats.lock_retries += 1
+            lock = await acquire_lobby_lock(self.code)
+        if isinstance(lock, BadResponse):
+            _resolve_all(batch, lock)
+            return
+
+        try:
+            lobby = await get_lobby_by_code(self.code, fresh=True)
+            if isinstance(lobby, BadResponse):
+                _resolve_all(batch, lobby)
+                return
+
+            changes = LobbyChanges()
+            results = []
+            for mutation, _ in batch:
+                # Действие меняет копию: если оно упадет на середине, его изменения не попадут в пачку
+                candidate = lobby.copy()
+                candidate_changes = LobbyChanges(set(changes.players), changes.meta, list(changes.events))
+                try:
+                    results.append(mutation(candidate, candidate_changes))
+                except Exception as e:
+                    print(f"Ошибка при изменении лобби {self.code}: {e}")
+                    results.append(BadResponse(str(e), INTERNAL_ERROR))
+                    continue
+                lobby, changes = candidate, candidate_changes
+
+            if changes.players or changes.meta:
+                stats.writes += 1
+                saved = await save_lobby_changes(lobby, changes.players, changes.meta, lock,
+                                                 ",".join(changes.events) or UPDATE_EVENT)
+                if isinstance(saved, BadResponse):
+                    _resolve_all(batch, saved)
+                    return
+                # Вход и выход идут мимо блокировки: вызывающим отдается лобби, как его сохранил Redis
+                lobby = saved
+        finally:
+            await release_lobby_lock(lock)
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result((result, lobby))
+
+
+def _resolve_all(batch: List[Tuple[LobbyMutation, asyncio.Future]], response: BadResponse) -> None:
+    for _, future in batch:
+        if not future.done():
+            future.set_result(response)
+
+
+@dataclass(slots=True)
+class ActorStats:
+    batches: int = 0
+    mutations: int = 0
+    writes: int = 0
+    lock_retries: int = 0
+
+    def to_dict(self):
+        return {"actors": len(_actors), "batches": self.batches, "mutations": self.mutations, "writes": self.writes,
+                "lock_retries": self.lock_retries}
+
+
+stats = ActorStats()
+_actors: Dict[str, LobbyActor] = {}
+
+
+@traced()
+async def run_in_lobby(code: str, mutation: LobbyMutation) -> Tuple[Any, Lobby] | BadResponse:
+    """
+    Выполняет действие в очереди лобби. Возвращает результат действия и лобби после сохранения
+    всей пачки изменений либо BadResponse, если лобби не удалось прочитать или сохранить.
+    """
+    actor = _actors.get(code)
+    if actor is None:
+        actor = _actors[code] = LobbyActor(code, LOBBY_FLUSH_WINDOW_MS / 1000, LOBBY_ACTOR_IDLE_SECONDS)
+    future = asyncio.get_running_loop().create_future()
+    actor.queue.put_nowait((mutation, future))
+    return await future
+
+
+async def stop_lobby_actors() -> None:
+    """Дожидается сохранения уже принятых изменений и останавливает обработчики лобби."""
+    actors = list(_actors.values())
+    _actors.clear()
+    for actor in actors:
+        actor.queue.put_nowait(None)
+    await asyncio.gather(*(actor.task for actor in actors), return_exceptions=True)
@@ -1,18 +1,23 @@
 import random
 import secrets
-from typing import Dict, List
+from typing import List, Tuple
 
-from aiogram import Bot
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.utils.markdown import bold
 
-from commands.menu_commands import get_main_menu
-from models.lobby import Bunker
+from commands.menu_commands import get_main_menu, build_main_menu
+from config import LIVE_BOARD, LIVE_BOARD_DEBOUNCE_MS, NOTIFY_CONCURRENCY
 from models.player_card import PlayerCard
-from models.scenario import Item, SpecialCard, BunkerFeature, Scenario
+from models.scenario import Scenario
+from services.dealer import deal_lobby
+from services.live_board import LiveBoards
+from services.lobby_actor import LobbyChanges, run_in_lobby
+from services.outbox import OutgoingMessage, enqueue
+from services.render_service import render_lobby_board, render_player_card, render_bunker
+from storage.lobby_snapshot import LobbySnapshot, load_lobby
 from storage.redis_repository import *
 from utils.escape import escape_md
-from utils.scenario_loader import SCENARIOS
+from utils.scenario_loader import get_catalog, get_scenario
+from utils.tracing import traced
 
 
 class JoinLobbyState(StatesGroup):
@@ -24,219 +29,190 @@ class RevealCardState(StatesGroup):
 class ActionsState(StatesGroup):
     choosing_action = State()
 
+CREATE_LOBBY_ATTEMPTS = 3
+
 def generate_lobby_code() -> str:
     return secrets.token_hex(3)
 
 
-async def create_lobby(owner_id: int, username: str) -> str:
-    lobby = Lobby(code=generate_lobby_code(),
-                  owner=Player(user_id=owner_id,
-                               username=username,
-                               cards=None),
-                  players=[Player(user_id=owner_id,
-                                  username=username,
-                                  cards=None)],
-                  bunker=None)
-    response = await create_lobby_and_add_user(owner_id, lobby)
+@traced()
+async def create_lobby(owner_id: int, username: str, snapshot: LobbySnapshot | None = None) -> str:
+    response = None
+    for _ in range(CREATE_LOBBY_ATTEMPTS):
+        lobby = Lobby(code=generate_lobby_code(),
+                      owner=Player(user_id=owner_id,
+                                   username=username,
+                                   cards=None),
+                      players=[Player(user_id=owner_id,
+                                      username=username,
+                                      cards=None)],
+                      bunker=None)
+        response = await create_lobby_and_add_user(owner_id, lobby)
+        # Код лобби уже занят - пробуем сгенерировать другой
+        if not (isinstance(response, BadResponse) and response.code == ALREADY_EXISTS):
+            break
+
     if isinstance(response, Lobby):
+        if snapshot is not None:
+            snapshot.set(response)
+        if LIVE_BOARD:
+            live_boards.schedule([owner_id])
         return f"Лобби создано!\nКод: ||{response.code}||\nПоделись этим кодом с друзьями"
     else:
         return response.message
 
 
-async def join_lobby(user_id: int, username: str, code: str, bot: Bot) -> str:
+@traced()
+async def join_lobby(user_id: int, username: str, code: str, snapshot: LobbySnapshot | None = None) -> str:
     response = await add_user_to_lobby(user_id, username, code)
     if isinstance(response, Lobby):
-        for player in response.players:
-            if player.user_id != user_id:
-                await send_notification(player.user_id, bot, f"{username} присоединился к лобби")
+        if snapshot is not None:
+            snapshot.set(response)
+        await publish_lobby_change(response, f"{username} присоединился к лобби", user_id)
         return f"Вы присоединились к лобби {response.code}"
     return response.message
 
 
-async def leave_lobby(user_id: int, username: str, bot: Bot) -> str:
+@traced()
+async def leave_lobby(user_id: int, username: str, snapshot: LobbySnapshot | None = None) -> str:
     user_lobby = await get_user_lobby_code(user_id)
     if isinstance(user_lobby, BadResponse):
         return user_lobby.message
 
     response = await remove_user_from_lobby(user_id, user_lobby)
     if isinstance(response, Lobby):
-        for player in response.players:
-            if player.user_id != user_id:
-                await send_notification(player.user_id, bot, f"{username} вышел из лобби")
+        if snapshot is not None:
+            snapshot.set(BadResponse("Пользователь не состоит в лобби", NOT_FOUND_ERROR))
+        await publish_lobby_change(response, f"{username} вышел из лобби", user_id)
         return f"Вы покинули лобби"
     else:
         return response.message
 
 
-async def get_lobby_info(user_id: int) -> str:
-    response = await get_lobby_by_user(user_id)
+@traced()
+async def get_lobby_info(user_id: int, snapshot: LobbySnapshot | None = None) -> str:
+    response = await load_lobby(user_id, snapshot)
 
     if isinstance(response, Lobby):
-        players_output = []
-
-        for player in response.players:
-            card = player.cards
-            card_parts = []
-
-            if card:
-                if card.characteristics:
-                    characteristics = "\n".join([
-                        f"• {escape_md(k)}: {escape_md(v) if k in card.revealed_values else 'неизвестно'}"
-                        for k, v in card.characteristics.items()
-                    ])
-                    card_parts.append(f"{bold('Характеристики')}:\n{characteristics}")
-
-                if card.items:
-                    items = "\n".join([
-                        f"• {escape_md(item.name) if item.name in card.revealed_values else 'неизвестно'}"
-                        for item in card.items
-                    ])
-                    card_parts.append(f"{bold('Предметы')}:\n{items}")
-
-                if card.special_cards:
-                    specials = "\n".join([
-                        f"• {escape_md(s.name) if s.name in card.revealed_values else 'неизвестно'}"
-                        for s in card.special_cards
-                    ])
-                    card_parts.append(f"{bold('Спец. карты')}:\n{specials}")
-
-            if card_parts:
-                player_info = f"\n\n📌 {bold(player.username)}\n" + "\n".join(card_parts)
-            else:
-                player_info = f"\n📌 {bold(player.username)}"
-
-            players_output.append(player_info)
-
-        lobby_header = f"🏠 Лобби: ||{escape_md(response.code)}||\n👑 Владелец: {escape_md(response.owner.username)}"
-        return f"{lobby_header}\n\n{bold('Игроки')}:" + "".join(players_output)
+        return render_lobby_board(response, await get_lobby_scenario(response))
 
     return escape_md(response.message)
 
 
-async def start_game(owner_id: int, bot: Bot) -> str:
-    lobby = await get_lobby_by_user(owner_id)
+@traced()
+async def get_live_board(user_id: int) -> Tuple[str, str] | BadResponse:
+    """Код лобби пользователя и доска лобби для живой доски."""
+    snapshot = LobbySnapshot(user_id)
+    lobby = await load_lobby(user_id, snapshot)
     if isinstance(lobby, BadResponse):
-        return lobby.message
-
-    if lobby.owner.user_id != owner_id:
-        return "Только владелец лобби может начать игру"
+        return lobby
+    return lobby.code, await get_lobby_info(user_id, snapshot)
 
-    lobby.started = True
-    response = await update_lobby_info(lobby)
-    if isinstance(response, BadResponse):
-        return "Ошибка. Попробуйте позже"
 
-    for player in lobby.players:
-        if player.user_id != lobby.owner.user_id:
-            await send_notification(player.user_id, bot, f"Игра началась!")
+live_boards = LiveBoards(get_live_board, LIVE_BOARD_DEBOUNCE_MS / 1000, NOTIFY_CONCURRENCY)
 
-    scenario = random.choice(SCENARIOS)
-    await update_lobby_info(assign_cards(response, scenario))
 
-    return f"Игра началась!"
+def _remember_lobby(snapshot: LobbySnapshot | None, lobby: Lobby) -> None:
+    """Кладет в снимок лобби, полученное после изменения, если пользователь все еще в нем."""
+    if snapshot is None:
+        return
+    if any(p.user_id == snapshot.user_id for p in lobby.players):
+        snapshot.set(lobby)
+    else:
+        snapshot.invalidate()
 
 
-def assign_cards(lobby: Lobby, scenario: Scenario) -> Lobby | BadResponse:
-    lobby.bunker = Bunker(
-        scenario_id=scenario.id,
-        scenario_name=scenario.name,
-        scenario_description=scenario.description,
-        features=[BunkerFeature(name=bf.name, description=bf.description) for bf in scenario.bunker_features]
-    )
+@traced()
+async def start_game(owner_id: int, snapshot: LobbySnapshot | None = None) -> str:
+    lobby = await load_lobby(owner_id, snapshot)
+    if isinstance(lobby, BadResponse):
+        return lobby.message
 
-    for player in lobby.players:
-        characteristics = generate_characteristics(scenario.characteristics)
+    if lobby.owner.user_id != owner_id:
+        return "Только владелец лобби может начать игру"
 
-        items = generate_items(scenario.items)
+    scenario = random.choice(get_catalog().scenarios)
+    # Без закрепленной версии карты лобби нельзя будет прочитать после правки сценария
+    pinned = await pin_scenario(scenario)
+    if isinstance(pinned, BadResponse):
+        return "Ошибка. Попробуйте позже"
 
-        special_cards = generate_special_cards(scenario.special_cards)
+    def start(lobby: Lobby, changes: LobbyChanges) -> str | None:
+        # Лобби могло измениться с момента чтения снимка, поэтому проверки повторяются
+        if lobby.owner.user_id != owner_id:
+            return "Только владелец лобби может начать игру"
+        if lobby.started:
+            return "Игра уже началась"
+        lobby.started = True
+        deal_lobby(lobby, scenario)
+        changes.meta = True
+        changes.events += ["start", "deal"]
+        changes.players.update(p.user_id for p in lobby.players)
+        return None
 
-        player.cards = PlayerCard(
-            characteristics=characteristics,
-            items=items,
-            special_cards=special_cards
-        )
+    response = await run_in_lobby(lobby.code, start)
+    if isinstance(response, BadResponse):
+        if snapshot is not None:
+            snapshot.invalidate()
+        return "Ошибка. Попробуйте позже"
 
-    return lobby
+    error, lobby = response
+    _remember_lobby(snapshot, lobby)
+    if error:
+        return error
 
-def generate_characteristics(characteristics: Dict[str, List[str]]) -> Dict[str, str]:
-    generated_characteristics = {}
-    for characteristic, values in characteristics.items():
-        generated_characteristics[characteristic] = random.choice(values)
-    return generated_characteristics
+    # Меню игроков меняется с началом игры, поэтому сообщение отправляется и при живой доске
+    await notify_players(lobby, f"Игра началась!", exclude_user_id=lobby.owner.user_id)
+    if LIVE_BOARD:
+        live_boards.schedule(p.user_id for p in lobby.players)
 
-def generate_items(items: List[Item]) -> List[Item]:
-    return [random.choice(items)]
+    return f"Игра началась!"
 
-def generate_special_cards(special_cards: List[SpecialCard]) -> List[SpecialCard]:
-    return [random.choice(special_cards)]
 
-async def get_bunker_info(user_id: int, bot: Bot) -> str | BadResponse:
-    response = await get_lobby_by_user(user_id)
+@traced()
+async def get_lobby_scenario(lobby: Lobby) -> Scenario | None:
+    """Сценарий, закрепленный за лобби при старте игры."""
+    if lobby.bunker is None:
+        return None
+    scenario = get_scenario(lobby.bunker.scenario_id, lobby.bunker.scenario_version)
+    if scenario is None and lobby.bunker.scenario_version:
+        pinned = await get_pinned_scenario(lobby.bunker.scenario_id, lobby.bunker.scenario_version)
+        if isinstance(pinned, Scenario):
+            scenario = pinned
+    if scenario is None:
+        # Закрепленная версия потеряна - показываем текущую; ссылки, которых в ней нет, пропускаются
+        scenario = get_scenario(lobby.bunker.scenario_id)
+    return scenario
+
+@traced()
+async def get_bunker_info(user_id: int, snapshot: LobbySnapshot | None = None) -> str | BadResponse:
+    response = await load_lobby(user_id, snapshot)
     if isinstance(response, BadResponse):
         return response
 
-    bunker = response.bunker
-
-    features_text = ""
-    if bunker.features:
-        feature = random.choice(bunker.features)
-        features_text = "\n\n" + bold("Особенности бункера") + ":\n" + "\n".join(
-            [f"• {escape_md(feature.name)}: {escape_md(feature.description)}"]
-        )
+    scenario = await get_lobby_scenario(response)
+    if scenario is None:
+        return "Игра еще не началась"
 
-    return (
-        f"🏰 {bold('Бункер')}\n\n"
-        f"{bold('Сценарий')}: {escape_md(bunker.scenario_name)}\n\n"
-        f"{bunker.scenario_description}"
-        f"{features_text}"
-    )
+    return render_bunker(scenario)
 
-async def get_player_info(user_id: int) -> str:
-    response = await get_lobby_by_user(user_id)
+@traced()
+async def get_player_info(user_id: int, snapshot: LobbySnapshot | None = None) -> str:
+    response = await load_lobby(user_id, snapshot)
 
     if isinstance(response, Lobby):
         player = next((p for p in response.players if p.user_id == user_id), None)
         if not player:
             return "❗ Вы не найдены в этом лобби."
 
-        card = player.cards
-        card_parts = []
-
-        if card:
-            if card.characteristics:
-                characteristics = "\n".join([
-                    f"• {escape_md(k)}: {escape_md(v)}"
-                    for k, v in card.characteristics.items()
-                ])
-                card_parts.append(f"{bold('Характеристики')}:\n{characteristics}")
-
-            if card.items:
-                items = "\n".join([
-                    f"• {escape_md(item.name)} - {escape_md(item.description)}"
-                    for item in card.items
-                ])
-                card_parts.append(f"{bold('Предметы')}:\n{items}")
-
-            if card.special_cards:
-                specials = "\n".join([
-                    f"• {escape_md(s.name)} - {escape_md(s.description)}"
-                    for s in card.special_cards
-                ])
-                card_parts.append(f"{bold('Спец. карты')}:\n{specials}")
-
-        player_info = bold(player.username)
-        if card_parts:
-            player_info += "\n" + "\n\n".join(card_parts)
-
-        return player_info
+        return render_player_card(response, player, await get_lobby_scenario(response))
 
     return escape_md(response.message)
 
 
-async def get_player_card(user_id: int) -> PlayerCard | BadResponse:
-    lobby = await get_lobby_by_user(user_id)
+@traced()
+async def get_player_card(user_id: int, snapshot: LobbySnapshot | None = None) -> PlayerCard | BadResponse:
+    lobby = await load_lobby(user_id, snapshot)
 
     if isinstance(lobby, Lobby):
         player = next((p for p in lobby.players if p.user_id == user_id), None)
@@ -247,29 +223,68 @@ async def get_player_card(user_id: int) -> PlayerCard | BadResponse:
 
     return lobby
 
-async def reveal_player_value(user_id: int, value_name: str, bot: Bot) -> bool:
-    lobby = await get_lobby_by_user(user_id)
+@traced()
+async def get_unrevealed_values(user_id: int, snapshot: LobbySnapshot | None = None) -> List[str] | BadResponse:
+    """Названия характеристик и карт игрока, которые он еще не раскрыл."""
+    lobby = await load_lobby(user_id, snapshot)
+    if isinstance(lobby, BadResponse):
+        return lobby
+
+    player = next((p for p in lobby.players if p.user_id == user_id), None)
+    if not player or not player.cards:
+        return BadResponse("Игрок не найден", NOT_FOUND_ERROR)
+
+    card = player.cards
+    scenario = await get_lobby_scenario(lobby)
+    names = list(card.characteristics.keys())
+    if scenario:
+        names += [item.name for item in card.resolve_items(scenario)] + \
+                 [special_card.name for special_card in card.resolve_special_cards(scenario)]
+    return [name for name in names if name not in card.revealed_values]
+
+@traced()
+async def reveal_player_value(user_id: int, value_name: str, snapshot: LobbySnapshot | None = None) -> bool:
+    lobby = await load_lobby(user_id, snapshot)
+    if isinstance(lobby, BadResponse):
+        return False
 
-    if isinstance(lobby, Lobby):
+    def reveal(lobby: Lobby, changes: LobbyChanges) -> Player | None:
         player = next((p for p in lobby.players if p.user_id == user_id), None)
-        if player and player.cards:
-            if value_name not in player.cards.revealed_values:
-                player.cards.revealed_values.append(value_name)
-                await update_lobby_info(lobby)
-
-                for lobby_player in lobby.players:
-                    if lobby_player.user_id != user_id:
-                        await send_notification(lobby_player.user_id, bot, f"{player.username} раскрыл {value_name}")
-
-                return True
-
-    return False
+        if not player or not player.cards or value_name in player.cards.revealed_values:
+            return None
+        player.cards.revealed_values.append(value_name)
+        changes.players.add(user_id)
+        changes.events.append("reveal")
+        return player
+
+    response = await run_in_lobby(lobby.code, reveal)
+    if isinstance(response, BadResponse):
+        if snapshot is not None:
+            snapshot.invalidate()
+        return False
+
+    player, lobby = response
+    _remember_lobby(snapshot, lobby)
+    # Игрок мог выйти, пока ждал запись: тогда раскрытие не сохранено
+    if player is None or not any(p.user_id == user_id for p in lobby.players):
+        return False
+
+    await publish_lobby_change(lobby, f"{player.username} раскрыл {value_name}", user_id)
+    return True
+
+@traced()
+async def publish_lobby_change(lobby: Lobby, message: str, user_id: int) -> None:
+    """
+    Сообщает игрокам об изменении лобби, которое сделал user_id: обновлением живых досок всех игроков
+    (и самого user_id, даже если он вышел) или сообщением всем, кроме него.
+    """
+    if LIVE_BOARD:
+        live_boards.schedule([p.user_id for p in lobby.players] + [user_id])
+    else:
+        await notify_players(lobby, message, exclude_user_id=user_id)
 
-async def send_notification(user_id: int, bot: Bot, message: str) -> None | BadResponse:
-    try:
-        menu = await get_main_menu(user_id)
-        await bot.send_message(user_id, message, reply_markup=menu)
-        return None
-    except Exception as e:
-        print(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-        return BadResponse("Возникла непредвиденная ошибка", INTERNAL_ERROR)
+@traced()
+async def notify_players(lobby: Lobby, message: str, exclude_user_id: int | None = None) -> None | BadResponse:
+    """Ставит в очередь уведомлений сообщение всем игрокам лобби (кроме exclude_user_id)."""
+    return await enqueue(OutgoingMessage(player.user_id, message, build_main_menu(lobby, player.user_id))
+                         for player in lobby.players if player.user_id != exclude_user_id)
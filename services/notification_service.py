@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, TypeVar
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+from config import NOTIFY_CONCURRENCY, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Ведро токенов: rate отправок в секунду с запасом не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Забирает токен (в долг, если нужно) и возвращает, сколько секунд ждать до отправки."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(delay, self._blocked_until - now)
+
+    def block(self, seconds: float) -> None:
+        """Запрещает отправку на seconds секунд (ответ 429 от Telegram)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class NotificationDispatcher:
+    """
+    Отправка сообщений с ограничением параллелизма и лимитами Telegram (общим и для каждого чата).
+
+    Очередь уведомлений (services/outbox.py) отправляет через него сообщения и сама решает, повторять ли
+    отправку: ошибки, в том числе RetryAfter, пробрасываются вызывающему.
+    """
+
+    def __init__(self, concurrency: int, global_rate: float, chat_rate: float, chat_burst: float,
+                 max_chats: int = 10_000):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._global = TokenBucket(global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._max_chats = max_chats
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+            if len(self._chats) > self._max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def deliver(self, bot: Bot, chat_id: int, text: str, **kwargs) -> Message:
+        """Отправляет сообщение, дождавшись своей очереди по лимитам чата и бота."""
+        return await self.limited(chat_id, lambda: bot.send_message(chat_id, text, **kwargs))
+
+    async def limited(self, chat_id: int, request: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет запрос к Bot API в чат chat_id (отправку, редактирование) по тем же лимитам."""
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self._semaphore:
+            delay = self._global.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await request()
+            except TelegramRetryAfter as e:
+                self._chat_bucket(chat_id).block(e.retry_after)
+                raise
+
+notifier = NotificationDispatcher(concurrency=NOTIFY_CONCURRENCY,
+                                  global_rate=TELEGRAM_GLOBAL_RATE,
+                                  chat_rate=TELEGRAM_CHAT_RATE,
+                                  chat_burst=TELEGRAM_CHAT_BURST)
@@ -0,0 +1,442 @@
+"""
+Очередь исходящих уведомлений в Redis: поток outbox с группой отправителей.
+
+Обработчики только добавляют сообщения в поток (enqueue; сообщения одновременных обработчиков процесса
+записываются одним запросом), а отправляют их OUTBOX_WORKERS отправителей каждого процесса бота. Сообщение удаляется из потока после
+отправки или окончательной ошибки. До этого оно числится за отправителем, и если процесс упал или был
+остановлен, через OUTBOX_CLAIM_IDLE_MS сообщение забирает (XAUTOCLAIM) отправитель другого или
+перезапущенного процесса, поэтому уведомления переживают перезапуск (сообщение, отправленное прямо перед
+падением, может прийти дважды).
+
+Сообщения одному чату, пришедшие с паузами меньше NOTIFY_DIGEST_WINDOW_MS, отправляются одним сообщением-сводкой
+(строки по порядку, меню из последнего сообщения), но не позже NOTIFY_DIGEST_MAX_DELAY_MS после первого из них.
+Пока сводка собирается, ее сообщения числятся за отправителем, поэтому сводка тоже переживает перезапуск.
+
+Отправка повторяется при RetryAfter (через указанное Telegram время) и сетевых ошибках и ошибках сервера
+Telegram (с экспоненциальной задержкой), не больше NOTIFY_MAX_RETRIES раз. Сообщения, которые так и не
+удалось отправить, сохраняются в потоке outbox:dead.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import socket
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, ReplyKeyboardRemove
+from redis.exceptions import ResponseError
+
+from config import OUTBOX_WORKERS, OUTBOX_BATCH, OUTBOX_BLOCK_MS, OUTBOX_CLAIM_IDLE_MS, NOTIFY_MAX_RETRIES, \
+    NOTIFY_BACKOFF_BASE_MS, NOTIFY_BACKOFF_CAP_MS, NOTIFY_DIGEST_WINDOW_MS, NOTIFY_DIGEST_MAX_DELAY_MS
+from models.error import BadResponse, INTERNAL_ERROR
+from services.notification_service import notifier
+from storage.redis_repository import redis_client
+from utils.metrics import observe_redis, OUTBOX_DELIVERY, OUTBOX_RETRIES, OUTBOX_DROPPED, OUTBOX_COALESCED
+
+OUTBOX_KEY = "outbox"
+DEAD_LETTER_KEY = "outbox:dead"
+OUTBOX_GROUP = "senders"
+# Защита от бесконечного роста, если отправители не запущены: самые старые сообщения вытесняются
+OUTBOX_MAX_LENGTH = 1_000_000
+DEAD_LETTER_MAX_LENGTH = 10_000
+# Ограничение Telegram на длину текста сообщения: длиннее сводка не собирается
+MESSAGE_MAX_LENGTH = 4096
+# Запись в очередь без новых сообщений завершается и создается заново при следующем
+WRITER_IDLE_SECONDS = 5.0
+
+MarkupType = ReplyKeyboardMarkup | InlineKeyboardMarkup | ReplyKeyboardRemove
+_MARKUP_TYPES = {"reply": ReplyKeyboardMarkup, "inline": InlineKeyboardMarkup, "remove": ReplyKeyboardRemove}
+
+
+@dataclass(slots=True)
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    reply_markup: MarkupType | None = None
+    parse_mode: str | None = None
+
+    def to_fields(self) -> dict:
+        fields = {"chat_id": self.chat_id, "text": self.text}
+        if self.reply_markup is not None:
+            # Подклассы тоже подходят (например, неизменяемые меню из commands/menu_commands.py)
+            fields["markup_type"] = next(name for name, markup_type in _MARKUP_TYPES.items()
+                                         if isinstance(self.reply_markup, markup_type))
+            fields["markup"] = self.reply_markup.model_dump_json(exclude_none=True)
+        if self.parse_mode is not None:
+            fields["parse_mode"] = self.parse_mode
+        return fields
+
+    @staticmethod
+    def merge(messages: List["OutgoingMessage"]):
+        """Сводка сообщений одному чату: тексты по порядку, меню из последнего сообщения с меню."""
+        markup = next((m.reply_markup for m in reversed(messages) if m.reply_markup is not None), None)
+        return OutgoingMessage(chat_id=messages[0].chat_id,
+                               text="\n".join(m.text for m in messages),
+                               reply_markup=markup,
+                               parse_mode=messages[0].parse_mode)
+
+    @staticmethod
+    def from_fields(data: Dict[bytes, bytes]):
+        markup = data.get(b"markup")
+        parse_mode = data.get(b"parse_mode")
+        return OutgoingMessage(chat_id=int(data[b"chat_id"]),
+                               text=data[b"text"].decode(),
+                               reply_markup=_MARKUP_TYPES[data[b"markup_type"].decode()].model_validate_json(markup)
+                               if markup else None,
+                               parse_mode=parse_mode.decode() if parse_mode else None)
+
+
+class _OutboxWriter:
+    """
+    Запись в очередь сообщений всех обработчиков процесса: сообщения, накопившиеся за время
+    предыдущей записи, добавляются одним запросом (под нагрузкой обработчики не занимают
+    по соединению из пула ради каждого уведомления).
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        # None в очереди - сигнал остановки после записи предыдущих сообщений
+        self.queue: asyncio.Queue[Tuple[List[OutgoingMessage], asyncio.Future] | None] = asyncio.Queue()
+        # Запись живет дольше апдейта, который ее создал, и не должна наследовать его контекст (дерево вызовов)
+        self.task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        global _writer
+        while True:
+            try:
+                first = await asyncio.wait_for(self.queue.get(), WRITER_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                # Между проверкой и удалением нет await, поэтому новое сообщение не может потеряться
+                if self.queue.empty():
+                    if _writer is self:
+                        _writer = None
+                    return
+                continue
+            batch = [first]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            stopping = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                await self._write(batch)
+            if stopping:
+                if _writer is self:
+                    _writer = None
+                return
+
+    @staticmethod
+    async def _write(batch: List[Tuple[List[OutgoingMessage], asyncio.Future]]) -> None:
+        result = None
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for messages, _ in batch:
+                    for message in messages:
+                        pipe.xadd(OUTBOX_KEY, message.to_fields(), maxlen=OUTBOX_MAX_LENGTH, approximate=True)
+                await pipe.execute()
+        except Exception as e:
+            print(f"Не удалось поставить уведомления в очередь: {e}")
+            result = BadResponse(str(e), INTERNAL_ERROR)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(result)
+
+
+_writer: _OutboxWriter | None = None
+
+
+@observe_redis("enqueue_notifications")
+async def enqueue(messages: Iterable[OutgoingMessage]) -> None | BadResponse:
+    """Ставит сообщения в очередь (вместе с сообщениями других обработчиков); отправят их отправители."""
+    global _writer
+    messages = list(messages)
+    if not messages:
+        return None
+    if _writer is None or _writer.loop is not asyncio.get_running_loop():
+        _writer = _OutboxWriter()
+    future = _writer.loop.create_future()
+    _writer.queue.put_nowait((messages, future))
+    return await future
+
+
+@dataclass(slots=True)
+class OutboxStats:
+    length: int
+    pending: int
+    oldest_seconds: float
+
+
+async def outbox_stats() -> OutboxStats:
+    """Неотправленные сообщения (из них взятые отправителями) и возраст самого старого."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xlen(OUTBOX_KEY)
+        pipe.xpending(OUTBOX_KEY, OUTBOX_GROUP)
+        pipe.xrange(OUTBOX_KEY, count=1)
+        length, pending, oldest = await pipe.execute(raise_on_error=False)
+    return OutboxStats(length=length,
+                       pending=pending["pending"] if isinstance(pending, dict) else 0,
+                       oldest_seconds=max(time.time() - _enqueued_at(oldest[0][0]), 0.0) if oldest else 0.0)
+
+
+def _enqueued_at(entry_id: bytes) -> float:
+    # Идентификатор записи потока начинается со времени добавления в мс
+    return int(entry_id.split(b"-")[0]) / 1000
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(NOTIFY_BACKOFF_CAP_MS, NOTIFY_BACKOFF_BASE_MS * 2 ** attempt)) / 1000
+
+
+# Запись очереди: id и поля сообщения
+OutboxEntry = Tuple[bytes, Dict[bytes, bytes]]
+# Сообщение, отправка которого закончена: id, поля и ошибка (None - отправлено)
+FinishedMessage = Tuple[bytes, Dict[bytes, bytes], Exception | None]
+
+
+@dataclass(slots=True)
+class _Digest:
+    """Сообщения одному чату, которые будут отправлены одной сводкой."""
+    entries: List[OutboxEntry]
+    length: int
+    first_at: float
+    last_at: float
+    # Сводку нужно отправить сейчас: следующее сообщение в нее не помещается или отправители останавливаются
+    ready: asyncio.Event
+
+
+class OutboxSender:
+    """
+    Отправители одного процесса: каждый держит в работе до batch сообщений или сводок. Законченные сообщения
+    подтверждаются и удаляются из очереди пачками одной транзакцией.
+    """
+
+    def __init__(self, bot: Bot, workers: int, batch: int, block_ms: int, claim_idle_ms: int,
+                 digest_window_ms: int = 0, digest_max_delay_ms: int = 0):
+        self.bot = bot
+        self.workers = workers
+        self.batch = batch
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.digest_window = digest_window_ms / 1000
+        self.digest_max_delay = digest_max_delay_ms / 1000
+        # Собираемые сводки по (чат, parse_mode), общие для отправителей процесса
+        self._digests: Dict[Tuple[bytes, bytes | None], _Digest] = {}
+        self._name = f"{socket.gethostname()}-{os.getpid()}"
+        self._stopping = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._in_flight: Set[asyncio.Task] = set()
+        # None в очереди - сигнал остановки после подтверждения предыдущих сообщений
+        self._finished: asyncio.Queue[FinishedMessage | None] = asyncio.Queue()
+        self._ack_task: asyncio.Task | None = None
+        # Когда в следующий раз удалять из группы отправители остановленных процессов
+        self._next_prune = 0.0
+
+    async def start(self) -> None:
+        try:
+            await redis_client.xgroup_create(OUTBOX_KEY, OUTBOX_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        # Отправители живут дольше апдейта и не должны наследовать его контекст (дерево вызовов)
+        self._tasks = [asyncio.create_task(self._run(f"{self._name}-{i}"), context=contextvars.Context())
+                       for i in range(self.workers)]
+        self._ack_task = asyncio.create_task(self._acknowledge(), context=contextvars.Context())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """
+        Перестает брать новые сообщения и ждет начатых отправок не дольше timeout. Неотправленные
+        сообщения остаются в очереди за этим процессом, и после OUTBOX_CLAIM_IDLE_MS их заберет другой.
+        """
+        self._stopping.set()
+        for digest in self._digests.values():
+            digest.ready.set()
+        deadline = time.monotonic() + timeout
+        unfinished = set()
+        # Отправители перестают читать очередь, затем дожидаемся взятых сообщений и их подтверждения
+        for tasks in (self._tasks, self._in_flight, [self._ack_task]):
+            if tasks == [self._ack_task]:
+                self._finished.put_nowait(None)
+            if tasks:
+                _, left = await asyncio.wait(list(tasks), timeout=max(deadline - time.monotonic(), 0))
+                unfinished |= left
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+    async def _run(self, consumer: str) -> None:
+        own: Set[asyncio.Task] = set()
+        next_claim = 0.0
+        while not self._stopping.is_set():
+            try:
+                if len(own) >= self.batch:
+                    await asyncio.wait(own, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                if time.monotonic() >= next_claim:
+                    next_claim = time.monotonic() + self.claim_idle_ms / 2000
+                    entries = await self._claim(consumer, self.batch - len(own))
+                else:
+                    response = await redis_client.xreadgroup(OUTBOX_GROUP, consumer, {OUTBOX_KEY: ">"},
+                                                             count=self.batch - len(own), block=self.block_ms)
+                    entries = response[0][1] if response else []
+                # Взятые при остановке сообщения останутся за отправителем и будут отправлены после перезапуска
+                if self._stopping.is_set():
+                    break
+                for entry in entries:
+                    task = self._add(consumer, entry)
+                    if task is not None:
+                        for tasks in (own, self._in_flight):
+                            tasks.add(task)
+                            task.add_done_callback(tasks.discard)
+            except Exception as e:
+                print(f"Ошибка чтения очереди уведомлений: {e}")
+                await asyncio.sleep(1)
+
+    async def _claim(self, consumer: str, count: int) -> list:
+        """Забирает сообщения, которые другой отправитель взял и не подтвердил дольше claim_idle_ms."""
+        # Сначала только id: Redis 6.2 вместо записи, удаленной из потока, возвращает nil без id,
+        # и ее нельзя было бы подтвердить
+        ids = await redis_client.xautoclaim(OUTBOX_KEY, OUTBOX_GROUP, consumer, self.claim_idle_ms,
+                                            start_id="0-0", count=count, justid=True)
+        entries = []
+        if ids:
+            entries = [entry for entry in await redis_client.xclaim(OUTBOX_KEY, OUTBOX_GROUP, consumer, 0, ids)
+                       if entry[0] is not None]
+            lost = set(ids) - {entry_id for entry_id, _ in entries}
+            if lost:
+                # Данных сообщения уже нет, отправлять нечего
+                print(f"Уведомления удалены из очереди до отправки: {len(lost)}")
+                await redis_client.xack(OUTBOX_KEY, OUTBOX_GROUP, *lost)
+        if time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + self.claim_idle_ms / 1000
+            await self._prune_consumers()
+        return entries
+
+    async def _prune_consumers(self) -> None:
+        """Удаляет из группы отправители остановленных процессов, за которыми не осталось сообщений."""
+        for info in await redis_client.xinfo_consumers(OUTBOX_KEY, OUTBOX_GROUP):
+            if info["pending"] == 0 and info["idle"] > self.claim_idle_ms:
+                await redis_client.xgroup_delconsumer(OUTBOX_KEY, OUTBOX_GROUP, info["name"])
+
+    def _add(self, consumer: str, entry: OutboxEntry) -> asyncio.Task | None:
+        """
+        Добавляет сообщение в сводку его чата. Возвращает задачу отправки, если начата новая сводка
+        (или сводки выключены), и None, если сообщение присоединилось к уже собираемой.
+        """
+        if self.digest_window <= 0:
+            return asyncio.create_task(self._process(consumer, [entry]))
+        data = entry[1]
+        key = (data[b"chat_id"], data.get(b"parse_mode"))
+        length = len(data[b"text"].decode())
+        now = time.monotonic()
+        digest = self._digests.get(key)
+        if digest is not None and digest.length + 1 + length <= MESSAGE_MAX_LENGTH and not digest.ready.is_set():
+            digest.entries.append(entry)
+            digest.length += 1 + length
+            digest.last_at = now
+            OUTBOX_COALESCED.inc()
+            return None
+        if digest is not None:
+            digest.ready.set()
+        digest = self._digests[key] = _Digest([entry], length, now, now, asyncio.Event())
+        return asyncio.create_task(self._send_digest(consumer, key, digest))
+
+    async def _send_digest(self, consumer: str, key: Tuple[bytes, bytes | None], digest: _Digest) -> None:
+        # Ждем паузы в сообщениях чату, но не дольше digest_max_delay с первого сообщения
+        while not digest.ready.is_set():
+            delay = min(digest.last_at + self.digest_window,
+                        digest.first_at + self.digest_max_delay) - time.monotonic()
+            if delay <= 0:
+                break
+            try:
+                await asyncio.wait_for(digest.ready.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        if self._digests.get(key) is digest:
+            del self._digests[key]
+        await self._process(consumer, digest.entries)
+
+    async def _process(self, consumer: str, entries: List[OutboxEntry]) -> None:
+        error = None
+        ids = [entry_id for entry_id, _ in entries]
+        try:
+            message = OutgoingMessage.merge([OutgoingMessage.from_fields(data) for _, data in entries])
+            for attempt in range(NOTIFY_MAX_RETRIES + 1):
+                try:
+                    await notifier.deliver(self.bot, message.chat_id, message.text,
+                                           reply_markup=message.reply_markup, parse_mode=message.parse_mode)
+                    for entry_id in ids:
+                        OUTBOX_DELIVERY.observe(max(time.time() - _enqueued_at(entry_id), 0.0))
+                    error = None
+                    break
+                except TelegramRetryAfter as e:
+                    error, delay, reason = e, e.retry_after, "rate_limited"
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    error, delay, reason = e, _backoff(attempt), "network"
+                if attempt < NOTIFY_MAX_RETRIES:
+                    OUTBOX_RETRIES.labels(reason).inc()
+                    # Ожидание не должно выглядеть как упавший отправитель
+                    await redis_client.xclaim(OUTBOX_KEY, OUTBOX_GROUP, consumer, 0, ids, justid=True)
+                    await asyncio.sleep(delay)
+        except Exception as e:
+            error = e
+
+        if error is not None:
+            OUTBOX_DROPPED.inc(len(entries))
+            print(f"Не удалось отправить уведомление {ids[0].decode()} (сообщений: {len(ids)}): {error}")
+        for entry_id, data in entries:
+            self._finished.put_nowait((entry_id, data, error))
+
+    async def _acknowledge(self) -> None:
+        while True:
+            first = await self._finished.get()
+            batch = [first]
+            while not self._finished.empty():
+                batch.append(self._finished.get_nowait())
+            stopping = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                try:
+                    await self._ack(batch)
+                except Exception as e:
+                    # Сообщения останутся за отправителями, и их повторно отправит тот, кто их заберет
+                    print(f"Не удалось подтвердить уведомления: {e}")
+            if stopping:
+                return
+
+    @staticmethod
+    async def _ack(batch: List[FinishedMessage]) -> None:
+        ids = [entry_id for entry_id, _, _ in batch]
+        # Подтверждение и удаление в одной транзакции: в потоке не бывает удаленных, но не подтвержденных записей,
+        # и XLEN равен числу неотправленных сообщений
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for _, data, error in batch:
+                if error is not None:
+                    pipe.xadd(DEAD_LETTER_KEY, {**data, b"error": str(error) or type(error).__name__},
+                              maxlen=DEAD_LETTER_MAX_LENGTH, approximate=True)
+            pipe.xack(OUTBOX_KEY, OUTBOX_GROUP, *ids)
+            pipe.xdel(OUTBOX_KEY, *ids)
+            await pipe.execute()
+
+
+_sender: OutboxSender | None = None
+
+
+async def start_outbox(bot: Bot) -> None:
+    global _sender
+    if OUTBOX_WORKERS > 0 and _sender is None:
+        _sender = OutboxSender(bot, OUTBOX_WORKERS, OUTBOX_BATCH, OUTBOX_BLOCK_MS, OUTBOX_CLAIM_IDLE_MS,
+                               NOTIFY_DIGEST_WINDOW_MS, NOTIFY_DIGEST_MAX_DELAY_MS)
+        await _sender.start()
+
+
+async def stop_outbox() -> None:
+    global _sender
+    if _writer is not None and not _writer.task.done():
+        _writer.queue.put_nowait(None)
+        await _writer.task
+    if _sender is not None:
+        await _sender.stop()
+        _sender = None
@@ -0,0 +1,192 @@
+import random
+from collections import OrderedDict
+from typing import Hashable, List, Tuple
+
+from aiogram.utils.markdown import bold
+
+from config import RENDER_CACHE_SIZE
+from models.lobby import Lobby, Player
+from models.scenario import Scenario
+from utils.escape import escape_md
+
+
+class RenderCache:
+    """
+    LRU-кэш готовых текстов. Ключ включает версию лобби, поэтому после любого изменения
+    лобби старые тексты просто перестают запрашиваться и вытесняются.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._texts: OrderedDict[Hashable, str] = OrderedDict()
+
+    def get(self, key: Hashable) -> str | None:
+        text = self._texts.get(key)
+        if text is None:
+            self.misses += 1
+            return None
+        self._texts.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key: Hashable, text: str) -> None:
+        if self.max_size <= 0:
+            return
+        self._texts[key] = text
+        self._texts.move_to_end(key)
+        if len(self._texts) > self.max_size:
+            self._texts.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._texts.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._texts), "max_size": self.max_size, "enabled": self.max_size > 0,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+# Версий сценариев немного, но после перезагрузок каталога старые не нужны
+BUNKER_CACHE_SIZE = 64
+
+
+def _escape(scenario: Scenario, text: str) -> str:
+    # Значения из старых лобби могут отсутствовать в сценарии
+    escaped = scenario.escaped_text.get(text)
+    return escaped if escaped is not None else escape_md(text)
+
+
+def _cached(key: Hashable | None, render, *args) -> str:
+    """key=None - версия лобби неизвестна, текст не кэшируется."""
+    if key is None:
+        return render(*args)
+    text = render_cache.get(key)
+    if text is None:
+        text = render(*args)
+        render_cache.put(key, text)
+    return text
+
+
+def _lobby_key(kind: str, lobby: Lobby, scenario: Scenario | None, *extra) -> Tuple | None:
+    if not lobby.version:
+        return None
+    return (kind, lobby.code, lobby.version, scenario.version if scenario else None) + extra
+
+
+def _render_board(lobby: Lobby, scenario: Scenario | None) -> str:
+    players_output = []
+
+    for player in lobby.players:
+        card = player.cards
+        card_parts = []
+
+        if card and scenario:
+            card_characteristics = card.resolve_characteristics(scenario)
+            card_items = card.resolve_items(scenario)
+            card_special_cards = card.resolve_special_cards(scenario)
+
+            if card_characteristics:
+                characteristics = "\n".join([
+                    f"• {_escape(scenario, k)}: {_escape(scenario, v) if k in card.revealed_values else 'неизвестно'}"
+                    for k, v in card_characteristics.items()
+                ])
+                card_parts.append(f"{bold('Характеристики')}:\n{characteristics}")
+
+            if card_items:
+                items = "\n".join([
+                    f"• {_escape(scenario, item.name) if item.name in card.revealed_values else 'неизвестно'}"
+                    for item in card_items
+                ])
+                card_parts.append(f"{bold('Предметы')}:\n{items}")
+
+            if card_special_cards:
+                specials = "\n".join([
+                    f"• {_escape(scenario, s.name) if s.name in card.revealed_values else 'неизвестно'}"
+                    for s in card_special_cards
+                ])
+                card_parts.append(f"{bold('Спец. карты')}:\n{specials}")
+
+        if card_parts:
+            player_info = f"\n\n📌 {bold(player.username)}\n" + "\n".join(card_parts)
+        else:
+            player_info = f"\n📌 {bold(player.username)}"
+
+        players_output.append(player_info)
+
+    lobby_header = f"🏠 Лобби: ||{escape_md(lobby.code)}||\n👑 Владелец: {escape_md(lobby.owner.username)}"
+    return f"{lobby_header}\n\n{bold('Игроки')}:" + "".join(players_output)
+
+
+def render_lobby_board(lobby: Lobby, scenario: Scenario | None) -> str:
+    """Общая доска лобби: одинакова для всех игроков и строится один раз на версию лобби."""
+    return _cached(_lobby_key("board", lobby, scenario), _render_board, lobby, scenario)
+
+
+def _render_player(player: Player, scenario: Scenario | None) -> str:
+    card = player.cards
+    card_parts = []
+
+    if card and scenario:
+        card_characteristics = card.resolve_characteristics(scenario)
+        card_items = card.resolve_items(scenario)
+        card_special_cards = card.resolve_special_cards(scenario)
+
+        if card_characteristics:
+            characteristics = "\n".join([
+                f"• {_escape(scenario, k)}: {_escape(scenario, v)}"
+                for k, v in card_characteristics.items()
+            ])
+            card_parts.append(f"{bold('Характеристики')}:\n{characteristics}")
+
+        if card_items:
+            items = "\n".join([
+                f"• {_escape(scenario, item.name)} - {_escape(scenario, item.description)}"
+                for item in card_items
+            ])
+            card_parts.append(f"{bold('Предметы')}:\n{items}")
+
+        if card_special_cards:
+            specials = "\n".join([
+                f"• {_escape(scenario, s.name)} - {_escape(scenario, s.description)}"
+                for s in card_special_cards
+            ])
+            card_parts.append(f"{bold('Спец. карты')}:\n{specials}")
+
+    player_info = bold(player.username)
+    if card_parts:
+        player_info += "\n" + "\n\n".join(card_parts)
+
+    return player_info
+
+
+def render_player_card(lobby: Lobby, player: Player, scenario: Scenario | None) -> str:
+    """Карточка игрока для него самого (с нераскрытыми значениями)."""
+    return _cached(_lobby_key("player", lobby, scenario, player.user_id), _render_player, player, scenario)
+
+
+def _render_bunker_parts(scenario: Scenario) -> Tuple[str, List[str]]:
+    header = (f"🏰 {bold('Бункер')}\n\n"
+              f"{bold('Сценарий')}: {_escape(scenario, scenario.name)}\n\n"
+              f"{scenario.description}")
+    features = [f"\n\n{bold('Особенности бункера')}:\n• {_escape(scenario, f.name)}: {_escape(scenario, f.description)}"
+                for f in scenario.bunker_features]
+    return header, features
+
+
+_bunker_parts: OrderedDict[Tuple[str, str], Tuple[str, List[str]]] = OrderedDict()
+
+
+def render_bunker(scenario: Scenario) -> str:
+    """Описание бункера; особенность выбирается случайно при каждом просмотре, как и раньше."""
+    key = (scenario.id, scenario.version)
+    parts = _bunker_parts.get(key)
+    if parts is None:
+        parts = _bunker_parts[key] = _render_bunker_parts(scenario)
+        if len(_bunker_parts) > BUNKER_CACHE_SIZE:
+            _bunker_parts.popitem(last=False)
+    header, features = parts
+    return header + (random.choice(features) if features else "")
@@ -0,0 +1,176 @@
+"""
+Сериализация лобби для хранения в Redis.
+
+Поддерживаются два формата:
+- msgpack: заголовок BINARY_MARKER + версия схемы, затем компактные позиционные записи;
+- JSON (схема версии 0): словари to_dict, как в старых документах. Используется, если msgpack
+  не установлен или выбран LOBBY_CODEC=json, и всегда читается для совместимости.
+
+Формат определяется по первому байту записи, поэтому экземпляры бота с разными
+LOBBY_CODEC могут работать одновременно при плавном обновлении (сначала выкатывается код,
+который читает оба формата, затем включается запись в msgpack).
+"""
+import json
+from typing import Any
+
+from config import LOBBY_CODEC
+from models.lobby import Lobby, Player, Bunker
+from models.player_card import PlayerCard
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 0xc1 не используется в msgpack и не может начинать JSON-документ
+BINARY_MARKER = 0xc1
+SCHEMA_VERSION = 2
+
+
+def _json_dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode()
+
+
+def _json_dumps_stdlib(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode()
+
+
+def _json_loads(raw: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _cards_to_row(cards: PlayerCard | None) -> list | None:
+    if cards is None:
+        return None
+    return [cards.characteristics, cards.items, cards.special_cards, cards.revealed_values]
+
+
+def _cards_from_row(row: list | None) -> PlayerCard | None:
+    if row is None:
+        return None
+    return PlayerCard(characteristics=row[0], items=row[1], special_cards=row[2], revealed_values=row[3])
+
+
+def _cards_from_row_v1(row: list | None) -> PlayerCard | None:
+    # В схеме 1 предметы и спец. карты хранились целиком: [название, описание, действия]
+    if row is None:
+        return None
+    return PlayerCard(characteristics=row[0],
+                      items=[i[0] for i in row[1]],
+                      special_cards=[c[0] for c in row[2]],
+                      revealed_values=row[3])
+
+
+def _player_to_row(player: Player) -> list:
+    return [player.user_id, player.username, _cards_to_row(player.cards)]
+
+
+def _player_from_row(row: list) -> Player:
+    return Player(user_id=row[0], username=row[1], cards=_cards_from_row(row[2]))
+
+
+def _player_from_row_v1(row: list) -> Player:
+    return Player(user_id=row[0], username=row[1], cards=_cards_from_row_v1(row[2]))
+
+
+def _bunker_to_row(bunker: Bunker) -> list:
+    return [bunker.scenario_id, bunker.scenario_version, bunker.deal_seed]
+
+
+def _bunker_from_row(row: list) -> Bunker:
+    # В схеме 1 бункер хранил копию сценария без версии: [id, название, описание, особенности];
+    # до записи зерна раздачи - [id, версия]
+    if len(row) == 4:
+        return Bunker(scenario_id=row[0])
+    return Bunker(scenario_id=row[0], scenario_version=row[1], deal_seed=row[2] if len(row) == 3 else None)
+
+
+def _lobby_to_row(lobby: Lobby) -> list:
+    return [lobby.code,
+            lobby.owner.user_id,
+            lobby.started,
+            _bunker_to_row(lobby.bunker) if lobby.bunker else None,
+            [_player_to_row(p) for p in lobby.players]]
+
+
+def _lobby_from_row(row: list, player_from_row=_player_from_row) -> Lobby:
+    players = [player_from_row(p) for p in row[4]]
+    owner = next((p for p in players if p.user_id == row[1]), None) or Player(user_id=row[1], username="", cards=None)
+    return Lobby(code=row[0], owner=owner, players=players, started=row[2],
+                 bunker=_bunker_from_row(row[3]) if row[3] else None)
+
+
+def _lobby_from_row_v1(row: list) -> Lobby:
+    return _lobby_from_row(row, _player_from_row_v1)
+
+
+class JsonCodec:
+    name = "json"
+
+    def __init__(self, use_orjson: bool = True):
+        self._dumps = _json_dumps if use_orjson else _json_dumps_stdlib
+
+    def encode(self, obj, to_row) -> bytes:
+        return self._dumps(obj.to_dict())
+
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def __init__(self):
+        self._header = bytes([BINARY_MARKER, SCHEMA_VERSION])
+
+    def encode(self, obj, to_row) -> bytes:
+        return self._header + msgpack.packb(to_row(obj), use_bin_type=True)
+
+
+def _decode(raw: bytes | str, readers: dict, from_dict):
+    """readers - функции разбора записи для каждой поддерживаемой версии схемы."""
+    if isinstance(raw, bytes) and raw[0] == BINARY_MARKER:
+        version = raw[1]
+        if version not in readers:
+            raise ValueError(f"Неизвестная версия схемы лобби: {version}")
+        return readers[version](msgpack.unpackb(raw[2:], raw=False, use_list=True))
+    return from_dict(_json_loads(raw))
+
+
+def get_codec(name: str) -> JsonCodec | MsgpackCodec:
+    if name == "msgpack" and msgpack is not None:
+        return MsgpackCodec()
+    return JsonCodec()
+
+
+codec = get_codec(LOBBY_CODEC)
+
+
+def encode_player(player: Player, using: JsonCodec | MsgpackCodec | None = None) -> bytes:
+    return (using or codec).encode(player, _player_to_row)
+
+
+def decode_player(raw: bytes | str) -> Player:
+    return _decode(raw, {1: _player_from_row_v1, 2: _player_from_row}, Player.from_dict)
+
+
+def encode_bunker(bunker: Bunker, using: JsonCodec | MsgpackCodec | None = None) -> bytes:
+    return (using or codec).encode(bunker, _bunker_to_row)
+
+
+def decode_bunker(raw: bytes | str) -> Bunker:
+    return _decode(raw, {1: _bunker_from_row, 2: _bunker_from_row}, Bunker.from_dict)
+
+
+def encode_lobby(lobby: Lobby, using: JsonCodec | MsgpackCodec | None = None) -> bytes:
+    return (using or codec).encode(lobby, _lobby_to_row)
+
+
+def decode_lobby(raw: bytes | str) -> Lobby:
+    return _decode(raw, {1: _lobby_from_row_v1, 2: _lobby_from_row}, Lobby.from_dict)
@@ -0,0 +1,187 @@
+"""
+Хранилище состояний диалогов aiogram (FSM): кэш в памяти процесса поверх Redis.
+
+Ключи и формат значений те же, что у RedisStorage aiogram (fsm:<чат>:<пользователь>:state и :data),
+поэтому хранилища можно менять без потери состояний. Чтения идут из кэша, в Redis - только при промахе.
+Записи сразу попадают в кэш и уходят в Redis одной пачкой раз в write_behind_ms (0 - при каждой записи),
+при остановке бота неотправленные записи дописываются. Запись продлевает время жизни ключа на ttl секунд
+(0 - без срока), поэтому состояния брошенных диалогов удаляются сами.
+
+Согласованность между процессами - как у кэша лобби (TrackedCache): запись другого процесса
+сбрасывает ключ в кэше через инвалидацию Redis. Пока записи копятся для отправки, другие процессы
+видят в Redis предыдущее состояние. Когда кэш выключен (нет подписки на инвалидации), записи идут в Redis сразу.
+"""
+import asyncio
+import contextvars
+import json
+from typing import Any, Dict
+
+import redis.asyncio as redis
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from storage.tracked_cache import TrackedCache
+from utils.metrics import observe_redis
+
+# Значение в кэше для ключа, которого нет в Redis (None в TrackedCache - промах)
+_MISSING = ""
+
+
+class FsmCache(TrackedCache):
+    """
+    Кэш значений ключей состояний. Инвалидация, которую Redis присылает в ответ на запись этого же процесса,
+    ключ не сбрасывает: для каждого ключа считается, сколько таких инвалидаций еще должно прийти.
+    Инвалидации приходят в порядке записей, поэтому запись другого процесса после нашей все равно сбросит ключ.
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__(max_size, "Кэш состояний диалогов")
+        self._own_writes: Dict[str, int] = {}
+
+    def set(self, key: str, value: str) -> None:
+        """Запись этого процесса: начатые раньше чтения уже не положат в кэш старое значение."""
+        self.epoch += 1
+        self.put(key, value, self.epoch)
+
+    def expect_invalidation(self, key: str) -> None:
+        if self.enabled:
+            self._own_writes[key] = self._own_writes.get(key, 0) + 1
+
+    def cancel_invalidation(self, key: str) -> None:
+        """Запись не изменила ключ или не выполнена: инвалидации не будет, а значение в кэше под сомнением."""
+        self._consume(key)
+        super().invalidate(key)
+
+    def invalidate(self, key: str) -> None:
+        if not self._consume(key):
+            super().invalidate(key)
+
+    def clear(self) -> None:
+        self._own_writes.clear()
+        super().clear()
+
+    def _consume(self, key: str) -> bool:
+        pending = self._own_writes.pop(key, 0)
+        if pending > 1:
+            self._own_writes[key] = pending - 1
+        return pending > 0
+
+
+class HybridStorage(BaseStorage):
+    def __init__(self, client: redis.Redis, cache_size: int, ttl: int, write_behind_ms: int = 0,
+                 owns_client: bool = False, key_builder: KeyBuilder | None = None):
+        """owns_client=True - отдельный клиент (своя база или пул), хранилище закрывает его при остановке."""
+        self.redis = client
+        self.owns_client = owns_client
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.key_prefix = self.key_builder.prefix + self.key_builder.separator
+        self.ttl = ttl
+        self.write_behind = write_behind_ms / 1000
+        self.cache = FsmCache(cache_size)
+        # Записи, которые еще не отправлены в Redis: ключ Redis -> значение (None - удалить ключ)
+        self._dirty: Dict[str, str | None] = {}
+        self._flush_task: asyncio.Task | None = None
+        # Пачки отправляются по одной: иначе более старая запись ключа может дойти до Redis позже новой
+        self._flush_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        self.cache.start(self.redis, self.key_prefix)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self.cache.stop()
+        if self.owns_client:
+            await self.redis.aclose()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(self.key_builder.build(key, "state"), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self._read(self.key_builder.build(key, "state"))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(self.key_builder.build(key, "data"), json.dumps(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        # В кэше JSON, а не словарь: изменения полученного словаря не попадут в кэш
+        raw = await self._read(self.key_builder.build(key, "data"))
+        return json.loads(raw) if raw else {}
+
+    async def _read(self, redis_key: str) -> str | None:
+        if redis_key in self._dirty:
+            return self._dirty[redis_key]
+        cache_key = redis_key[len(self.key_prefix):]
+        value = self.cache.get(cache_key)
+        if value is not None:
+            return value or None
+        epoch = self.cache.epoch
+        raw = await self._get(redis_key)
+        value = raw.decode() if raw is not None else None
+        self.cache.put(cache_key, value or _MISSING, epoch)
+        return value
+
+    @observe_redis("fsm_get")
+    async def _get(self, redis_key: str) -> bytes | None:
+        return await self.redis.get(redis_key)
+
+    async def _write(self, redis_key: str, value: str | None) -> None:
+        cache_key = redis_key[len(self.key_prefix):]
+        # Удаление ключа, которого и так нет (обычное при выходе из диалога без данных), - без запроса к Redis
+        if value is None and redis_key not in self._dirty and self.cache.get(cache_key) == _MISSING:
+            return
+        self.cache.set(cache_key, value or _MISSING)
+        if self.write_behind > 0 and self.cache.enabled:
+            self._dirty[redis_key] = value
+            if self._flush_task is None:
+                # Отправка живет дольше апдейта и не должна наследовать его контекст (дерево вызовов)
+                self._flush_task = asyncio.create_task(self._flush_later(), context=contextvars.Context())
+            return
+        await self._send({redis_key: value})
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.write_behind)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Не удалось сохранить состояния диалогов: {e}")
+            if self._dirty and self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Отправляет в Redis накопленные записи."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            writes, self._dirty = self._dirty, {}
+            try:
+                await self._send(writes)
+            except Exception:
+                # Записи, которые не перезаписали за время отправки, уйдут со следующей пачкой
+                for key, value in writes.items():
+                    self._dirty.setdefault(key, value)
+                raise
+
+    @observe_redis("fsm_write")
+    async def _send(self, writes: Dict[str, str | None]) -> None:
+        for key in writes:
+            self.cache.expect_invalidation(key[len(self.key_prefix):])
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, value in writes.items():
+                    if value is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, value, ex=self.ttl or None)
+                results = await pipe.execute()
+        except Exception:
+            for key in writes:
+                self.cache.cancel_invalidation(key[len(self.key_prefix):])
+            raise
+        for (key, value), deleted in zip(writes.items(), results):
+            # DEL отсутствующего ключа инвалидацию не присылает
+            if value is None and not deleted:
+                self.cache.cancel_invalidation(key[len(self.key_prefix):])
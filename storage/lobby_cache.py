@@ -0,0 +1,20 @@
+from models.lobby import Lobby
+from storage.tracked_cache import TrackedCache
+
+
+class LobbyCache(TrackedCache):
+    """
+    LRU-кэш декодированных лобби в памяти процесса по коду лобби (см. TrackedCache).
+
+    Объекты лобби общие для всех читателей: изменять их можно только с последующей
+    записью через репозиторий, которая сбрасывает запись в кэше.
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__(max_size, "Кэш лобби")
+
+    def get(self, code: str) -> Lobby | None:
+        return super().get(code)
+
+    def put(self, code: str, lobby: Lobby, epoch: int) -> None:
+        super().put(code, lobby, epoch)
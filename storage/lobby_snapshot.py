@@ -0,0 +1,33 @@
+from models.error import BadResponse
+from models.lobby import Lobby
+from storage.redis_repository import get_lobby_by_user
+from utils.tracing import traced
+
+
+class LobbySnapshot:
+    """Лобби пользователя в рамках одного апдейта: читается из Redis не больше одного раза."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._lobby: Lobby | BadResponse | None = None
+
+    async def get(self) -> Lobby | BadResponse:
+        if self._lobby is None:
+            self._lobby = await get_lobby_by_user(self.user_id)
+        return self._lobby
+
+    def set(self, lobby: Lobby | BadResponse) -> None:
+        """Подменяет снимок результатом записи, сделанной в этом же апдейте."""
+        self._lobby = lobby
+
+    def invalidate(self) -> None:
+        """Сбрасывает снимок: следующее обращение перечитает лобби из Redis."""
+        self._lobby = None
+
+
+@traced()
+async def load_lobby(user_id: int, snapshot: LobbySnapshot | None = None) -> Lobby | BadResponse:
+    """Возвращает лобби пользователя из снимка апдейта, а без снимка - напрямую из Redis."""
+    if snapshot is not None and snapshot.user_id == user_id:
+        return await snapshot.get()
+    return await get_lobby_by_user(user_id)
@@ -0,0 +1,85 @@
+"""
+Подключения к Redis с настройками из config.py.
+
+Пул ограничен REDIS_MAX_CONNECTIONS: когда все соединения заняты, запрос ждет свободное
+не дольше REDIS_POOL_TIMEOUT вместо открытия новых соединений без ограничения.
+Соединение, простаивавшее дольше REDIS_HEALTH_CHECK_INTERVAL, перед запросом проверяется PING.
+Команда повторяется REDIS_RETRIES раз с экспоненциальной задержкой со случайной добавкой, только если
+она не дошла до Redis: не удалось подключиться или соединение не прошло проверку. Таймаут и обрыв после
+отправки не повторяются: скрипты лобби, XADD и пачки команд не идемпотентны и могли уже выполниться.
+"""
+import asyncio
+
+import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialWithJitterBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+
+
+class CommandNotSentError(ConnectionError):
+    """Команда не отправлена в Redis: ее можно безопасно повторить."""
+
+
+class _Connection(redis.Connection):
+    """
+    Неудачное подключение повторяется внутри connect(), неудачная проверка PING - повтором всей команды.
+    Ошибки после начала отправки команды не повторяются.
+    """
+
+    async def _connect(self) -> None:
+        try:
+            await super()._connect()
+        except asyncio.TimeoutError as e:
+            raise CommandNotSentError("Timeout connecting to server") from e
+        except OSError as e:
+            raise CommandNotSentError(self._error_message(e)) from e
+
+    async def send_packed_command(self, command, check_health: bool = True) -> None:
+        if not self.is_connected:
+            await self.connect_check_health(check_health=False)
+        if check_health:
+            try:
+                await self.check_health()
+            except (ConnectionError, TimeoutError) as e:
+                raise CommandNotSentError(str(e)) from e
+        await super().send_packed_command(command, check_health=False)
+
+from config import REDIS_DB, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT, \
+    REDIS_RETRIES, REDIS_BACKOFF_BASE_MS, REDIS_BACKOFF_CAP_MS, REDIS_HEALTH_CHECK_INTERVAL
+
+
+class _BlockingPool(redis.BlockingConnectionPool):
+    """
+    Ожидание свободного соединения привязано к циклу событий, в котором пул начал ждать.
+    После закрытия пул снова можно использовать в другом цикле (новый asyncio.run или дочерний процесс).
+    """
+
+    async def disconnect(self, inuse_connections: bool = True) -> None:
+        await super().disconnect(inuse_connections)
+        self._condition = asyncio.Condition()
+
+
+def create_redis(host: str, port: int, db: int = REDIS_DB) -> redis.Redis:
+    pool = _BlockingPool(
+        host=host,
+        port=port,
+        db=db,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        connection_class=_Connection,
+        retry=Retry(ExponentialWithJitterBackoff(cap=REDIS_BACKOFF_CAP_MS / 1000, base=REDIS_BACKOFF_BASE_MS / 1000),
+                    REDIS_RETRIES, supported_errors=(CommandNotSentError,)),
+    )
+    # Клиент владеет пулом: aclose() закрывает и соединения пула
+    return redis.Redis.from_pool(pool)
+
+
+def pool_stats(client: redis.Redis) -> dict:
+    pool = client.connection_pool
+    return {"max_connections": pool.max_connections,
+            "in_use": len(pool._in_use_connections),
+            "available": len(pool._available_connections)}
@@ -1,20 +1,564 @@
+import asyncio
 import json
+import random
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
 
-import redis.asyncio as redis
+from redis.exceptions import ResponseError
 
-from config import REDIS_HOST, REDIS_PORT
-from models.error import BadResponse, NOT_FOUND_ERROR, BAD_REQUEST, INTERNAL_ERROR
+from config import REDIS_HOST, REDIS_PORT, REDIS_REPLICA_HOST, REDIS_REPLICA_PORT, LOBBY_CACHE_SIZE, LOBBY_LOCK_TTL_MS, LOBBY_LOCK_WAIT_MS, \
+    LOBBY_TTL_SECONDS, LOBBY_SWEEP_INTERVAL, LOBBY_SWEEP_BATCH, LOBBY_EVENTS_MAX
+from models.error import BadResponse, NOT_FOUND_ERROR, BAD_REQUEST, INTERNAL_ERROR, ALREADY_EXISTS, CONFLICT
 from models.lobby import Lobby, Player
+from models.scenario import Scenario
+from storage.codec import encode_player, decode_player, encode_bunker, decode_bunker, decode_lobby
+from storage.lobby_cache import LobbyCache
+from storage.redis_connection import create_redis
+from utils.metrics import observe_redis
+from utils.scenario_loader import parse_scenario, register_scenario
 
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# Ответы не декодируются: записи игроков хранятся в бинарном формате (см. storage/codec.py)
+redis_client = create_redis(REDIS_HOST, REDIS_PORT)
+# Чтения лобби, для которых допустимо небольшое отставание, идут в реплику, если она задана.
+# Изменения лобби и чтения под блокировкой всегда идут в основной Redis
+redis_reader = create_redis(REDIS_REPLICA_HOST, REDIS_REPLICA_PORT) if REDIS_REPLICA_HOST else redis_client
+lobby_cache = LobbyCache(max_size=LOBBY_CACHE_SIZE)
 
 LOBBY_KEY_PREFIX = "lobby:"
 USER_LOBBY_PREFIX = "user_lobby:"
+SCENARIO_KEY_PREFIX = "scenario:"
+# Ключи блокировок не начинаются с LOBBY_KEY_PREFIX, чтобы не сбрасывать кэш лобби
+LOBBY_LOCK_PREFIX = "lock:lobby:"
+# Общий счетчик токенов блокировок: токены только растут, поэтому ключ не нужно чистить
+LOCK_FENCE_KEY = "lock:fence"
+# Реестр активных лобби: код -> время последнего изменения. По нему сборщик находит заброшенные лобби
+ACTIVE_LOBBIES_KEY = "lobbies:active"
+# Ключи лобби живут дольше LOBBY_TTL_SECONDS на случай, если сборщик не запущен:
+# тогда их удалит сам Redis, а реестр почистит следующий запуск сборщика
+LOBBY_KEY_GRACE_SECONDS = 3600
+# Журнал изменений лобби (поток events:lobby:<код>, см. get_lobby_events). Ключ не начинается
+# с LOBBY_KEY_PREFIX, чтобы запись в журнал не сбрасывала кэш лобби
+LOBBY_EVENTS_PREFIX = "events:" + LOBBY_KEY_PREFIX
+# Тип события изменения полей лобби, если действие не назвало себя
+UPDATE_EVENT = "update"
+# Сообщение живой доски игрока (board:<id> -> код лобби и id сообщения)
+BOARD_KEY_PREFIX = "board:"
 
+# Лобби хранится в хэше lobby:<код>, каждый игрок - в отдельном поле,
+# чтобы вход, выход и раскрытие карты перезаписывали только запись одного игрока.
+OWNER_FIELD = "owner"
+STARTED_FIELD = "started"
+BUNKER_FIELD = "bunker"
+SEQ_FIELD = "seq"
+# Увеличивается при каждом изменении лобби, по нему кэшируется отрисовка (services/render_service.py)
+VERSION_FIELD = "version"
+# Токен последней блокировки, под которой изменялось лобби
+FENCE_FIELD = "fence"
+# Время последнего продления ссылок user_lobby всех игроков лобби (см. touch)
+LINKS_AT_FIELD = "links_at"
+PLAYER_FIELD_PREFIX = "player:"
+JOINED_FIELD_PREFIX = "joined:"
+
+
+# Изменения состава лобби выполняются атомарно на стороне Redis за один запрос,
+# поэтому одновременные входы в одно лобби не теряются.
+# Во всех скриптах ARGV[1] - текущее время (с), ARGV[2] - время жизни ключей лобби (с),
+# ARGV[3] - длина журнала, после которой он сжимается, последний ключ - реестр активных лобби.
+# Каждое изменение продлевает жизнь лобби, его журнала и ссылки user_lobby игрока, который его сделал,
+# и добавляет событие в журнал лобби.
+_LOBBY_LUA_HELPERS = """
+-- Событие: тип, затем пары поле/значение хэша лобби после изменения (у входа и выхода еще и id игрока).
+-- Длинный журнал заменяется снимком лобби: событие snapshot со всеми полями хэша
+local function append_event(lobby_key, event)
+    local events_key = 'events:' .. lobby_key
+    redis.call('XADD', events_key, '*', unpack(event))
+    if redis.call('XLEN', events_key) > tonumber(ARGV[3]) then
+        local data = redis.call('HGETALL', lobby_key)
+        if #data > 0 then
+            table.insert(data, 1, 'type')
+            table.insert(data, 2, 'snapshot')
+            local id = redis.call('XADD', events_key, '*', unpack(data))
+            redis.call('XTRIM', events_key, 'MINID', id)
+        end
+    end
+end
+
+-- user_key - ссылка user_lobby игрока, сделавшего изменение (nil - нет такой ссылки)
+local function touch(lobby_key, active_key, code, user_key)
+    if redis.call('EXISTS', lobby_key) == 0 then
+        redis.call('ZREM', active_key, code)
+        return
+    end
+    redis.call('ZADD', active_key, ARGV[1], code)
+    redis.call('EXPIRE', lobby_key, ARGV[2])
+    redis.call('EXPIRE', 'events:' .. lobby_key, ARGV[2])
+    if user_key then redis.call('EXPIRE', user_key, ARGV[2]) end
+    -- Ссылки остальных игроков продлеваются не чаще раза в половину времени жизни ключей:
+    -- этого хватает, чтобы ссылка молчащего игрока не истекла, пока лобби живо
+    local refreshed = tonumber(redis.call('HGET', lobby_key, 'links_at') or '0')
+    if tonumber(ARGV[1]) - refreshed < tonumber(ARGV[2]) / 2 then return end
+    redis.call('HSET', lobby_key, 'links_at', ARGV[1])
+    for _, field in ipairs(redis.call('HKEYS', lobby_key)) do
+        if string.sub(field, 1, 7) == 'joined:' then
+            redis.call('EXPIRE', 'user_lobby:' .. string.sub(field, 8), ARGV[2])
+        end
+    end
+end
+
+-- Код лобби пользователя (JSON); ссылка на уже удаленное лобби не мешает войти в другое
+local function current_lobby(user_key)
+    local current = redis.call('GET', user_key)
+    if current and redis.call('EXISTS', 'lobby:' .. cjson.decode(current)) == 0 then
+        redis.call('DEL', user_key)
+        return nil
+    end
+    return current
+end
+"""
+
+# KEYS: хэш лобби, user_lobby:<id>, реестр. ARGV[4..]: id пользователя, запись игрока, код лобби (JSON), код лобби
+_JOIN_LOBBY_LUA = _LOBBY_LUA_HELPERS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {'not_found'} end
+local current = current_lobby(KEYS[2])
+if current then
+    if current == ARGV[6] then return {'already_joined'} end
+    return {'in_other_lobby'}
+end
+local seq = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+redis.call('HSET', KEYS[1], 'player:' .. ARGV[4], ARGV[5], 'joined:' .. ARGV[4], seq)
+redis.call('SET', KEYS[2], ARGV[6])
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+append_event(KEYS[1], {'type', 'join', 'user', ARGV[4], 'player:' .. ARGV[4], ARGV[5], 'joined:' .. ARGV[4], seq,
+                       'seq', seq, 'version', version})
+touch(KEYS[1], KEYS[3], ARGV[7], KEYS[2])
+local data = redis.call('HGETALL', KEYS[1])
+table.insert(data, 1, 'ok')
+return data
+"""
+
+# KEYS: хэш лобби, user_lobby:<id>, реестр. ARGV[4..]: id пользователя, код лобби (JSON), код лобби
+_LEAVE_LOBBY_LUA = _LOBBY_LUA_HELPERS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if redis.call('GET', KEYS[2]) == ARGV[5] then redis.call('DEL', KEYS[2]) end
+    return {'not_found'}
+end
+local current = redis.call('GET', KEYS[2])
+if not current then return {'not_in_lobby'} end
+if current ~= ARGV[5] then return {'in_other_lobby'} end
+redis.call('HDEL', KEYS[1], 'player:' .. ARGV[4], 'joined:' .. ARGV[4])
+redis.call('DEL', KEYS[2])
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+local event = {'type', 'leave', 'user', ARGV[4], 'version', version}
+local data = redis.call('HGETALL', KEYS[1])
+local owner_index, next_owner, first_seq
+for i = 1, #data, 2 do
+    if data[i] == 'owner' then
+        owner_index = i + 1
+    elseif string.sub(data[i], 1, 7) == 'joined:' then
+        local seq = tonumber(data[i + 1])
+        if first_seq == nil or seq < first_seq then
+            first_seq = seq
+            next_owner = string.sub(data[i], 8)
+        end
+    end
+end
+if next_owner == nil then
+    -- Журнал последнего лобби остается до истечения его времени жизни
+    redis.call('DEL', KEYS[1])
+    append_event(KEYS[1], {'type', 'leave', 'user', ARGV[4], 'deleted', '1'})
+else
+    if data[owner_index] == ARGV[4] then
+        redis.call('HSET', KEYS[1], 'owner', next_owner)
+        data[owner_index] = next_owner
+        table.insert(event, 'owner')
+        table.insert(event, next_owner)
+    end
+    append_event(KEYS[1], event)
+end
+touch(KEYS[1], KEYS[3], ARGV[6])
+table.insert(data, 1, 'ok')
+return data
+"""
+
+# KEYS: хэш лобби, user_lobby:<id>, реестр. ARGV[4..]: код лобби (JSON), код лобби, затем пары поле/значение хэша
+_CREATE_LOBBY_LUA = _LOBBY_LUA_HELPERS + """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 'exists' end
+if current_lobby(KEYS[2]) then return 'in_other_lobby' end
+redis.call('HSET', KEYS[1], unpack(ARGV, 6))
+redis.call('SET', KEYS[2], ARGV[4])
+-- Код лобби мог принадлежать удаленному лобби, журнал которого еще хранится
+redis.call('DEL', 'events:' .. KEYS[1])
+append_event(KEYS[1], {'type', 'create', unpack(ARGV, 6)})
+touch(KEYS[1], KEYS[3], ARGV[5], KEYS[2])
+return 'ok'
+"""
+
+# KEYS: хэш лобби, реестр. ARGV[4..]: токен блокировки (0 - без проверки), код лобби, тип события,
+# затем пары поле/значение. Запись с токеном меньше уже записанного отклоняется: блокировка этого
+# процесса истекла, и лобби успел изменить следующий владелец блокировки.
+# Вход и выход идут без блокировки, поэтому запись игрока, который уже вышел, пропускается,
+# а владелец этим скриптом не записывается (его меняет только выход).
+# Возвращает хэш лобби после записи: в нем только игроки, которые действительно остались в лобби.
+_WRITE_LOBBY_LUA = _LOBBY_LUA_HELPERS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {'not_found'} end
+local fence = tonumber(ARGV[4])
+if fence > 0 then
+    local current = tonumber(redis.call('HGET', KEYS[1], 'fence') or '0')
+    if current > fence then return {'conflict'} end
+    redis.call('HSET', KEYS[1], 'fence', fence)
+end
+local fields = {}
+for i = 7, #ARGV, 2 do
+    local field = ARGV[i]
+    local keep = field ~= 'owner'
+    if string.sub(field, 1, 7) == 'player:' then
+        local user_id = string.sub(field, 8)
+        keep = redis.call('HEXISTS', KEYS[1], 'joined:' .. user_id) == 1
+        -- Запись игрока меняет его собственное действие (раскрытие карты), поэтому продлевается его ссылка
+        if keep then redis.call('EXPIRE', 'user_lobby:' .. user_id, ARGV[2]) end
+    end
+    if keep then
+        table.insert(fields, field)
+        table.insert(fields, ARGV[i + 1])
+    end
+end
+if #fields > 0 then
+    redis.call('HSET', KEYS[1], unpack(fields))
+    local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+    local event = {'type', ARGV[6], unpack(fields)}
+    table.insert(event, 'version')
+    table.insert(event, version)
+    append_event(KEYS[1], event)
+    touch(KEYS[1], KEYS[2], ARGV[5])
+end
+local data = redis.call('HGETALL', KEYS[1])
+table.insert(data, 1, 'ok')
+return data
+"""
+
+# KEYS: хэш лобби, реестр. ARGV: граница активности (с), код лобби (JSON), код лобби.
+# Удаляет лобби без изменений с момента границы, его журнал и ссылки user_lobby, которые еще указывают на него.
+_REAP_LOBBY_LUA = """
+local score = redis.call('ZSCORE', KEYS[2], ARGV[3])
+if score and tonumber(score) > tonumber(ARGV[1]) then return 0 end
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(field, 1, 7) == 'joined:' then
+        local user_key = 'user_lobby:' .. string.sub(field, 8)
+        if redis.call('GET', user_key) == ARGV[2] then redis.call('DEL', user_key) end
+    end
+end
+redis.call('DEL', KEYS[1], 'events:' .. KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[3])
+return 1
+"""
+
+# ARGV: коды лобби. Возвращает, сколько из них еще существует и сколько в них игроков
+_COUNT_PLAYERS_LUA = """
+local lobbies, players = 0, 0
+for _, code in ipairs(ARGV) do
+    local fields = redis.call('HKEYS', 'lobby:' .. code)
+    if #fields > 0 then lobbies = lobbies + 1 end
+    for _, field in ipairs(fields) do
+        if string.sub(field, 1, 7) == 'joined:' then players = players + 1 end
+    end
+end
+return {lobbies, players}
+"""
+
+# Перевод лобби из старого формата. KEYS: ключ лобби, журнал лобби, реестр.
+# ARGV: время, время жизни ключей, лобби в старом формате (JSON), код, затем пары поле/значение хэша.
+# Если ключ уже не та строка, которую прочитал процесс (лобби перевел другой процесс), ничего не делает
+_MIGRATE_LOBBY_LUA = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' or redis.call('GET', KEYS[1]) ~= ARGV[3] then return 0 end
+local fields = {unpack(ARGV, 5)}
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(fields))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+-- Журнал лобби начинается со снимка
+redis.call('XADD', KEYS[2], '*', 'type', 'snapshot', unpack(fields))
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[1], ARGV[4])
+return 1
+"""
+
+# KEYS[1] - ключ блокировки, KEYS[2] - счетчик токенов. ARGV: время жизни блокировки, мс
+_ACQUIRE_LOCK_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+local fence = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], fence, 'PX', ARGV[1])
+return fence
+"""
+
+# KEYS[1] - ключ блокировки. ARGV: токен владельца
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+_join_lobby_script = redis_client.register_script(_JOIN_LOBBY_LUA)
+_leave_lobby_script = redis_client.register_script(_LEAVE_LOBBY_LUA)
+_create_lobby_script = redis_client.register_script(_CREATE_LOBBY_LUA)
+_write_lobby_script = redis_client.register_script(_WRITE_LOBBY_LUA)
+_reap_lobby_script = redis_client.register_script(_REAP_LOBBY_LUA)
+_migrate_lobby_script = redis_client.register_script(_MIGRATE_LOBBY_LUA)
+_count_players_script = redis_reader.register_script(_COUNT_PLAYERS_LUA)
+_acquire_lock_script = redis_client.register_script(_ACQUIRE_LOCK_LUA)
+_release_lock_script = redis_client.register_script(_RELEASE_LOCK_LUA)
+
+
+@dataclass(slots=True)
+class LobbyLock:
+    code: str
+    fence: int
+    local: asyncio.Lock
+
+
+# Задачи одного процесса сначала встают в очередь на локальную блокировку, чтобы к Redis
+# за блокировкой лобби обращалась только одна из них. Запись удаляется, когда блокировка никому не нужна.
+_local_lobby_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+def _player_field(user_id: int) -> str:
+    return PLAYER_FIELD_PREFIX + str(user_id)
+
+
+def _joined_field(user_id: int) -> str:
+    return JOINED_FIELD_PREFIX + str(user_id)
+
+
+def _dump_player(player: Player) -> bytes:
+    return encode_player(player)
+
+
+def _meta_fields(lobby: Lobby) -> dict:
+    """Общие поля лобби, которые меняются под блокировкой. Владельца меняет только выход игрока."""
+    return {STARTED_FIELD: int(lobby.started),
+            BUNKER_FIELD: encode_bunker(lobby.bunker) if lobby.bunker else b""}
+
+
+def _key_ttl() -> int:
+    return LOBBY_TTL_SECONDS + LOBBY_KEY_GRACE_SECONDS
+
+
+def _activity_args() -> list:
+    """Общие аргументы скриптов лобби: текущее время, время жизни ключей и длина журнала до сжатия."""
+    return [time.time(), _key_ttl(), LOBBY_EVENTS_MAX]
+
+
+def _lobby_fields(lobby: Lobby) -> dict:
+    """Полный набор полей хэша для лобби (используется при создании и миграции)."""
+    fields = _meta_fields(lobby)
+    fields[OWNER_FIELD] = lobby.owner.user_id
+    fields[SEQ_FIELD] = len(lobby.players)
+    fields[VERSION_FIELD] = lobby.version = 1
+    for seq, player in enumerate(lobby.players, start=1):
+        fields[_player_field(player.user_id)] = _dump_player(player)
+        fields[_joined_field(player.user_id)] = seq
+    return fields
+
+
+_PLAYER_FIELD_BYTES = PLAYER_FIELD_PREFIX.encode()
+_JOINED_FIELD_BYTES = JOINED_FIELD_PREFIX.encode()
+
+
+def _lobby_from_hash(code: str, data: dict) -> Lobby:
+    joined = {}
+    players = []
+    for field, value in data.items():
+        if field.startswith(_PLAYER_FIELD_BYTES):
+            players.append(decode_player(value))
+        elif field.startswith(_JOINED_FIELD_BYTES):
+            joined[int(field[len(_JOINED_FIELD_BYTES):])] = int(value)
+    players.sort(key=lambda p: joined.get(p.user_id, 0))
+
+    owner_id = int(data[OWNER_FIELD.encode()])
+    owner = next((p for p in players if p.user_id == owner_id), None) or Player(user_id=owner_id, username="", cards=None)
+    bunker = data.get(BUNKER_FIELD.encode())
+
+    return Lobby(code=code,
+                 owner=owner,
+                 players=players,
+                 started=data.get(STARTED_FIELD.encode()) == b"1",
+                 bunker=decode_bunker(bunker) if bunker else None,
+                 version=int(data.get(VERSION_FIELD.encode(), 0)))
+
+
+async def _migrate_legacy_lobby(code: str) -> Lobby | None:
+    """
+    Переводит лобби из старого формата (JSON-строка целиком) в хэш. Одновременные переводы одного лобби
+    не мешают друг другу: переводит один процесс, остальные читают уже переведенное лобби.
+    """
+    key = LOBBY_KEY_PREFIX + code
+    try:
+        raw = await redis_client.get(key)
+    except ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            raise
+        raw = b""
+    if raw is None:
+        return None
+    if raw:
+        lobby = decode_lobby(raw)
+        fields = _lobby_fields(lobby)
+        migrated = await _migrate_lobby_script(
+            keys=[key, LOBBY_EVENTS_PREFIX + code, ACTIVE_LOBBIES_KEY],
+            args=[time.time(), _key_ttl(), raw, code,
+                  *(item for pair in fields.items() for item in pair)])
+        if migrated:
+            return lobby
+    # Лобби уже перевел другой процесс
+    data = await redis_client.hgetall(key)
+    return _lobby_from_hash(code, data) if data else None
+
+
+async def migrate_legacy_lobbies() -> int:
+    """Разовая миграция всех лобби старого формата. Возвращает количество переведенных лобби."""
+    migrated = 0
+    async for key in redis_client.scan_iter(match=LOBBY_KEY_PREFIX + "*", _type="string"):
+        if await _migrate_legacy_lobby(key.decode()[len(LOBBY_KEY_PREFIX):]):
+            migrated += 1
+    return migrated
+
+
+async def start_lobby_cache() -> None:
+    """
+    Запускает подписку на инвалидации, без нее кэш лобби не используется.
+    Подписка идет к тому же серверу, из которого читаются лобби: инвалидация с реплики приходит
+    только после того, как изменение до нее дошло, поэтому в кэш не попадет устаревшая копия.
+    """
+    lobby_cache.start(redis_reader, LOBBY_KEY_PREFIX)
+
+
+async def stop_lobby_cache() -> None:
+    await lobby_cache.stop()
+
+
+async def close_redis() -> None:
+    if redis_reader is not redis_client:
+        await redis_reader.aclose()
+    await redis_client.aclose()
+
+
+@observe_redis("sweep_lobbies")
+async def sweep_lobbies(now: float | None = None) -> int:
+    """Удаляет лобби, не изменявшиеся дольше LOBBY_TTL_SECONDS. Возвращает количество удаленных лобби."""
+    deadline = (time.time() if now is None else now) - LOBBY_TTL_SECONDS
+    removed = 0
+    while True:
+        codes = await redis_client.zrangebyscore(ACTIVE_LOBBIES_KEY, "-inf", deadline, start=0, num=LOBBY_SWEEP_BATCH)
+        if not codes:
+            return removed
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for code in codes:
+                code = code.decode()
+                await _reap_lobby_script(keys=[LOBBY_KEY_PREFIX + code, ACTIVE_LOBBIES_KEY],
+                                         args=[deadline, json.dumps(code), code], client=pipe)
+            results = await pipe.execute()
+        for code in codes:
+            lobby_cache.invalidate(code.decode())
+        removed += sum(results)
+        # Лобби, которое успело измениться, остается в реестре с новым временем и в выборку больше не попадет
+        if len(codes) < LOBBY_SWEEP_BATCH:
+            return removed
+
+
+async def _sweep(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await sweep_lobbies()
+            if removed:
+                print(f"Удалено неактивных лобби: {removed}")
+        except Exception as e:
+            print(f"Ошибка при удалении неактивных лобби: {e}")
+
+
+_sweeper: asyncio.Task | None = None
+
+
+async def start_lobby_sweeper() -> None:
+    global _sweeper
+    if LOBBY_SWEEP_INTERVAL > 0 and _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep(LOBBY_SWEEP_INTERVAL))
+
+
+async def stop_lobby_sweeper() -> None:
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
+
+
+async def delete_lobbies(codes: Iterable[str], user_ids: Iterable[int] = ()) -> None:
+    """
+    Удаляет лобби целиком: хэши, журналы, блокировки, записи реестра активных лобби, а также ссылки
+    user_lobby и доски игроков user_ids (для нагрузочных тестов и обслуживания).
+    """
+    codes = list(codes)
+    keys = [prefix + code for code in codes for prefix in (LOBBY_KEY_PREFIX, LOBBY_EVENTS_PREFIX, LOBBY_LOCK_PREFIX)]
+    keys += [prefix + str(user_id) for user_id in user_ids for prefix in (USER_LOBBY_PREFIX, BOARD_KEY_PREFIX)]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        if keys:
+            pipe.delete(*keys)
+        if codes:
+            pipe.zrem(ACTIVE_LOBBIES_KEY, *codes)
+        await pipe.execute()
+    for code in codes:
+        lobby_cache.invalidate(code)
+
+
+@observe_redis("count_lobby_players")
+async def count_lobby_players() -> Tuple[int, int]:
+    """
+    Число лобби реестра активных лобби, которые еще существуют, и игроков в них (для метрик).
+    Считается по самим хэшам лобби пачками по LOBBY_SWEEP_BATCH, поэтому не расходится с ними,
+    как бы лобби ни было удалено.
+    """
+    lobbies = players = 0
+    start = 0
+    while True:
+        codes = await redis_reader.zrange(ACTIVE_LOBBIES_KEY, start, start + LOBBY_SWEEP_BATCH - 1)
+        if codes:
+            counted = await _count_players_script(args=codes)
+            lobbies += counted[0]
+            players += counted[1]
+        if len(codes) < LOBBY_SWEEP_BATCH:
+            return lobbies, players
+        start += LOBBY_SWEEP_BATCH
+
+
+async def backfill_active_lobbies() -> int:
+    """
+    Разовое заполнение реестра активных лобби для лобби, созданных до его появления.
+    Их время активности считается текущим, ключам лобби и ссылкам игроков задается время жизни.
+    Возвращает количество добавленных лобби.
+    """
+    added = 0
+    now = time.time()
+    async for key in redis_client.scan_iter(match=LOBBY_KEY_PREFIX + "*", _type="hash"):
+        code = key.decode()[len(LOBBY_KEY_PREFIX):]
+        if await redis_client.zadd(ACTIVE_LOBBIES_KEY, {code: now}, nx=True):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.expire(key, _key_ttl())
+                for field in await redis_client.hkeys(key):
+                    if field.startswith(_JOINED_FIELD_BYTES):
+                        pipe.expire(USER_LOBBY_PREFIX + field[len(_JOINED_FIELD_BYTES):].decode(), _key_ttl())
+                await pipe.execute()
+            added += 1
+    return added
+
+
+@observe_redis("get_user_lobby_code")
 async def get_user_lobby_code(user_id: int) -> str | BadResponse:
     """Получает код лобби, в котором находится пользователь."""
     try:
-        raw = await redis_client.get(USER_LOBBY_PREFIX + str(user_id))
+        raw = await redis_reader.get(USER_LOBBY_PREFIX + str(user_id))
         if raw is None:
             return BadResponse("Пользователь не состоит в лобби", NOT_FOUND_ERROR)
         return json.loads(raw)
@@ -22,13 +566,71 @@ async def get_user_lobby_code(user_id: int) -> str | BadResponse:
         return BadResponse(str(e), INTERNAL_ERROR)
 
 
-async def get_lobby_by_code(code: str) -> Lobby | BadResponse:
-    """Получает объект лобби по коду."""
+@observe_redis("get_board_message")
+async def get_board_message(user_id: int) -> Tuple[str, int] | None | BadResponse:
+    """Код лобби и id сообщения живой доски игрока; None - доски нет."""
     try:
-        raw = await redis_client.get(LOBBY_KEY_PREFIX + code)
-        if raw is None:
+        data = await redis_client.hgetall(BOARD_KEY_PREFIX + str(user_id))
+        if not data:
+            return None
+        return data[b"code"].decode(), int(data[b"message_id"])
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
+
+
+@observe_redis("set_board_message")
+async def set_board_message(user_id: int, code: str, message_id: int) -> None | BadResponse:
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(BOARD_KEY_PREFIX + str(user_id), mapping={"code": code, "message_id": message_id})
+            pipe.expire(BOARD_KEY_PREFIX + str(user_id), _key_ttl())
+            await pipe.execute()
+        return None
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
+
+
+@observe_redis("delete_board_message")
+async def delete_board_message(user_id: int) -> None | BadResponse:
+    try:
+        await redis_client.delete(BOARD_KEY_PREFIX + str(user_id))
+        return None
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
+
+
+async def get_lobby_by_code(code: str, fresh: bool = False) -> Lobby | BadResponse:
+    """
+    Получает объект лобби по коду.
+
+    fresh=True - читать из основного Redis в обход кэша и реплики: под блокировкой лобби нужна
+    последняя версия, а инвалидация от другого процесса могла еще не дойти.
+    """
+    lobby = None if fresh else lobby_cache.get(code)
+    if lobby is not None:
+        return lobby
+    return await _read_lobby(code, fresh)
+
+
+# Попадания в кэш лобби не замеряются, чтобы метрика показывала время Redis
+@observe_redis("get_lobby_by_code")
+async def _read_lobby(code: str, fresh: bool) -> Lobby | BadResponse:
+    epoch = lobby_cache.epoch
+    try:
+        try:
+            data = await (redis_client if fresh else redis_reader).hgetall(LOBBY_KEY_PREFIX + code)
+        except ResponseError as e:
+            if "WRONGTYPE" not in str(e):
+                raise
+            lobby = await _migrate_legacy_lobby(code)
+            return lobby if lobby else BadResponse("Лобби не найдено", NOT_FOUND_ERROR)
+        if not data:
             return BadResponse("Лобби не найдено", NOT_FOUND_ERROR)
-        return Lobby.from_dict(json.loads(raw))
+        lobby = _lobby_from_hash(code, data)
+        # Свежее лобби читают, чтобы изменить, поэтому в общий кэш оно не кладется
+        if not fresh:
+            lobby_cache.put(code, lobby, epoch)
+        return lobby
     except Exception as e:
         return BadResponse(str(e), INTERNAL_ERROR)
 
@@ -41,76 +643,266 @@ async def get_lobby_by_user(user_id: int) -> Lobby | BadResponse:
     return await get_lobby_by_code(code)
 
 
-async def add_user_to_lobby(user_id: int, username: str, code: str) -> Lobby | BadResponse:
-    lobby = await get_lobby_by_code(code)
-    if isinstance(lobby, BadResponse):
-        return lobby
+@dataclass(slots=True)
+class LobbyEvent:
+    """Событие журнала лобби: поля хэша, записанные изменением (у выхода игрока - только версия и владелец)."""
+    id: str
+    type: str
+    fields: Dict[bytes, bytes]
+    user_id: int | None = None
+    deleted: bool = False
 
-    user_lobby = await get_user_lobby_code(user_id)
-    if not isinstance(user_lobby, BadResponse):
-        return BadResponse("Вы уже находитесь в другом лобби", BAD_REQUEST)
-    elif user_lobby == lobby.code:
-        return BadResponse("Вы уже присоединились к этому лобби", BAD_REQUEST)
+    @property
+    def time(self) -> float:
+        return int(self.id.split("-")[0]) / 1000
+
+    @property
+    def version(self) -> int | None:
+        version = self.fields.get(VERSION_FIELD.encode())
+        return int(version) if version is not None else None
+
+
+# Служебные поля события, которых нет в хэше лобби
+_EVENT_META_FIELDS = (b"type", b"user", b"deleted")
+# События, которые содержат лобби целиком
+SNAPSHOT_EVENTS = ("create", "snapshot")
 
-    lobby.players.append(Player(user_id=user_id, username=username, cards=None))
 
+def _lobby_event(entry_id: bytes, data: dict) -> LobbyEvent:
+    user = data.get(b"user")
+    return LobbyEvent(id=entry_id.decode(),
+                      type=data[b"type"].decode(),
+                      fields={field: value for field, value in data.items() if field not in _EVENT_META_FIELDS},
+                      user_id=int(user) if user is not None else None,
+                      deleted=b"deleted" in data)
+
+
+@observe_redis("get_lobby_events")
+async def get_lobby_events(code: str) -> List[LobbyEvent] | BadResponse:
+    """
+    Журнал изменений лобби от последнего сжатия. Каждое изменение лобби атомарно с записью в хэш
+    добавляет событие, поэтому по журналу можно восстановить лобби на любой версии (replay_lobby).
+    """
     try:
-        await redis_client.set(LOBBY_KEY_PREFIX + lobby.code, json.dumps(lobby.to_dict()))
-        await redis_client.set(USER_LOBBY_PREFIX + str(user_id), json.dumps(lobby.code))
+        entries = await redis_client.xrange(LOBBY_EVENTS_PREFIX + code)
     except Exception as e:
         return BadResponse(str(e), INTERNAL_ERROR)
+    return [_lobby_event(entry_id, data) for entry_id, data in entries]
+
+
+def fold_lobby_events(code: str, events: List[LobbyEvent], version: int | None = None) -> Lobby | None:
+    """
+    Применяет события к последнему снимку в журнале, как их применял Redis к хэшу лобби.
+    version - остановиться на этой версии лобби. None, если в журнале нет снимка или лобби удалено.
+    """
+    state = None
+    for event in events:
+        # У удаления лобби нет версии: оно идет после всех версий
+        if version is not None and (event.deleted or event.version is not None and event.version > version):
+            break
+        if event.type in SNAPSHOT_EVENTS:
+            state = dict(event.fields)
+        elif state is None:
+            continue
+        elif event.deleted:
+            state = {}
+        else:
+            if event.type == "leave":
+                state.pop(_player_field(event.user_id).encode(), None)
+                state.pop(_joined_field(event.user_id).encode(), None)
+            state.update(event.fields)
+    return _lobby_from_hash(code, state) if state else None
+
 
+async def replay_lobby(code: str, version: int | None = None) -> Lobby | BadResponse:
+    """Восстанавливает лобби по журналу: последнюю версию или версию version."""
+    events = await get_lobby_events(code)
+    if isinstance(events, BadResponse):
+        return events
+    lobby = fold_lobby_events(code, events, version)
+    if lobby is None:
+        return BadResponse("Журнал лобби не найден, неполон или лобби удалено", NOT_FOUND_ERROR)
     return lobby
 
 
+async def _run_lobby_script(script, code: str, user_id: int, args: list) -> list:
+    """Выполняет скрипт над лобби; лобби старого формата сначала переводится в хэш."""
+    keys = [LOBBY_KEY_PREFIX + code, USER_LOBBY_PREFIX + str(user_id), ACTIVE_LOBBIES_KEY]
+    args = _activity_args() + args + [code]
+    try:
+        return await script(keys=keys, args=args)
+    except ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            raise
+        await _migrate_legacy_lobby(code)
+        return await script(keys=keys, args=args)
+    finally:
+        lobby_cache.invalidate(code)
+
+
+def _pairs_to_dict(flat: list) -> dict:
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def _status(result: list | bytes) -> str:
+    return (result[0] if isinstance(result, list) else result).decode()
+
+
+@observe_redis("add_user_to_lobby")
+async def add_user_to_lobby(user_id: int, username: str, code: str) -> Lobby | BadResponse:
+    player = Player(user_id=user_id, username=username, cards=None)
+    try:
+        result = await _run_lobby_script(_join_lobby_script, code, user_id,
+                                         [user_id, _dump_player(player), json.dumps(code)])
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
+
+    status = _status(result)
+    if status == "not_found":
+        return BadResponse("Лобби не найдено", NOT_FOUND_ERROR)
+    if status == "already_joined":
+        return BadResponse("Вы уже присоединились к этому лобби", BAD_REQUEST)
+    if status == "in_other_lobby":
+        return BadResponse("Вы уже находитесь в другом лобби", BAD_REQUEST)
+    return _lobby_from_hash(code, _pairs_to_dict(result[1:]))
+
+
+@observe_redis("create_lobby_and_add_user")
 async def create_lobby_and_add_user(owner_id: int, lobby: Lobby) -> Lobby | BadResponse:
-    existing_lobby = await get_lobby_by_code(lobby.code)
-    if not isinstance(existing_lobby, BadResponse):
-        return BadResponse("Лобби с таким кодом уже существует", BAD_REQUEST)
+    fields = _lobby_fields(lobby)
+    args = _activity_args() + [json.dumps(lobby.code), lobby.code]
+    for field, value in fields.items():
+        args += [field, value]
 
     try:
-        await redis_client.set(LOBBY_KEY_PREFIX + lobby.code, json.dumps(lobby.to_dict()))
-        await redis_client.set(USER_LOBBY_PREFIX + str(owner_id), json.dumps(lobby.code))
+        status = await _create_lobby_script(keys=[LOBBY_KEY_PREFIX + lobby.code, USER_LOBBY_PREFIX + str(owner_id),
+                                                  ACTIVE_LOBBIES_KEY],
+                                            args=args)
     except Exception as e:
         return BadResponse(str(e), INTERNAL_ERROR)
 
+    status = _status(status)
+    if status == "exists":
+        return BadResponse("Лобби с таким кодом уже существует", ALREADY_EXISTS)
+    if status == "in_other_lobby":
+        return BadResponse("Вы уже находитесь в другом лобби", BAD_REQUEST)
     return lobby
 
 
+@observe_redis("remove_user_from_lobby")
 async def remove_user_from_lobby(user_id: int, code: str) -> Lobby | BadResponse:
-    lobby = await get_lobby_by_code(code)
-    if isinstance(lobby, BadResponse):
-        return lobby
-
-    user_lobby = await get_user_lobby_code(user_id)
-    if isinstance(user_lobby, BadResponse):
-        return user_lobby
+    try:
+        result = await _run_lobby_script(_leave_lobby_script, code, user_id, [user_id, json.dumps(code)])
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
 
-    if user_lobby != lobby.code:
+    status = _status(result)
+    if status == "not_found":
+        return BadResponse("Лобби не найдено", NOT_FOUND_ERROR)
+    if status == "not_in_lobby":
+        return BadResponse("Пользователь не состоит в лобби", NOT_FOUND_ERROR)
+    if status == "in_other_lobby":
         return BadResponse("Вы находитесь в другом лобби", BAD_REQUEST)
+    return _lobby_from_hash(code, _pairs_to_dict(result[1:]))
 
-    player_to_remove = next((p for p in lobby.players if p.user_id == user_id), None)
-    lobby.players.remove(player_to_remove)
 
-    if lobby.owner.user_id == user_id and len(lobby.players) > 0:
-        lobby.owner.user_id = lobby.players[0].user_id
+@observe_redis("acquire_lobby_lock")
+async def acquire_lobby_lock(code: str) -> LobbyLock | BadResponse:
+    """Захватывает блокировку лобби, ожидая ее освобождения не дольше LOBBY_LOCK_WAIT_MS."""
+    local = _local_lobby_locks.get(code)
+    if local is None:
+        local = _local_lobby_locks[code] = asyncio.Lock()
 
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LOBBY_LOCK_WAIT_MS / 1000
     try:
-        if len(lobby.players) == 0:
-            await redis_client.delete(LOBBY_KEY_PREFIX + code)
-        else:
-            await redis_client.set(LOBBY_KEY_PREFIX + lobby.code, json.dumps(lobby.to_dict()))
+        await asyncio.wait_for(local.acquire(), LOBBY_LOCK_WAIT_MS / 1000)
+    except asyncio.TimeoutError:
+        return BadResponse("Лобби занято, попробуйте еще раз", CONFLICT)
 
-        await redis_client.delete(USER_LOBBY_PREFIX + str(user_id), json.dumps(lobby.code))
+    try:
+        while True:
+            fence = await _acquire_lock_script(keys=[LOBBY_LOCK_PREFIX + code, LOCK_FENCE_KEY],
+                                               args=[LOBBY_LOCK_TTL_MS])
+            if fence:
+                return LobbyLock(code=code, fence=fence, local=local)
+            if loop.time() >= deadline:
+                local.release()
+                return BadResponse("Лобби занято, попробуйте еще раз", CONFLICT)
+            await asyncio.sleep(random.uniform(0.005, 0.02))
     except Exception as e:
+        local.release()
         return BadResponse(str(e), INTERNAL_ERROR)
 
-    return lobby
-
 
-async def update_lobby_info(lobby: Lobby) -> Lobby | BadResponse:
+@observe_redis("release_lobby_lock")
+async def release_lobby_lock(lock: LobbyLock) -> None:
     try:
-        await redis_client.set(LOBBY_KEY_PREFIX + lobby.code, json.dumps(lobby.to_dict()))
+        await _release_lock_script(keys=[LOBBY_LOCK_PREFIX + lock.code], args=[lock.fence])
+    except Exception as e:
+        # Блокировка освободится сама по истечении LOBBY_LOCK_TTL_MS
+        print(f"Не удалось освободить блокировку лобби {lock.code}: {e}")
+    finally:
+        lock.local.release()
+
+
+@observe_redis("save_lobby_changes")
+async def save_lobby_changes(lobby: Lobby, player_ids: Iterable[int], meta: bool,
+                             lock: LobbyLock | None = None, event: str = UPDATE_EVENT) -> Lobby | BadResponse:
+    """
+    Сохраняет одной записью общие поля лобби (если meta) и записи перечисленных игроков;
+    с блокировкой - только если она еще действительна. Записи игроков, которые успели выйти, пропускаются.
+    Возвращает лобби в том виде, в каком оно сохранено в Redis.
+    """
+    fields = _meta_fields(lobby) if meta else {}
+    players = {p.user_id: p for p in lobby.players}
+    for user_id in player_ids:
+        if user_id in players:
+            fields[_player_field(user_id)] = _dump_player(players[user_id])
+    if not fields:
         return lobby
+    args = _activity_args() + [lock.fence if lock else 0, lobby.code, event]
+    for field, value in fields.items():
+        args += [field, value]
+    try:
+        result = await _write_lobby_script(keys=[LOBBY_KEY_PREFIX + lobby.code, ACTIVE_LOBBIES_KEY], args=args)
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
+    finally:
+        lobby_cache.invalidate(lobby.code)
+
+    status = _status(result)
+    if status == "not_found":
+        return BadResponse("Лобби не найдено", NOT_FOUND_ERROR)
+    if status == "conflict":
+        return BadResponse("Лобби изменено другим запросом, попробуйте еще раз", CONFLICT)
+    return _lobby_from_hash(lobby.code, _pairs_to_dict(result[1:]))
+
+
+@observe_redis("pin_scenario")
+async def pin_scenario(scenario: Scenario) -> None | BadResponse:
+    """
+    Сохраняет версию сценария, с которой началась игра, чтобы правка файла сценариев не сломала лобби.
+    Ключ живет столько же, сколько ключи лобби, и продлевается каждым стартом игры с этой версией.
+    """
+    try:
+        await redis_client.set(f"{SCENARIO_KEY_PREFIX}{scenario.id}:{scenario.version}",
+                               json.dumps(scenario.to_dict(), ensure_ascii=False), ex=_key_ttl())
+        return None
     except Exception as e:
-        return BadResponse(str(e), INTERNAL_ERROR)
\ No newline at end of file
+        return BadResponse(str(e), INTERNAL_ERROR)
+
+
+@observe_redis("get_pinned_scenario")
+async def get_pinned_scenario(scenario_id: str, version: str) -> Scenario | BadResponse:
+    """Загружает закрепленную версию сценария и добавляет ее в список известных версий."""
+    try:
+        # Чтение продлевает ключ: версия нужна, пока в нее играют
+        raw = await redis_client.getex(f"{SCENARIO_KEY_PREFIX}{scenario_id}:{version}", ex=_key_ttl())
+        if raw is None:
+            return BadResponse("Сценарий не найден", NOT_FOUND_ERROR)
+        scenario = parse_scenario(json.loads(raw))
+    except Exception as e:
+        return BadResponse(str(e), INTERNAL_ERROR)
+    register_scenario(scenario)
+    return scenario
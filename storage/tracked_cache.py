@@ -0,0 +1,136 @@
+import asyncio
+from collections import OrderedDict
+from typing import Any, Hashable
+
+import redis.asyncio as redis
+
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+# Как часто проверять соединение отслеживания, пока нет инвалидаций
+KEEPALIVE_INTERVAL = 30
+RECONNECT_DELAY = 5
+
+
+class TrackedCache:
+    """
+    LRU-кэш значений ключей Redis с одним префиксом в памяти процесса.
+
+    Согласованность между экземплярами бота обеспечивает Redis: соединение отслеживания
+    включает CLIENT TRACKING в режиме BCAST по префиксу ключей, и сервер присылает
+    имена измененных ключей в канал __redis__:invalidate. Пока подписка не работает,
+    кэш выключен и все чтения идут в Redis. Ключ кэша - имя ключа Redis без префикса.
+    """
+
+    def __init__(self, max_size: int, name: str):
+        self.max_size = max_size
+        self.name = name
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Увеличивается при каждой инвалидации: чтение, которое началось раньше, не кладется в кэш
+        self.epoch = 0
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._task: asyncio.Task | None = None
+
+    def get(self, key: Hashable) -> Any | None:
+        if not self.enabled:
+            return None
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, epoch: int) -> None:
+        """Кладет значение, прочитанное при значении epoch, если с тех пор ничего не инвалидировалось."""
+        if not self.enabled or epoch != self.epoch:
+            return
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self.epoch += 1
+        if self._items.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.epoch += 1
+        self.invalidations += len(self._items)
+        self._items.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._items),
+                "max_size": self.max_size,
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations}
+
+    def start(self, client: redis.Redis, key_prefix: str) -> None:
+        if self.max_size > 0 and self._task is None:
+            self._task = asyncio.create_task(self._listen(client, key_prefix))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_invalidate(self, keys: list | None, key_prefix: str) -> None:
+        # None приходит при FLUSHDB/FLUSHALL
+        if keys is None:
+            self.clear()
+            return
+        for key in keys:
+            if isinstance(key, bytes):
+                key = key.decode()
+            self.invalidate(key[len(key_prefix):])
+
+    async def _listen(self, client: redis.Redis, key_prefix: str) -> None:
+        while True:
+            listener = client.connection_pool.make_connection()
+            tracker = client.connection_pool.make_connection()
+            try:
+                await listener.connect()
+                await listener.send_command("CLIENT", "ID")
+                listener_id = await listener.read_response()
+                await listener.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+                await listener.read_response()
+
+                await tracker.connect()
+                await tracker.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", listener_id,
+                                           "BCAST", "PREFIX", key_prefix)
+                await tracker.read_response()
+
+                self.clear()
+                self.enabled = True
+                while True:
+                    message = await listener.read_response(timeout=KEEPALIVE_INTERVAL)
+                    if message is None:
+                        # Без соединения отслеживания инвалидации перестанут приходить
+                        await tracker.send_command("PING")
+                        await tracker.read_response()
+                        continue
+                    kind = message[0].decode() if isinstance(message[0], bytes) else message[0]
+                    if kind == "message":
+                        self._on_invalidate(message[2], key_prefix)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{self.name} отключен, нет подписки на инвалидации: {e}")
+            finally:
+                self.enabled = False
+                self.clear()
+                await listener.disconnect()
+                await tracker.disconnect()
+            await asyncio.sleep(RECONNECT_DELAY)
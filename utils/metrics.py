@@ -0,0 +1,86 @@
+"""
+Метрики бота в формате Prometheus (отдает metrics_server.py).
+
+Метки задаются заранее (обработчик, операция Redis, метод Bot API), поэтому наблюдение
+на горячем пути - это только замер времени и увеличение счетчика.
+"""
+import functools
+import time
+from typing import Awaitable, Callable, TypeVar
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from models.error import BadResponse, INTERNAL_ERROR
+from utils.tracing import start_span, end_span
+
+# Границы корзин гистограмм, с: от долей миллисекунды (Redis) до секунд (Telegram, медленные обработчики)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HANDLER_LATENCY = Histogram("bunker_handler_seconds", "Время работы обработчика команды",
+                            ["handler"], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter("bunker_handler_errors_total", "Исключения в обработчиках команд", ["handler"])
+UPDATES_IN_FLIGHT = Gauge("bunker_updates_in_flight", "Апдейты, которые сейчас обрабатываются")
+
+REDIS_LATENCY = Histogram("bunker_redis_seconds", "Время операции с Redis", ["operation"], buckets=LATENCY_BUCKETS)
+REDIS_ERRORS = Counter("bunker_redis_errors_total", "Ошибки операций с Redis", ["operation"])
+
+TELEGRAM_LATENCY = Histogram("bunker_telegram_seconds", "Время запроса к Bot API", ["method"],
+                             buckets=LATENCY_BUCKETS)
+TELEGRAM_RATE_LIMITED = Counter("bunker_telegram_rate_limited_total", "Ответы 429 (RetryAfter) от Bot API",
+                                ["method"])
+TELEGRAM_ERRORS = Counter("bunker_telegram_errors_total", "Остальные ошибки запросов к Bot API", ["method"])
+
+ACTIVE_LOBBIES = Gauge("bunker_active_lobbies", "Существующие лобби из реестра активных лобби")
+LOBBY_PLAYERS = Gauge("bunker_lobby_players", "Игроки во всех лобби")
+
+OUTBOX_DEPTH = Gauge("bunker_outbox_depth", "Неотправленные уведомления в очереди")
+OUTBOX_PENDING = Gauge("bunker_outbox_pending", "Уведомления, которые отправляются сейчас (взяты отправителями)")
+OUTBOX_OLDEST = Gauge("bunker_outbox_oldest_seconds", "Сколько ждет самое старое неотправленное уведомление")
+OUTBOX_DELIVERY = Histogram("bunker_outbox_delivery_seconds", "Время от постановки уведомления в очередь до отправки",
+                            buckets=LATENCY_BUCKETS + (30, 60, 120))
+OUTBOX_RETRIES = Counter("bunker_outbox_retries_total", "Повторные попытки отправки уведомлений", ["reason"])
+OUTBOX_DROPPED = Counter("bunker_outbox_dropped_total", "Уведомления, которые не удалось отправить")
+OUTBOX_COALESCED = Counter("bunker_outbox_coalesced_total", "Уведомления, отправленные в сводке с предыдущими")
+
+# Кэши процесса (лобби, отрисовка, состояния диалогов): по ним подбираются размеры кэшей.
+# События считаются с запуска процесса и только растут, поэтому к ним применим rate()
+CACHE_ITEMS = Gauge("bunker_cache_items", "Записи в кэше", ["cache"])
+CACHE_MAX_ITEMS = Gauge("bunker_cache_max_items", "Наибольшее число записей в кэше (0 - кэш выключен)", ["cache"])
+CACHE_ENABLED = Gauge("bunker_cache_enabled", "Кэш используется (1) или все чтения идут в Redis (0)", ["cache"])
+CACHE_EVENTS = Gauge("bunker_cache_events", "Попадания, промахи, вытеснения и инвалидации кэша с запуска процесса",
+                     ["cache", "event"])
+
+T = TypeVar("T")
+
+
+def observe_redis(operation: str) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Замеряет время операции репозитория и добавляет ее в дерево вызовов апдейта. Ошибкой считается
+    исключение или BadResponse с INTERNAL_ERROR (так репозиторий возвращает исключения Redis).
+    """
+    latency = REDIS_LATENCY.labels(operation)
+    errors = REDIS_ERRORS.labels(operation)
+    span_name = "redis " + operation
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs) -> T:
+            span = start_span(span_name)
+            started = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                errors.inc()
+                end_span(span, e)
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+            if isinstance(result, BadResponse) and result.code == INTERNAL_ERROR:
+                errors.inc()
+                end_span(span, result.message)
+            else:
+                end_span(span)
+            return result
+        return wrapper
+
+    return decorator
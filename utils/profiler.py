@@ -0,0 +1,165 @@
+"""
+Профилирование работающего бота по запросу (команда /profile или сигнал SIGUSR1).
+
+На заданное время запускается выборочный профилировщик: отдельный поток раз в
+PROFILE_SAMPLE_INTERVAL_MS снимает стек потока цикла событий. Накладные расходы не зависят
+от числа вызовов, поэтому профилировать можно под боевой нагрузкой. Одновременно включается
+tracemalloc (если он еще не включен). Результаты сохраняются в PROFILE_DIR:
+- <время>.folded - стеки в формате flamegraph.pl / speedscope (стек;стек;... число выборок);
+- <время>.top.txt - функции с наибольшим собственным и общим временем;
+- <время>.memory.txt и <время>.tracemalloc - места, где выделено больше всего памяти, и сам снимок.
+"""
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import List
+
+from config import PROFILE_DIR, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_MAX_SECONDS, PROFILE_DEFAULT_SECONDS
+
+TOP_LINES = 40
+TRACEMALLOC_FRAMES = 10
+
+_running: asyncio.Task | None = None
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+def _top_functions(stacks: Counter, samples: int) -> List[str]:
+    own: Counter[str] = Counter()
+    total: Counter[str] = Counter()
+    for stack, count in stacks.items():
+        frames = [frame.rsplit(":", 1)[0] + ")" for frame in stack.split(";")]
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+
+    def table(title: str, counter: Counter) -> List[str]:
+        rows = [title]
+        for frame, count in counter.most_common(TOP_LINES):
+            rows.append(f"{count / samples * 100:6.1f}%  {count:7d}  {frame}")
+        return rows
+
+    return table("Собственное время (функция на вершине стека):", own) + [""] + \
+        table("Общее время (функция есть в стеке):", total)
+
+
+def _write(path: str, lines: List[str]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def profile_seconds(seconds: float) -> float:
+    return min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+
+async def profile(seconds: float) -> List[str]:
+    """Профилирует процесс seconds секунд (не больше PROFILE_MAX_SECONDS) и возвращает пути к файлам результатов."""
+    seconds = profile_seconds(seconds)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}")
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    sampler = _Sampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_MS / 1000)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+    return await asyncio.to_thread(_save, prefix, seconds, sampler, snapshot)
+
+
+def _save(prefix: str, seconds: float, sampler: _Sampler, snapshot: tracemalloc.Snapshot) -> List[str]:
+    paths = [prefix + ".folded", prefix + ".top.txt", prefix + ".memory.txt", prefix + ".tracemalloc"]
+    _write(paths[0], [f"{stack} {count}" for stack, count in sampler.stacks.most_common()])
+    header = f"Профиль {seconds:.0f} с, выборок: {sampler.samples}, интервал {sampler.interval * 1000:.0f} мс"
+    _write(paths[1], [header, ""] + (_top_functions(sampler.stacks, sampler.samples) if sampler.samples else []))
+
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, __file__)))
+    stats = snapshot.statistics("lineno")
+    total = sum(stat.size for stat in stats)
+    _write(paths[2], [f"Выделено с начала отслеживания и не освобождено: {total / 1024:.1f} КиБ", ""] +
+           [str(stat) for stat in stats[:TOP_LINES]])
+    snapshot.dump(paths[3])
+    return paths
+
+
+def is_running() -> bool:
+    return _running is not None and not _running.done()
+
+
+def start_profile(seconds: float) -> asyncio.Task | None:
+    """Запускает профилирование в фоне; None, если оно уже идет."""
+    global _running
+    if is_running():
+        return None
+    _running = asyncio.create_task(profile(seconds))
+    return _running
+
+
+async def stop_profile() -> None:
+    """Прерывает профилирование при остановке бота (результаты не сохраняются)."""
+    if is_running():
+        _running.cancel()
+        try:
+            await _running
+        except asyncio.CancelledError:
+            pass
+
+
+def _on_signal() -> None:
+    task = start_profile(PROFILE_DEFAULT_SECONDS)
+    if task is None:
+        print("Профилирование уже идет")
+        return
+    print(f"Профилирование запущено на {PROFILE_DEFAULT_SECONDS} с")
+    task.add_done_callback(_report)
+
+
+def _report(task: asyncio.Task) -> None:
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        print(f"Ошибка профилирования: {task.exception()}")
+    else:
+        print(f"Профиль сохранен: {', '.join(task.result())}")
+
+
+async def install_profile_signal() -> None:
+    """Профилирование по сигналу SIGUSR1: kill -USR1 <pid процесса бота>."""
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, _on_signal)
@@ -1,48 +1,252 @@
+import asyncio
+import hashlib
 import json
-from typing import List
+import os
+import pickle
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
 
 import config
-from models.scenario import Scenario, WinCondition, Item, Action, BunkerFeature, SpecialCard, SpecialCardAction, \
-    BaseAction
+from models.scenario import Scenario
+from utils.escape import escape_md
+
+# Меняется при изменении формата предкомпилированного каталога
+CATALOG_CACHE_FORMAT = 3
+
+
+def scenario_version(data: dict) -> str:
+    """Версия сценария - хэш его содержимого."""
+    canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()[:12]
+
+
+def validate_scenario(scenario: Scenario) -> None:
+    if not scenario.characteristics or not all(scenario.characteristics.values()):
+        raise ValueError(f"Сценарий {scenario.id}: у каждой характеристики должно быть хотя бы одно значение")
+    if not scenario.items:
+        raise ValueError(f"Сценарий {scenario.id}: нет предметов")
+    if not scenario.special_cards:
+        raise ValueError(f"Сценарий {scenario.id}: нет спец. карт")
+    unknown = set(scenario.repeatable_cards) - set(scenario.characteristics) - {"items", "special_cards"}
+    if unknown:
+        raise ValueError(f"Сценарий {scenario.id}: неизвестные колоды в repeatable_cards: {', '.join(sorted(unknown))}")
+
+
+def escape_scenario_text(scenario: Scenario) -> None:
+    """Экранирует все строки сценария, которые выводятся игрокам, чтобы не делать этого при каждой отрисовке."""
+    texts = [scenario.name]
+    for name, values in scenario.characteristics.items():
+        texts.append(name)
+        texts += values
+    for card in scenario.items + scenario.special_cards + scenario.bunker_features:
+        texts += [card.name, card.description]
+    scenario.escaped_text = {text: escape_md(text) for text in texts}
+
+
+def parse_scenario(data: dict) -> Scenario:
+    scenario = Scenario.from_dict(data)
+    validate_scenario(scenario)
+    scenario.version = scenario_version(scenario.to_dict())
+    escape_scenario_text(scenario)
+    return scenario
 
 
 def load_scenarios_from_file(path: str) -> List[Scenario]:
     with open(path, encoding='utf-8') as f:
         raw_data = json.load(f)
 
-    scenarios = []
-    for s in raw_data:
-        win_condition = WinCondition.from_dict(s["win_condition"])
+    # Файл может содержать как список сценариев, так и один сценарий
+    if isinstance(raw_data, dict):
+        raw_data = [raw_data]
+    return [parse_scenario(s) for s in raw_data]
+
+
+def scenario_files(path: str) -> List[str]:
+    """Файлы сценариев: сам path или все *.json в каталоге path."""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json"))
+    return [path]
+
+
+def source_signature(path: str) -> Tuple:
+    """Дешевая проверка изменений без чтения файлов: список файлов, их размеры и время изменения."""
+    signature = []
+    for file in scenario_files(path):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            continue
+        signature.append((file, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def source_hash(files: List[str]) -> str:
+    digest = hashlib.sha1(str(CATALOG_CACHE_FORMAT).encode())
+    for file in files:
+        digest.update(file.encode())
+        with open(file, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ScenarioCatalog:
+    """Загруженные сценарии с поиском по id; предметы и спец. карты индексируются внутри Scenario."""
+
+    def __init__(self, scenarios: List[Scenario], version: str):
+        self.scenarios = scenarios
+        self.version = version
+        self.signature: Tuple = ()
+        self.load_seconds = 0.0
+        self._by_id: Dict[str, Scenario] = {}
+        for scenario in scenarios:
+            if scenario.id in self._by_id:
+                raise ValueError(f"Сценарий {scenario.id} описан несколько раз")
+            self._by_id[scenario.id] = scenario
+
+    def get(self, scenario_id: str) -> Scenario | None:
+        return self._by_id.get(scenario_id)
+
+
+def load_catalog(path: str, cache_path: str | None) -> ScenarioCatalog:
+    """
+    Загружает каталог из файла или каталога сценариев.
+
+    Разобранный и проверенный каталог сохраняется в cache_path и переиспользуется,
+    пока не изменится содержимое исходных файлов.
+    """
+    start = time.perf_counter()
+    signature = source_signature(path)
+    files = [file for file, _, _ in signature]
+    version = source_hash(files)
+
+    catalog = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cached_version, scenarios = pickle.load(f)
+            if cached_version == version:
+                catalog = ScenarioCatalog(scenarios, version)
+        except Exception as e:
+            print(f"Не удалось прочитать кэш сценариев {cache_path}: {e}")
+
+    if catalog is None:
+        scenarios = [scenario for file in files for scenario in load_scenarios_from_file(file)]
+        catalog = ScenarioCatalog(scenarios, version)
+        _save_cache(cache_path, catalog)
+
+    catalog.signature = signature
+    catalog.load_seconds = time.perf_counter() - start
+    return catalog
+
+
+def _save_cache(cache_path: str | None, catalog: ScenarioCatalog) -> None:
+    if cache_path:
+        try:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump((catalog.version, catalog.scenarios), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Не удалось сохранить кэш сценариев {cache_path}: {e}")
+
+
+_catalog: ScenarioCatalog | None = None
+_watcher: asyncio.Task | None = None
+
+# Версии сценариев, закрепленные запущенными играми, но отсутствующие в текущем каталоге.
+# LRU на config.SCENARIO_PINNED_CACHE_SIZE версий: каждая перезагрузка каталога добавляет версии, а вытесненная
+# версия заново читается из Redis (get_pinned_scenario), где она закреплена при старте игры
+_pinned_versions: OrderedDict[Tuple[str, str], Scenario] = OrderedDict()
+
+
+def get_catalog() -> ScenarioCatalog:
+    """Каталог сценариев; загружается при первом обращении."""
+    global _catalog
+    if _catalog is None:
+        _catalog = load_catalog(config.CONFIG_FILE, config.SCENARIO_CACHE_FILE)
+        _report(_catalog, "загружен")
+    return _catalog
+
+
+def _report(catalog: ScenarioCatalog, action: str) -> None:
+    print(f"Каталог сценариев {action}: версия {catalog.version[:12]}, "
+          f"сценариев {len(catalog.scenarios)}, {catalog.load_seconds * 1000:.1f} мс")
+
+
+def _swap_catalog(catalog: ScenarioCatalog) -> None:
+    global _catalog
+    old = _catalog
+    # Игры, начатые на прежней версии, продолжают получать ее из памяти
+    if old is not None:
+        for scenario in old.scenarios:
+            current = catalog.get(scenario.id)
+            if current is None or current.version != scenario.version:
+                register_scenario(scenario)
+    # Обработчики читают _catalog без ожиданий, поэтому замена одним присваиванием атомарна
+    _catalog = catalog
+
+
+async def reload_catalog() -> bool:
+    """Пересобирает каталог в отдельном потоке; возвращает True, если версия изменилась."""
+    catalog = await asyncio.to_thread(load_catalog, config.CONFIG_FILE, config.SCENARIO_CACHE_FILE)
+    current = get_catalog()
+    if catalog.version == current.version:
+        current.signature = catalog.signature
+        return False
+    _swap_catalog(catalog)
+    _report(catalog, "обновлен")
+    return True
+
 
-        items = [
-            Item.from_dict(i)
-            for i in s.get("items", [])
-        ]
+async def _watch(interval: float) -> None:
+    failed_signature = None
+    while True:
+        await asyncio.sleep(interval)
+        signature = None
+        try:
+            signature = await asyncio.to_thread(source_signature, config.CONFIG_FILE)
+            if signature in (get_catalog().signature, failed_signature):
+                continue
+            await reload_catalog()
+        except Exception as e:
+            # Ошибка в файлах сценариев не должна ронять бота: остается прежний каталог до следующей правки
+            failed_signature = signature
+            print(f"Не удалось обновить каталог сценариев: {e}")
 
-        bunker_features = [BunkerFeature.from_dict(bf) for bf in s.get("bunker_features", [])]
 
-        special_cards = [
-            SpecialCard.from_dict(sc)
-            for sc in s.get("special_cards", [])
-        ]
+async def start_catalog_watcher() -> None:
+    global _watcher
+    get_catalog()
+    if config.SCENARIO_RELOAD_INTERVAL > 0 and _watcher is None:
+        _watcher = asyncio.create_task(_watch(config.SCENARIO_RELOAD_INTERVAL))
 
-        base_actions = [BaseAction.from_dict(a) for a in s.get("base_actions", [])]
 
-        scenario = Scenario(
-            id=s["id"],
-            name=s["name"],
-            description=s["description"],
-            win_condition=win_condition,
-            characteristics=s["characteristics"],
-            items=items,
-            bunker_features=bunker_features,
-            special_cards=special_cards,
-            base_actions=base_actions
-        )
+async def stop_catalog_watcher() -> None:
+    global _watcher
+    if _watcher is not None:
+        _watcher.cancel()
+        try:
+            await _watcher
+        except asyncio.CancelledError:
+            pass
+        _watcher = None
 
-        scenarios.append(scenario)
 
-    return scenarios
+def register_scenario(scenario: Scenario) -> None:
+    key = (scenario.id, scenario.version)
+    _pinned_versions[key] = scenario
+    _pinned_versions.move_to_end(key)
+    while len(_pinned_versions) > max(config.SCENARIO_PINNED_CACHE_SIZE, 0):
+        _pinned_versions.popitem(last=False)
 
 
-SCENARIOS = load_scenarios_from_file("./utils/config.json")
+def get_scenario(scenario_id: str, version: str = "") -> Scenario | None:
+    """Возвращает сценарий нужной версии; без версии - текущий."""
+    scenario = get_catalog().get(scenario_id)
+    if not version or (scenario is not None and scenario.version == version):
+        return scenario
+    scenario = _pinned_versions.get((scenario_id, version))
+    if scenario is not None:
+        _pinned_versions.move_to_end((scenario_id, version))
+    return scenario
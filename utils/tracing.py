@@ -0,0 +1,93 @@
+"""
+Дерево вызовов на время обработки одного апдейта: обработчик -> функции сервисов -> запросы к Redis и Bot API.
+
+Текущий узел хранится в contextvars, поэтому задачи, запущенные из обработчика (asyncio.gather),
+добавляют свои узлы к тому же дереву. Вне апдейта (фоновые задачи) узлы не создаются.
+"""
+import functools
+import time
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple
+
+from config import TRACE_MAX_SPANS
+
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    started: float
+    duration: float | None = None
+    error: str | None = None
+    children: List["Span"] = field(default_factory=list)
+    # Общий для всего дерева счетчик узлов (список из одного числа)
+    budget: List[int] = field(default_factory=lambda: [TRACE_MAX_SPANS])
+
+
+_current: ContextVar[Span | None] = ContextVar("trace_span", default=None)
+
+
+def start_trace(name: str) -> Tuple[Span, Token]:
+    root = Span(name, time.perf_counter())
+    return root, _current.set(root)
+
+
+def start_span(name: str) -> Tuple[Span, Token] | None:
+    """Добавляет узел к текущему дереву; None, если дерева нет, оно уже закрыто или переполнено."""
+    parent = _current.get()
+    if parent is None or parent.duration is not None or parent.budget[0] <= 0:
+        return None
+    parent.budget[0] -= 1
+    span = Span(name, time.perf_counter(), budget=parent.budget)
+    parent.children.append(span)
+    return span, _current.set(span)
+
+
+def end_span(started: Tuple[Span, Token] | None, error: BaseException | str | None = None) -> None:
+    if started is None:
+        return
+    span, token = started
+    span.duration = time.perf_counter() - span.started
+    if error is not None:
+        span.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+    _current.reset(token)
+
+
+def traced(name: str | None = None) -> Callable:
+    """Декоратор асинхронной функции: ее вызов становится узлом дерева текущего апдейта."""
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = start_span(span_name)
+            if started is None:
+                return await func(*args, **kwargs)
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as e:
+                end_span(started, e)
+                raise
+            end_span(started)
+            return result
+        return wrapper
+
+    return decorator
+
+
+def format_trace(root: Span) -> str:
+    lines = []
+
+    def walk(span: Span, depth: int) -> None:
+        offset = (span.started - root.started) * 1000
+        duration = f"{span.duration * 1000:.1f} мс" if span.duration is not None else "не завершен"
+        error = f" ({span.error})" if span.error else ""
+        lines.append(f"{'  ' * depth}{span.name}: {duration}, начало +{offset:.1f} мс{error}")
+        for child in span.children:
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    if root.budget[0] <= 0:
+        lines.append(f"(записаны первые {TRACE_MAX_SPANS} вызовов)")
+    return "\n".join(lines)
@@ -0,0 +1,146 @@
+"""
+Прием апдейтов через вебхук (aiohttp).
+
+Запрос от Telegram только проверяется и кладется в очередь, ответ отправляется сразу.
+Апдейты обрабатывают WEBHOOK_WORKERS фоновых задач; апдейты одного пользователя всегда
+попадают к одной задаче, поэтому обрабатываются по порядку, как при polling.
+"""
+import asyncio
+import multiprocessing
+import signal
+from typing import Any, Callable, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_WORKERS, \
+    WEBHOOK_QUEUE_SIZE
+
+# Поля апдейта, из которых берется отправитель (остальные типы апдейтов распределяются по update_id)
+_USER_EVENTS = ("message", "edited_message", "callback_query", "inline_query", "my_chat_member")
+
+
+def _shard_key(update: Dict[str, Any]) -> int:
+    for event_type in _USER_EVENTS:
+        event = update.get(event_type)
+        if event and "from" in event:
+            return event["from"]["id"]
+    return update.get("update_id", 0)
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука с фиксированным числом задач-обработчиков вместо задачи на каждый апдейт."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str | None,
+                 workers: int, queue_size: int, **data: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while True:
+            update = await queue.get()
+            try:
+                await self._background_feed_update(self.bot, update)
+            except Exception as e:
+                print(f"Ошибка при обработке апдейта {update.get('update_id')}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        queue = self._queues[_shard_key(update) % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        """Дорабатывает принятые апдейты; сессию бота закрывает приложение после остановки диспетчера."""
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def build_app(dp: Dispatcher, bot: Bot, workers: int = WEBHOOK_WORKERS,
+              register_webhook: bool = True) -> web.Application:
+    handler = QueuedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET,
+                                   workers=workers, queue_size=WEBHOOK_QUEUE_SIZE)
+    app = web.Application()
+    app["webhook_handler"] = handler
+
+    async def on_startup(_: web.Application) -> None:
+        handler.start()
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        if WEBHOOK_URL and register_webhook:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                                  secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+
+    async def on_shutdown(_: web.Application) -> None:
+        # Сначала дорабатываются принятые апдейты, затем останавливается диспетчер (в том числе рассылка)
+        await handler.close()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+
+    async def on_cleanup(_: web.Application) -> None:
+        await bot.session.close()
+
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, reuse_port: bool = False, register_webhook: bool = True) -> None:
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для режима webhook нужно задать WEBHOOK_SECRET")
+    runner = web.AppRunner(build_app(dp, bot, register_webhook=register_webhook))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=reuse_port)
+    await site.start()
+    print(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+def run_processes(processes: int, target: Callable[[int], None]) -> None:
+    """
+    Запускает processes процессов target(index) и ждет их завершения.
+
+    Процессы слушают один порт (SO_REUSEPORT), ядро распределяет между ними соединения Telegram.
+    Все состояние игры хранится в Redis, изменения одного лобби из разных процессов
+    упорядочиваются блокировкой лобби (см. acquire_lobby_lock).
+    """
+    context = multiprocessing.get_context("spawn")
+    children = [context.Process(target=target, args=(index,), name=f"bot-{index}") for index in range(processes)]
+    for child in children:
+        child.start()
+
+    def stop(*_):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.join()